@@ -0,0 +1,75 @@
+"""
+Compares splitting a full chain at issuance through pyOpenSSL and a second
+parse with splitting it in one pass.
+
+    python benchmarks/fullchain.py [iterations]
+"""
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+import OpenSSL
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.x509 import NameOID
+
+from certifire import config
+from certifire.plugins.acme import crypto
+
+
+def make_fullchain(length=3):
+    pems = []
+    issuer_key = issuer_name = None
+    for i in reversed(range(length)):
+        key = crypto.generate_private_key('RSA2048')
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'cert{}.certifire.xyz'.format(i))])
+        now = datetime.utcnow()
+        cert = x509.CertificateBuilder().subject_name(name).issuer_name(
+            issuer_name or name
+        ).public_key(key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(
+            now
+        ).not_valid_after(now + timedelta(days=90)).sign(issuer_key or key, hashes.SHA256(),
+                                                        default_backend())
+        pems.insert(0, crypto.export_pem_certificate(cert).decode('ascii'))
+        issuer_key, issuer_name = key, name
+    return ''.join(pems)
+
+
+def legacy(fullchain_pem):
+    pem_certificate = OpenSSL.crypto.dump_certificate(
+        OpenSSL.crypto.FILETYPE_PEM,
+        OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, fullchain_pem),
+    ).decode()
+    pem_chain = fullchain_pem[len(pem_certificate):].lstrip()
+    certificate = crypto.load_pem_certificate(pem_certificate.encode())
+    body = crypto.export_pem_certificate(certificate).decode('UTF-8')
+    while pem_chain:
+        # each intermediate is split off the same way, then parsed once more
+        # to be stored by fingerprint
+        pem_intermediate = OpenSSL.crypto.dump_certificate(
+            OpenSSL.crypto.FILETYPE_PEM,
+            OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, pem_chain),
+        ).decode()
+        pem_chain = pem_chain[len(pem_intermediate):].lstrip()
+        chain = crypto.load_pem_certificate(pem_intermediate.encode())
+        intermediate = crypto.export_pem_certificate(chain).decode('UTF-8')
+        crypto.get_certificate_fingerprint(crypto.load_pem_certificate(intermediate.encode()))
+    return body, certificate.not_valid_after, crypto.get_certificate_fingerprint(certificate)
+
+
+def single_pass(fullchain_pem):
+    (body, certificate), chain = crypto.split_fullchain(fullchain_pem)
+    for _, intermediate in chain:
+        crypto.get_certificate_fingerprint(intermediate)
+    return body, certificate.not_valid_after, crypto.get_certificate_fingerprint(certificate)
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    config.IDENTRUST_CROSS_SIGNED_LE_ICA = None
+    fullchain = make_fullchain()
+    assert legacy(fullchain) == single_pass(fullchain)
+    for name, func in (('legacy', legacy), ('single pass', single_pass)):
+        seconds = min(timeit.repeat(lambda: func(fullchain), number=iterations, repeat=3))
+        print('{:12} {:8.1f} us/chain'.format(name, seconds / iterations * 1e6))
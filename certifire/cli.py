@@ -6,6 +6,7 @@ import sys
 from certifire import app, auth, config, database, db, get_version
 from certifire.errors import CertifireError
 from certifire.plugins.acme import crypto
+from certifire.plugins.acme.importer import import_certificates
 from certifire.plugins.acme.models import Account, Certificate, Order
 from certifire.plugins.acme.plugin import (create_order, register, reorder,
                                            revoke_certificate)
@@ -79,6 +80,17 @@ current account.
 Takes account_id and certificate_id as required arguments
 """
 
+DESCRIPTION_IMPORT = \
+    """
+Imports certificates issued by other tooling. Takes PEM or DER files and
+directories, which are searched recursively.
+
+Private keys are matched to their certificates by public key, so a key can
+be in the same bundle as its certificate or in a file of its own. CA
+certificates found are stored as the intermediates of the certificates they
+issued. Certificates already in the database are skipped.
+"""
+
 # Command handlers
 
 
@@ -98,7 +110,8 @@ def _register(args):
             organizational_unit=args.organizational_unit,
             country=args.country,
             state=args.state,
-            location=args.location)
+            location=args.location,
+            key_type=args.key_type)
 
     if ret:
         print("Account created with account id: {}".format(act_id))
@@ -115,7 +128,7 @@ def _issue(args):
     csr = None
     if args.csr_file:
         with open(args.csr_file, 'rb') as f:
-            key = crypto.load_csr(f.read())
+            csr = crypto.load_csr(f.read())
 
     with app.app_context():
         ret, order_id = create_order(
@@ -132,7 +145,8 @@ def _issue(args):
             location=args.location,
             reissue=args.reissue,
             csr=csr,
-            key=key)
+            key=key,
+            key_type=args.key_type)
 
     if ret:
         print("Order created with order id: {}".format(order_id))
@@ -154,6 +168,16 @@ def _revoke(args):
 
         revoke_certificate(order.account_id, certdb.id)
 
+def _import(args):
+    with app.app_context():
+        summary = import_certificates(1, args.paths, workers=args.workers,
+                                      batch_size=args.batch_size)
+
+    for error in summary['errors']:
+        print(error)
+    print("{} files read, {} certificates imported, {} already stored, {} without a private key".format(
+        summary['files'], summary['imported'], summary['duplicates'], summary['without_key']))
+
 def _create_dest(args):
     pkey = None
     if args.pkey:
@@ -251,6 +275,9 @@ def certifire_main():
     register.add_argument('--country', '-c', help="Name of country")
     register.add_argument('--state', '-s', help="Name of state")
     register.add_argument('--location', '-l', help="Name of location")
+    register.add_argument('--key-type',
+                          help="Default certificate key type of the account",
+                          choices=list(crypto.KEY_TYPES))
     register.set_defaults(func=_register)
 
     # Certificate issuance
@@ -284,6 +311,10 @@ def certifire_main():
 
     issue.add_argument('--csr-file', help="Existing signing request to use")
 
+    issue.add_argument('--key-type',
+                       help="Certificate key type, defaults to the account's",
+                       choices=list(crypto.KEY_TYPES))
+
     issue.add_argument('--email', '-e', help="email address for CSR")
     issue.add_argument('--organization', '-o', help="Name of organization")
     issue.add_argument('--organizational_unit', '-u',
@@ -310,6 +341,20 @@ def certifire_main():
                         help="The acme account id to use", required=True)
     revoke.set_defaults(func=_revoke)
 
+    # Certificate import
+    importer = subparsers.add_parser(
+        'import',
+        help="Import existing certificates and keys",
+        description=DESCRIPTION_IMPORT,
+        formatter_class=Formatter,
+    )
+    importer.add_argument("paths", help="Files or directories to import", nargs='+')
+    importer.add_argument('--workers', '-w', type=int, default=config.IMPORT_WORKERS,
+                          help="Parsing processes, 0 parses inline")
+    importer.add_argument('--batch-size', '-b', type=int, default=config.IMPORT_BATCH_SIZE,
+                          help="Certificates inserted per transaction")
+    importer.set_defaults(func=_import)
+
     destination = subparsers.add_parser(
         'destination',
         help="Manage Destinations",
@@ -19,4 +19,11 @@ class UnknownProvider(CertifireError):
     pass
 
 class PluginError(CertifireError):
-    pass
\ No newline at end of file
+    pass
+
+class BacklogFull(CertifireError):
+    def __init__(self, limit):
+        self.limit = limit
+
+    def __str__(self):
+        return repr("Issuance backlog is full ({0} orders waiting), try again later".format(self.limit))
@@ -2,12 +2,32 @@ import os
 import unittest
 
 from flask_migrate import Migrate, MigrateCommand
-from flask_script import Manager
+from flask_script import Manager, Server
 
-from certifire import app, database, db, users
+from certifire import app, config, database, db, users
 from certifire.plugins.acme import views
+from certifire.plugins.acme.jobs import start_dispatcher
+from certifire.plugins.acme.plugin import (backfill_certificate_metadata,
+                                           convert_certificate_storage,
+                                           dedupe_intermediates)
 from certifire.plugins.destinations import views
 
+
+class IssuingServer(Server):
+    """Runs the server along with the issuance queue dispatcher."""
+
+    def __call__(self, app, *args, **kwargs):
+        use_reloader = kwargs.get('use_reloader')
+        if use_reloader is None:
+            use_reloader = app.debug
+        # with the reloader on, only the child process serves requests
+        if not config.ISSUANCE_EMBEDDED_WORKER:
+            print("Issuance is left to certifire-worker processes")
+        elif not use_reloader or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_dispatcher(app)
+        return super().__call__(app, *args, **kwargs)
+
+
 manager = Manager(app)
 migrate = Migrate(app, db)
 
@@ -38,10 +58,29 @@ def drop_db():
     db.drop_all()
 
 
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=500)
+def backfill_certificates(batch_size=500):
+    """Fills the metadata columns of existing certificates"""
+    backfill_certificate_metadata(batch_size)
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=500)
+def dedupe_chains(batch_size=500):
+    """Moves certificate intermediates into the shared intermediates table"""
+    dedupe_intermediates(batch_size)
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=500)
+def convert_storage(batch_size=500):
+    """Rewrites certificates and keys as DER or PEM, following COMPACT_STORAGE"""
+    convert_certificate_storage(batch_size)
+
+
 def main():
     manager.run()
 
 manager.add_command('db', MigrateCommand)
+manager.add_command('runserver', IssuingServer())
 
 @manager.command
 def test():
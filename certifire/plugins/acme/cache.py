@@ -0,0 +1,118 @@
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta, timezone
+
+import josepy as jose
+from certifire import config
+from certifire.plugins.acme import crypto
+
+from acme import messages
+
+AccountKey = namedtuple('AccountKey', ['key', 'jwk', 'thumbprint'])
+
+
+def key_digest(key_pem: str) -> str:
+    return hashlib.sha256(key_pem.encode("utf8")).hexdigest()
+
+
+class AuthorizationCache:
+    """
+    Bounded LRU cache of valid authorizations, keyed by account and
+    authorization URL. A valid authorization does not change until it
+    expires, so it is served from here until shortly before its expiry.
+    """
+
+    def __init__(self, max_size=None, margin=None):
+        self.max_size = max_size or config.AUTHZ_CACHE_SIZE
+        self.margin = timedelta(seconds=config.AUTHZ_CACHE_MARGIN if margin is None else margin)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fresh(self, authzr):
+        expires = authzr.body.expires
+        if expires is None:
+            return False
+        if expires.tzinfo is None:
+            expires = expires.replace(tzinfo=timezone.utc)
+        return expires - self.margin > datetime.now(timezone.utc)
+
+    def get(self, account, url):
+        key = (account, url)
+        with self._lock:
+            authzr = self._entries.get(key)
+            if authzr is None:
+                return None
+            if not self._fresh(authzr):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return authzr
+
+    def put(self, account, authzr):
+        if authzr.body.status != messages.STATUS_VALID or not self._fresh(authzr):
+            return
+        key = (account, authzr.uri)
+        with self._lock:
+            self._entries[key] = authzr
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+authorization_cache = AuthorizationCache()
+
+
+class AccountKeyCache:
+    """
+    Bounded LRU cache of parsed account keys with their JWK and thumbprint,
+    keyed by account id and a digest of the PEM, so a changed key is never
+    served from the cache.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or config.ACCOUNT_KEY_CACHE_SIZE
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, account_id, key_pem):
+        digest = key_digest(key_pem)
+        with self._lock:
+            entry = self._entries.get(account_id)
+            if entry is not None and entry[0] == digest:
+                self._entries.move_to_end(account_id)
+                return entry[1]
+
+        key = crypto.load_private_key(key_pem.encode("utf8"))
+        account_key = AccountKey(key, jose.JWKRSA(key=key), crypto.generate_jwk_thumbprint(key))
+        with self._lock:
+            self._entries[account_id] = (digest, account_key)
+            self._entries.move_to_end(account_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return account_key
+
+    def invalidate(self, account_id):
+        with self._lock:
+            self._entries.pop(account_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+account_key_cache = AccountKeyCache()
+
+
+def get_account_key(account) -> AccountKey:
+    return account_key_cache.get(account.id, account.key)
@@ -0,0 +1,206 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+import josepy as jose
+import requests
+from certifire import config
+from certifire.plugins.acme.cache import (account_key_cache, get_account_key,
+                                          key_digest)
+from requests.adapters import HTTPAdapter
+
+from acme import errors, jws
+from acme.client import BackwardsCompatibleClientV2, ClientNetwork
+from acme.messages import RegistrationResource
+
+logger = logging.getLogger(__name__)
+
+_clients = {}
+_clients_lock = threading.Lock()
+_nonce_pools = {}
+_nonce_pools_lock = threading.Lock()
+
+
+def decode_nonce(response):
+    nonce = response.headers.get(ClientNetwork.REPLAY_NONCE_HEADER)
+    if nonce is None:
+        raise errors.MissingNonce(response)
+    try:
+        return jws.Header._fields['nonce'].decode(nonce)
+    except jose.DeserializationError as error:
+        raise errors.BadNonce(nonce, error)
+
+
+class NoncePool:
+    """
+    Replay nonces of one ACME server, shared by every client talking to it.
+    Nonces returned with each response are kept for the next request, and
+    when the pool runs low it is topped up from newNonce in the background,
+    so most requests do not pay for a HEAD round trip of their own.
+    """
+
+    def __init__(self, new_nonce_url, size=None, max_age=None):
+        self.new_nonce_url = new_nonce_url
+        self.size = config.ACME_NONCE_POOL_SIZE if size is None else size
+        self.max_age = config.ACME_NONCE_MAX_AGE if max_age is None else max_age
+        self.hits = 0
+        self.misses = 0
+        self._nonces = deque()
+        self._lock = threading.Lock()
+        self._refilling = False
+        self._session = requests.Session()
+
+    def get(self):
+        """
+        Returns the freshest pooled nonce, or None on a miss.
+        """
+        with self._lock:
+            self._expire()
+            if self._nonces:
+                self.hits += 1
+                nonce = self._nonces.pop()[1]
+            else:
+                self.misses += 1
+                nonce = None
+            low = len(self._nonces) < self.size // 2
+        if low:
+            self.refill_async()
+        return nonce
+
+    def add(self, nonce):
+        with self._lock:
+            self._nonces.append((time.monotonic(), nonce))
+            while len(self._nonces) > self.size:
+                self._nonces.popleft()
+
+    def _expire(self):
+        oldest = time.monotonic() - self.max_age
+        while self._nonces and self._nonces[0][0] < oldest:
+            self._nonces.popleft()
+
+    def refill(self):
+        try:
+            while len(self._nonces) < self.size:
+                response = self._session.head(self.new_nonce_url, timeout=10)
+                self.add(decode_nonce(response))
+        except Exception as e:
+            logger.warning("Nonce refill from {} failed: {}".format(self.new_nonce_url, e))
+        finally:
+            with self._lock:
+                self._refilling = False
+
+    def refill_async(self):
+        with self._lock:
+            if self._refilling:
+                return
+            self._refilling = True
+        threading.Thread(target=self.refill, name='certifire-nonces', daemon=True).start()
+
+    @property
+    def stats(self):
+        return {'size': len(self._nonces), 'hits': self.hits, 'misses': self.misses}
+
+
+def get_nonce_pool(new_nonce_url):
+    with _nonce_pools_lock:
+        pool = _nonce_pools.get(new_nonce_url)
+        if pool is None:
+            pool = _nonce_pools[new_nonce_url] = NoncePool(new_nonce_url)
+        return pool
+
+
+def nonce_pool_stats():
+    with _nonce_pools_lock:
+        return {url: pool.stats for url, pool in _nonce_pools.items()}
+
+
+class ThreadSafeClientNetwork(ClientNetwork):
+    """
+    ClientNetwork whose nonces can be consumed by several threads at once.
+    The stock implementation checks for a nonce and pops it in two steps.
+    Its connection pool is sized for all threads sharing the client, and its
+    nonces come from the shared pool of the server once one is attached.
+    """
+
+    nonce_pool = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        adapter = HTTPAdapter(pool_connections=config.ACME_HTTP_POOL_SIZE,
+                              pool_maxsize=config.ACME_HTTP_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _add_nonce(self, response):
+        if self.nonce_pool is None:
+            return super()._add_nonce(response)
+        self.nonce_pool.add(decode_nonce(response))
+
+    def _get_nonce(self, url, new_nonce_url):
+        if self.nonce_pool is not None:
+            nonce = self.nonce_pool.get()
+            if nonce is not None:
+                return nonce
+            # a miss is fetched for this request only, not via the pool
+            return decode_nonce(self._check_response(self.head(new_nonce_url or url),
+                                                     content_type=None))
+        while True:
+            try:
+                return self._nonces.pop()
+            except KeyError:
+                pass
+            if new_nonce_url is None:
+                response = self.head(url)
+            else:
+                response = self._check_response(self.head(new_nonce_url), content_type=None)
+            self._add_nonce(response)
+
+
+def _build_client(account):
+    key = get_account_key(account).jwk
+    regr = RegistrationResource.from_json(json.loads(account.contents))
+    net = ThreadSafeClientNetwork(key, account=regr)
+    client = BackwardsCompatibleClientV2(net, key, account.directory_uri)
+    new_nonce_url = getattr(client.directory, 'newNonce', None)
+    if config.ACME_NONCE_POOL_SIZE and new_nonce_url:
+        net.nonce_pool = get_nonce_pool(new_nonce_url)
+    return key, client
+
+
+def get_acme_client(account):
+    """
+    Returns the (key, client) pair of an account. Clients are built once per
+    process and shared by all threads, keeping their directory, nonces and
+    keep-alive connections. A changed account key builds a new client.
+    """
+    digest = key_digest(account.key)
+    with _clients_lock:
+        entry = _clients.get(account.id)
+    if entry is not None and entry[0] == digest:
+        return entry[1], entry[2]
+
+    # built outside the lock, fetching the directory is a network call
+    key, client = _build_client(account)
+    with _clients_lock:
+        entry = _clients.get(account.id)
+        if entry is not None and entry[0] == digest:
+            return entry[1], entry[2]
+        _clients[account.id] = (digest, key, client)
+    return key, client
+
+
+def invalidate_acme_client(account_id: int):
+    """
+    Drops the cached client of an account, after deregistration or a key
+    change.
+    """
+    with _clients_lock:
+        _clients.pop(account_id, None)
+    account_key_cache.invalidate(account_id)
+
+
+def clear_acme_clients():
+    with _clients_lock:
+        _clients.clear()
@@ -1,8 +1,8 @@
 import base64
+import binascii
 import datetime
 import json
 import logging
-import re
 
 import josepy as jose
 import OpenSSL
@@ -10,11 +10,10 @@ from certifire import config
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
 from cryptography.hazmat.primitives.asymmetric.ec import \
     EllipticCurvePrivateKey
-from cryptography.hazmat.primitives.asymmetric.rsa import (
-    RSAPrivateKey, generate_private_key)
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
 from cryptography.hazmat.primitives.serialization import (Encoding,
                                                           NoEncryption,
                                                           PrivateFormat,
@@ -31,11 +30,46 @@ def jose_b64(data):
     return base64.urlsafe_b64encode(data).decode('ascii').replace('=', '')
 
 
+KEY_TYPES = {
+    'RSA2048': 2048,
+    'RSA3072': 3072,
+    'RSA4096': 4096,
+    'ECCPRIME256V1': ec.SECP256R1,
+    'ECCSECP384R1': ec.SECP384R1,
+}
+
+
 def generate_rsa_key(size=4096):
     """
     Generates a new RSA private key.
     """
-    return generate_private_key(65537, size, default_backend())
+    return rsa.generate_private_key(65537, size, default_backend())
+
+
+def generate_private_key(key_type):
+    """
+    Generates a new private key of one of the KEY_TYPES.
+    """
+    if key_type not in KEY_TYPES:
+        raise ValueError("Unsupported key type {}, use one of {}".format(
+            key_type, ', '.join(KEY_TYPES)))
+    if key_type.startswith('RSA'):
+        return generate_rsa_key(KEY_TYPES[key_type])
+    return ec.generate_private_key(KEY_TYPES[key_type](), default_backend())
+
+
+def get_key_type(key):
+    """
+    Returns the key type of a private or public key, None if it is not one
+    of the KEY_TYPES.
+    """
+    if isinstance(key, (rsa.RSAPrivateKey, rsa.RSAPublicKey)):
+        key_type = 'RSA{}'.format(key.key_size)
+    elif isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)):
+        key_type = {'secp256r1': 'ECCPRIME256V1', 'secp384r1': 'ECCSECP384R1'}.get(key.curve.name)
+    else:
+        return None
+    return key_type if key_type in KEY_TYPES else None
 
 
 def export_private_key(key):
@@ -72,6 +106,13 @@ def load_csr(data):
     return x509.load_pem_x509_csr(data, default_backend())
 
 
+def export_pem_csr(csr):
+    """
+    Exports a X.509 CSR as PEM.
+    """
+    return csr.public_bytes(Encoding.PEM)
+
+
 def generate_header(account_key):
     """
     Creates a new request header for the specified account key.
@@ -112,7 +153,7 @@ def create_csr(csr_config, private_key=None):
     :param csr_config:
     """
     if not private_key:
-        private_key = generate_rsa_key(4096)
+        private_key = generate_private_key(csr_config.get("key_type", config.DEFAULT_KEY_TYPE))
 
     builder = x509.CertificateSigningRequestBuilder()
     name_list = [x509.NameAttribute(
@@ -235,6 +276,27 @@ def get_certificate_domains(cert):
     return []
 
 
+def get_certificate_fingerprint(cert):
+    """
+    Gets the hex SHA256 fingerprint of a certificate.
+    """
+    return binascii.hexlify(cert.fingerprint(hashes.SHA256())).decode('ascii')
+
+
+def get_certificate_metadata(cert):
+    """
+    Gets the fields of a certificate that are stored next to its PEM.
+    """
+    return {
+        'serial': format(cert.serial_number, 'x'),
+        'issuer': cert.issuer.rfc4514_string(),
+        'not_before': cert.not_valid_before,
+        'not_after': cert.not_valid_after,
+        'key_type': get_key_type(cert.public_key()),
+        'san': list(get_certificate_domains(cert)),
+    }
+
+
 def export_pem_certificate(cert):
     """
     Exports a X.509 certificate as PEM.
@@ -249,31 +311,131 @@ def export_certificate_for_acme(cert):
     return jose_b64(cert.public_bytes(Encoding.DER))
 
 
-def strip_certificates(data):
-    p = re.compile("-----BEGIN CERTIFICATE-----\n(?s).+?"
-                   "-----END CERTIFICATE-----\n")
-    stripped_data = []
-    for cert in p.findall(data.decode()):
-        stripped_data.append(cert.encode())
-    return stripped_data
+PEM_BEGIN = "-----BEGIN CERTIFICATE-----"
+PEM_END = "-----END CERTIFICATE-----"
 
 
-def extract_cert_and_chain(fullchain_pem):
-    pem_certificate = OpenSSL.crypto.dump_certificate(
-        OpenSSL.crypto.FILETYPE_PEM,
-        OpenSSL.crypto.load_certificate(
-            OpenSSL.crypto.FILETYPE_PEM, fullchain_pem
-        ),
-    ).decode()
+def iter_pem_certificates(text):
+    """
+    Yields every PEM certificate block of a text in one scan, without
+    parsing them. Blocks are normalized to end with a single newline.
+    """
+    start = text.find(PEM_BEGIN)
+    while start != -1:
+        end = text.find(PEM_END, start)
+        if end == -1:
+            raise ValueError("Unterminated PEM certificate")
+        end += len(PEM_END)
+        yield text[start:end].replace('\r\n', '\n') + '\n'
+        start = text.find(PEM_BEGIN, end)
+
+
+def _iter_der_certificates(data):
+    offset = 0
+    while offset < len(data):
+        if data[offset] != 0x30:
+            raise ValueError("Not a DER certificate at offset {}".format(offset))
+        if offset + 2 > len(data):
+            raise ValueError("Truncated DER header at offset {}".format(offset))
+        length = data[offset + 1]
+        header = 2
+        if length & 0x80:
+            size = length & 0x7f
+            if offset + 2 + size > len(data):
+                raise ValueError("Truncated DER length at offset {}".format(offset))
+            length = int.from_bytes(data[offset + 2:offset + 2 + size], 'big')
+            header += size
+        end = offset + header + length
+        if end > len(data):
+            raise ValueError("Truncated DER certificate at offset {}".format(offset))
+        yield data[offset:end]
+        offset = end
+
+
+def split_certificates(data):
+    """
+    Splits a PEM bundle, or concatenated DER certificates, into a list of
+    (pem, certificate) pairs in one pass. Every certificate is parsed once
+    and PEM input is kept as is instead of being exported again.
+    """
+    if isinstance(data, bytes):
+        if PEM_BEGIN.encode() not in data:
+            certificates = []
+            for der in _iter_der_certificates(data):
+                cert = load_der_certificate(der)
+                certificates.append((export_pem_certificate(cert).decode('ascii'), cert))
+            return certificates
+        data = data.decode('ascii')
+    return [(pem, load_pem_certificate(pem.encode('ascii')))
+            for pem in iter_pem_certificates(data)]
+
+
+def split_fullchain(fullchain):
+    """
+    Splits a full chain into its leaf and intermediates. Returns the
+    (pem, certificate) pair of the leaf and a list of pairs for the chain.
+    """
+    certificates = split_certificates(fullchain)
+    if not certificates:
+        raise ValueError("No certificate found")
+    leaf, chain = certificates[0], certificates[1:]
 
     if config.IDENTRUST_CROSS_SIGNED_LE_ICA \
             and datetime.datetime.now() < datetime.datetime.strptime(
             config.IDENTRUST_CROSS_SIGNED_LE_ICA_EXPIRATION_DATE, '%d/%m/%y'):
-        pem_certificate_chain = config.IDENTRUST_CROSS_SIGNED_LE_ICA
-    else:
-        pem_certificate_chain = fullchain_pem[len(pem_certificate):].lstrip()
+        chain = split_certificates(config.IDENTRUST_CROSS_SIGNED_LE_ICA)
+    return leaf, chain
+
+
+def pem_to_der(pem, label=None):
+    """
+    Decodes a single PEM block to DER without parsing its contents. The
+    block must carry the given label, or any label if none is given, and
+    no headers.
+    """
+    lines = pem.strip().splitlines()
+    if len(lines) < 3 or not lines[0].startswith("-----BEGIN ") \
+            or lines[-1] != "-----END " + lines[0][len("-----BEGIN "):]:
+        raise ValueError("Not a single PEM block")
+    if label is not None and lines[0] != "-----BEGIN {}-----".format(label):
+        raise ValueError("Not a PEM {}".format(label))
+    try:
+        return base64.b64decode(''.join(line.strip() for line in lines[1:-1]), validate=True)
+    except binascii.Error as e:
+        raise ValueError("Invalid PEM block: {}".format(e))
+
+
+def der_to_pem(der, label):
+    """
+    Encodes DER as a PEM block with 64 character lines, the way OpenSSL
+    writes it.
+    """
+    body = base64.b64encode(der).decode('ascii')
+    lines = [body[i:i + 64] for i in range(0, len(body), 64)]
+    return "-----BEGIN {0}-----\n{1}\n-----END {0}-----\n".format(label, '\n'.join(lines))
+
+
+def private_key_label(der):
+    """
+    Returns the PEM label of a DER private key from its structure: a
+    PKCS#8 key has an algorithm identifier where an OpenSSL RSA key has its
+    modulus and an OpenSSL EC key its private value.
+    """
+    offset = 2 + (der[1] & 0x7f if der[1] & 0x80 else 0)
+    # skip the version INTEGER
+    offset += 2 + der[offset + 1]
+    return {0x30: "PRIVATE KEY", 0x02: "RSA PRIVATE KEY",
+            0x04: "EC PRIVATE KEY"}.get(der[offset], "PRIVATE KEY")
+
+
+def strip_certificates(data):
+    return [pem.encode() for pem in iter_pem_certificates(data.decode())]
+
+
+def extract_cert_and_chain(fullchain_pem):
+    (pem_certificate, _), chain = split_fullchain(fullchain_pem)
+    return pem_certificate, ''.join(pem for pem, _ in chain)
 
-    return pem_certificate, pem_certificate_chain
 
 def load_cert_for_revoke(key_pem, is_x509_cert=True):
     if is_x509_cert:
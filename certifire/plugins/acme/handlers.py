@@ -1,12 +1,19 @@
-import binascii
 import datetime
 import json
+import random
+import threading
 import time
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import josepy as jose
+import OpenSSL
+import requests
 from certifire import config, database
 from certifire.plugins.acme import crypto
+from certifire.plugins.acme.cache import authorization_cache
+from certifire.plugins.acme.client import (get_acme_client,
+                                           invalidate_acme_client)
+from certifire.plugins.acme.keypool import get_key_pool
 from certifire.plugins.acme.models import Account, Certificate, Order
 from certifire.plugins.destinations.models import Destination
 from certifire.plugins.dns_providers.plugin import get_dns_provider
@@ -19,19 +26,46 @@ from acme.messages import Error as AcmeError
 from acme.messages import Order as acmeOrder
 from acme.messages import OrderResource, RegistrationResource
 
+_acme_pool = None
+_probe_pool = None
+_acme_pool_lock = threading.Lock()
+
+
+def get_acme_pool() -> ThreadPoolExecutor:
+    """
+    Shared pool for concurrent ACME requests (challenge answers, authorization
+    polls) of all orders in this process, bounded by ACME_CONCURRENCY.
+    """
+    global _acme_pool
+    with _acme_pool_lock:
+        if _acme_pool is None:
+            _acme_pool = ThreadPoolExecutor(max_workers=config.ACME_CONCURRENCY,
+                                            thread_name_prefix='certifire-acme')
+        return _acme_pool
+
+
+def get_probe_pool() -> ThreadPoolExecutor:
+    """
+    Shared pool for challenge probes of all orders in this process, bounded by
+    HTTP01_PROBE_CONCURRENCY. Probes wait on destinations, so they never
+    occupy the workers of the ACME pool.
+    """
+    global _probe_pool
+    with _acme_pool_lock:
+        if _probe_pool is None:
+            _probe_pool = ThreadPoolExecutor(max_workers=config.HTTP01_PROBE_CONCURRENCY,
+                                             thread_name_prefix='certifire-probe')
+        return _probe_pool
+
 
 class AcmeHandler:
     def __init__(self, account_id=None):
         if account_id:
             self.account = Account.query.get(account_id)
-
-            self.key = jose.JWKRSA(key=crypto.load_private_key(
-                self.account.key.encode("utf8")))
-
-            regr = RegistrationResource.from_json(json.loads(self.account.contents))
-            net = ClientNetwork(self.key, account=regr)
-            self.client = BackwardsCompatibleClientV2(
-                net, self.key, self.account.directory_uri)
+            # plain copy for the ACME pool threads, the ORM instance belongs
+            # to the session of this thread
+            self.account_uri = self.account.uri
+            self.key, self.client = get_acme_client(self.account)
         else:
             print("Setup ACME Account")
 
@@ -40,7 +74,8 @@ class AcmeHandler:
                            organizational_unit: str = None,
                            country: str = None,
                            state: str = None,
-                           location: str = None):
+                           location: str = None,
+                           key_type: str = None):
         if not email:
             email = config.CERTIFIRE_EMAIL
         if not server:
@@ -53,7 +88,8 @@ class AcmeHandler:
                           organizational_unit=organizational_unit,
                           country=country,
                           state=state,
-                          location=location)
+                          location=location,
+                          key_type=key_type)
         key = jose.JWKRSA(key=rsa_key)
         net = ClientNetwork(key, account=None, timeout=3600)
         client = BackwardsCompatibleClientV2(
@@ -68,6 +104,7 @@ class AcmeHandler:
 
         database.add(account)
         self.account = account
+        self.account_uri = registration.uri
         self.key = key
         self.client = client
         return account
@@ -76,6 +113,7 @@ class AcmeHandler:
         regr = RegistrationResource.from_json(json.loads(self.account.contents))
         updated_regr = self.client.deactivate_registration(regr)
         if updated_regr.body.status == 'deactivated':
+            invalidate_acme_client(self.account.id)
             return True
         return False
 
@@ -85,7 +123,9 @@ class AcmeHandler:
                      organizational_unit: str = None,
                      country: str = None,
                      state: str = None,
-                     location: str = None):
+                     location: str = None,
+                     key_type: str = None,
+                     key=None):
         csr_config = {
             "domains": domains,
             "owner": email if email else self.account.email,
@@ -96,7 +136,8 @@ class AcmeHandler:
             "location": location if location else self.account.location
         }
 
-        csr_pem, key = crypto.create_csr(csr_config)
+        key_type = key_type or self.account.key_type or config.DEFAULT_KEY_TYPE
+        csr_pem, key = crypto.create_csr(csr_config, key or get_key_pool(key_type).get())
         return csr_pem, key
     
     def get_pending_challenges(self, order, type):
@@ -118,33 +159,181 @@ class AcmeHandler:
         order_db = Order.query.get(order_id)
         order = acmeOrder.from_json(json.loads(order_db.contents)['body'])
         orderr = OrderResource.from_json(json.loads(order_db.contents))
-        authorizations = []
-        for url in order.authorizations:
-            authorizations.append(self.client._authzr_from_response(self.client._post_as_get(url), uri=url))
+        pool = get_acme_pool()
+        futures = [pool.submit(self.get_authorization, url) for url in order.authorizations]
+        return orderr.update(authorizations=[future.result() for future in futures])
+
+    def get_authorization(self, url):
+        authzr = authorization_cache.get(self.account_uri, url)
+        if authzr is None:
+            authzr = self.client._authzr_from_response(self.client._post_as_get(url), uri=url)
+            authorization_cache.put(self.account_uri, authzr)
+        return authzr
+
+    def verify_challenge(self, domain, challenge, response):
+        return response.simple_verify(
+            challenge.chall, domain, self.key.public_key())
+
+    def answer_challenge(self, domain, challenge, response=None):
+        if response is None:
+            response = challenge.response(self.key)
+
+        print("Ansering challenge {} with response {}".format(
+            challenge.validation(self.key), response.key_authorization))
+        res = self.client.answer_challenge(challenge, response)
+        print("Got response: {}".format(res.body.status.name))
+        return res
+
+    def answer_challenges(self, pending_challenges):
+        """
+        Verifies all pending challenges concurrently on the probe pool and
+        answers each one on the ACME pool as soon as its own probe is done,
+        so a slow domain never holds back the others.
+        """
+        responses = {domain: challenge.response(self.key)
+                     for domain, challenge in pending_challenges.items()}
+        probe_pool = get_probe_pool()
+        probes = {probe_pool.submit(self.verify_challenge, domain, challenge,
+                                    responses[domain]): domain
+                  for domain, challenge in pending_challenges.items()}
+
+        pool = get_acme_pool()
+        answers = {}
+        for probe in as_completed(probes):
+            domain = probes[probe]
+            if not probe.result():
+                print("{} not verified".format(domain))
+            answers[domain] = pool.submit(self.answer_challenge, domain,
+                                          pending_challenges[domain], responses[domain])
+        return [answers[domain].result() for domain in pending_challenges]
+
+    def next_poll(self, response, attempt):
+        """
+        Seconds to wait before polling again: the Retry-After of the CA when
+        it sent one, otherwise exponential backoff with full jitter.
+        """
+        if 'Retry-After' in response.headers:
+            next_poll = self.client.retry_after(response, config.ACME_POLL_INTERVAL)
+            return max((next_poll - datetime.datetime.now()).total_seconds(), 0)
+        backoff = min(config.ACME_POLL_INTERVAL * 2 ** attempt, config.ACME_POLL_MAX_INTERVAL)
+        return random.uniform(config.ACME_POLL_INTERVAL, max(backoff, config.ACME_POLL_INTERVAL))
+
+    def fetch_authorization(self, url):
+        """
+        Fetches one authorization, returns it with the response it came in.
+        """
+        response = self.client._post_as_get(url)
+        return response, self.client._authzr_from_response(response, uri=url)
+
+    def poll_authorizations(self, orderr, deadline):
+        """
+        Polls all authorizations of an order against a shared deadline, each
+        on its own schedule. The waits happen in the calling thread, only the
+        requests themselves run on the ACME pool.
+        """
+        pool = get_acme_pool()
+        urls = orderr.body.authorizations
+        done = {}
+        attempts = dict.fromkeys(urls, 0)
+        next_poll = dict.fromkeys(urls, time.monotonic())
+        last_poll = False
+        while True:
+            now = time.monotonic()
+            futures = {url: pool.submit(self.fetch_authorization, url)
+                       for url in urls if url not in done and next_poll[url] <= now}
+            for url, future in futures.items():
+                response, authzr = future.result()
+                if authzr.body.status != messages.STATUS_PENDING:
+                    authorization_cache.put(self.account_uri, authzr)
+                    done[url] = authzr
+                    continue
+                next_poll[url] = time.monotonic() + self.next_poll(response, attempts[url])
+                attempts[url] += 1
+
+            pending = [url for url in urls if url not in done]
+            if not pending:
+                break
+            remaining = (deadline - datetime.datetime.now()).total_seconds()
+            if last_poll or remaining <= 0:
+                raise TimeoutError()
+            wait = min(next_poll[url] for url in pending) - time.monotonic()
+            if wait >= remaining:
+                # a Retry-After beyond the deadline still gets one last poll
+                last_poll = True
+                wait = remaining
+                next_poll.update(dict.fromkeys(pending, 0))
+            time.sleep(max(wait, 0))
+
+        authorizations = [done[url] for url in urls]
+        failed = [authzr for authzr in authorizations
+                  if authzr.body.status != messages.STATUS_VALID]
+        if failed:
+            raise errors.ValidationError(failed)
         return orderr.update(authorizations=authorizations)
 
+    def finalize_deadline(self, orderr):
+        """
+        Time budget for validation and issuance, growing with the number of
+        authorizations and capped by FINALIZE_MAX_TIMEOUT.
+        """
+        timeout = config.FINALIZE_TIMEOUT + \
+            config.FINALIZE_TIMEOUT_PER_DOMAIN * len(orderr.body.authorizations)
+        timeout = min(timeout, config.FINALIZE_MAX_TIMEOUT)
+        return datetime.datetime.now() + datetime.timedelta(seconds=timeout)
+
+    def finalize_order(self, orderr, deadline):
+        """
+        Submits the CSR and polls the order until the certificate is issued.
+        Returns the final order and the seconds it spent processing.
+        """
+        csr = OpenSSL.crypto.load_certificate_request(
+            OpenSSL.crypto.FILETYPE_PEM, orderr.csr_pem)
+        response = self.client._post(orderr.body.finalize,
+                                     messages.CertificateRequest(csr=jose.ComparableX509(csr)))
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            body = messages.Order.from_json(response.json())
+            if body.status == messages.STATUS_INVALID:
+                if body.error is not None:
+                    raise errors.IssuanceError(body.error)
+                raise errors.Error("The certificate order failed. No further "
+                                   "information was provided by the server.")
+            if body.status == messages.STATUS_VALID and body.certificate is not None:
+                processing_time = time.monotonic() - started
+                certificate_response = self.client._post_as_get(body.certificate)
+                return orderr.update(body=body, fullchain_pem=certificate_response.text), \
+                    processing_time
+
+            remaining = (deadline - datetime.datetime.now()).total_seconds()
+            if remaining <= 0:
+                raise TimeoutError()
+            # a Retry-After beyond the deadline still gets one last poll
+            time.sleep(min(self.next_poll(response, attempt), remaining))
+            attempt += 1
+            response = self.client._post_as_get(orderr.uri)
+
+    def finalize(self, orderr, order_db=None):
+        deadline = self.finalize_deadline(orderr)
+        orderr = self.poll_authorizations(orderr, deadline)
+        final_order, processing_time = self.finalize_order(orderr, deadline)
+        print("Order processed in {:.1f}s".format(processing_time))
+        if order_db is not None:
+            order_db.processing_time = processing_time
+        return final_order
+
     def issue_certificate(self, final_order, order_id, destination_id=None):
         order_db = Order.query.get(order_id)
         cert_db = Certificate(user_id=order_db.user_id, order_id=order_db.id, status='pending',
                               csr=order_db.csr, private_key=order_db.key)
         database.add(cert_db)
 
-        pem_certificate, pem_chain = crypto.extract_cert_and_chain(
-            final_order.fullchain_pem)
-        certificate = crypto.load_pem_certificate(pem_certificate.encode())
-        chain = crypto.load_pem_certificate(pem_chain.encode())
-
-        cert_db.body = crypto.export_pem_certificate(
-            certificate).decode('UTF-8')
-        cert_db.chain = crypto.export_pem_certificate(
-            certificate).decode('UTF-8')
-        cert_db.chain += crypto.export_pem_certificate(chain).decode('UTF-8')
-        cert_db.intermediate = crypto.export_pem_certificate(
-            chain).decode('UTF-8')
+        (cert_db.body, certificate), chain = crypto.split_fullchain(final_order.fullchain_pem)
+        cert_db.set_intermediates(chain)
         cert_db.expiry = certificate.not_valid_after.strftime(
             config.EXPIRATION_FORMAT)
-        cert_db.fingerprint = binascii.hexlify(
-            certificate.fingerprint(crypto.hashes.SHA256())).decode('ascii')
+        cert_db.fingerprint = crypto.get_certificate_fingerprint(certificate)
+        cert_db.load_metadata(certificate)
 
         print("Expires: {}".format(cert_db.expiry))
         print("SHA256: {}".format(cert_db.fingerprint))
@@ -174,9 +363,12 @@ class AcmeHandler:
             print(status)
             return False, status
 
-        certificate = crypto.load_pem_certificate(cert_db.body.encode('ASCII'))
+        domains = cert_db.domains
+        if not domains:
+            certificate = crypto.load_pem_certificate(cert_db.body.encode('ASCII'))
+            domains = crypto.get_certificate_domains(certificate)
         print("Revoking certificate for:")
-        for domain in crypto.get_certificate_domains(certificate):
+        for domain in domains:
             print("     {}".format(domain))
         
         certificate = crypto.load_cert_for_revoke(cert_db.body.encode('ASCII'))
@@ -218,8 +410,7 @@ class AcmeDnsHandler(AcmeHandler):
 
         if not pending_challenges:
             if reissue:
-                deadline = datetime.datetime.now() + datetime.timedelta(seconds=10)
-                final_order = self.client.poll_and_finalize(order, deadline)
+                final_order = self.finalize(order, order_db)
                 order_db.contents = json.dumps(final_order.to_json())
                 order_db.status = 'ready'
                 database.add(order_db)
@@ -245,42 +436,37 @@ class AcmeDnsHandler(AcmeHandler):
 
         dns = get_dns_provider(provider)
 
-        change_ids = []
-        print("Writing DNS Records")
-        for domain, challenge in pending_challenges.items():
-            change_id = dns.create_dns_record(
-                domain, challenge.validation(self.key))
-            change_ids.append(change_id)
-
-        for change_id in change_ids:
-            print("Waiting for DNS Change: {}".format(change_id))
-            dns.wait_for_change(change_id)
+        records = [(domain, challenge.validation(self.key))
+                   for domain, challenge in pending_challenges.items()]
+        if dns.alias:
+            print("Validating through DNS alias {}, the domains need these CNAME records:".format(
+                dns.alias))
+            for domain, _ in records:
+                chal = {"ident_value": domain}
+                print("     {} CNAME {}".format(dns.cname_domain(chal), dns.target_domain(chal)))
+        try:
+            print("Writing DNS Records")
+            change_ids = dns.create_dns_records(records)
 
-        for domain, challenge in pending_challenges.items():
-            response = challenge.response(self.key)
-            verified = response.simple_verify(
-                challenge.chall, domain, self.key.public_key())
-            if not verified:
-                print("{} not verified".format(domain))
-            
-            res = self.client.answer_challenge(challenge, response)
-            #time.sleep(5)
-            print("Ansering challenge {} with response {}".format(
-                challenge.validation(self.key), response.key_authorization))
-            res = self.client.answer_challenge(challenge, response)
-            print("Got response: {}".format(res.body.status.name))
+            print("Waiting for DNS Changes: {}".format(', '.join(change_ids)))
+            dns.wait_for_changes(change_ids)
+            if config.DNS_PROPAGATION_CHECK:
+                print("Waiting for DNS Records on authoritative nameservers")
+                dns.wait_for_propagation(records)
 
-        print("Finalizing order")
-        deadline = datetime.datetime.now() + datetime.timedelta(seconds=10 *
-                                                                len(pending_challenges))
-        #final_order = self.client.finalize_order(order, deadline)
-        final_order = self.client.poll_and_finalize(order, deadline)
-        order_db.contents = json.dumps(final_order.to_json())
-        order_db.status = 'ready'
-        database.add(order_db)
+            self.answer_challenges(pending_challenges)
 
-        for domain, challenge in pending_challenges.items():
-            dns.delete_dns_record(domain, challenge.validation(self.key))
+            print("Finalizing order")
+            final_order = self.finalize(order, order_db)
+            order_db.contents = json.dumps(final_order.to_json())
+            order_db.status = 'ready'
+            database.add(order_db)
+        finally:
+            # the provider is shared by all orders, never leave values behind
+            try:
+                dns.delete_dns_records(records)
+            except Exception as e:
+                print("DNS Records not removed: {}".format(e))
 
         cert_id = self.issue_certificate(final_order, order_id, destination_id)
 
@@ -288,6 +474,35 @@ class AcmeDnsHandler(AcmeHandler):
 
 class AcmeHttpHandler(AcmeHandler):
 
+    def probe_token(self, domain, challenge, response):
+        """
+        Fetches the challenge URL once and checks that the destination serves
+        the expected key authorization.
+        """
+        uri = challenge.chall.uri(domain)
+        try:
+            http_response = requests.get(uri, timeout=config.HTTP01_PROBE_REQUEST_TIMEOUT,
+                                         verify=False)
+        except requests.exceptions.RequestException as e:
+            print("Unable to reach {}: {}".format(uri, e))
+            return False
+        served = http_response.text.rstrip(challenges.HTTP01Response.WHITESPACE_CUTSET)
+        return http_response.ok and served == response.key_authorization
+
+    def verify_challenge(self, domain, challenge, response):
+        """
+        Waits until the token is actually served, probing with exponential
+        backoff, so that the challenge is answered as soon as it can pass.
+        """
+        deadline = time.monotonic() + config.HTTP01_PROBE_TIMEOUT
+        delay = 0.25
+        while not self.probe_token(domain, challenge, response):
+            if time.monotonic() + delay > deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+        return True
+
     def create_order(self, csr_pem, provider, order_id, destination_id, reissue=False):
         order_db = Order.query.get(order_id)
         destination_db = Destination.query.get(destination_id)
@@ -304,8 +519,7 @@ class AcmeHttpHandler(AcmeHandler):
         
         if not pending_challenges:
             if reissue:
-                deadline = datetime.datetime.now() + datetime.timedelta(seconds=10)
-                final_order = self.client.poll_and_finalize(order, deadline)
+                final_order = self.finalize(order, order_db)
                 order_db.contents = json.dumps(final_order.to_json())
                 order_db.status = 'ready'
                 database.add(order_db)
@@ -335,27 +549,12 @@ class AcmeHttpHandler(AcmeHandler):
             chall_path = challenge.chall.path
             response, validation = challenge.response_and_validation(self.key)
             destination_db.upload_acme_token(chall_path,validation)
-        time.sleep(5)
 
-        for domain, challenge in pending_challenges.items():
-            response = challenge.response(self.key)
-            verified = response.simple_verify(
-                challenge.chall, domain, self.key.public_key())
-            if not verified:
-                print("{} not verified".format(domain))
-            
-            #res = self.client.answer_challenge(challenge, response)
-            time.sleep(5)
-            print("Ansering challenge {} with response {}".format(
-                challenge.validation(self.key), response.key_authorization))
-            res = self.client.answer_challenge(challenge, response)
-            print("Got response: {}".format(res.body.status.name))
+        # each challenge is answered as soon as its own token is served
+        self.answer_challenges(pending_challenges)
 
         print("Finalizing order")
-        deadline = datetime.datetime.now() + datetime.timedelta(seconds=10 *
-                                                                len(pending_challenges))
-        #final_order = self.client.finalize_order(order, deadline)
-        final_order = self.client.poll_and_finalize(order, deadline)
+        final_order = self.finalize(order, order_db)
         order_db.contents = json.dumps(final_order.to_json())
         order_db.status = 'ready'
         database.add(order_db)
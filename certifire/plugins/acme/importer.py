@@ -0,0 +1,255 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from certifire import config, database, db
+from certifire.plugins.acme import crypto
+from certifire.plugins.acme.models import Certificate, Intermediate
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.serialization import (Encoding,
+                                                          PublicFormat)
+
+logger = logging.getLogger(__name__)
+
+KEY_BEGIN = "-----BEGIN "
+
+
+def iter_import_files(paths):
+    """
+    Yields every file of the given files and directories, walking
+    directories recursively in a stable order.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def _iter_pem_private_keys(text):
+    start = text.find(KEY_BEGIN)
+    while start != -1:
+        label_end = text.find("-----", start + len(KEY_BEGIN))
+        if label_end == -1:
+            return
+        label = text[start + len(KEY_BEGIN):label_end]
+        if not label.endswith("PRIVATE KEY"):
+            start = text.find(KEY_BEGIN, label_end)
+            continue
+        footer = "-----END " + label + "-----"
+        end = text.find(footer, label_end)
+        if end == -1:
+            raise ValueError("Unterminated PEM private key")
+        end += len(footer)
+        yield text[start:end].replace('\r\n', '\n') + '\n'
+        start = text.find(KEY_BEGIN, end)
+
+
+def _public_key_digest(public_key):
+    return hashlib.sha256(public_key.public_bytes(
+        Encoding.DER, PublicFormat.SubjectPublicKeyInfo)).hexdigest()
+
+
+def _is_ca(cert):
+    try:
+        return cert.extensions.get_extension_for_class(x509.BasicConstraints).value.ca
+    except x509.ExtensionNotFound:
+        return False
+
+
+def _key_identifiers(cert):
+    try:
+        key_id = cert.extensions.get_extension_for_class(x509.SubjectKeyIdentifier).value.digest
+    except x509.ExtensionNotFound:
+        key_id = x509.SubjectKeyIdentifier.from_public_key(cert.public_key()).digest
+    try:
+        authority_key_id = cert.extensions.get_extension_for_class(
+            x509.AuthorityKeyIdentifier).value.key_identifier
+    except x509.ExtensionNotFound:
+        authority_key_id = None
+    return key_id.hex(), authority_key_id.hex() if authority_key_id else None
+
+
+def parse_bundle(source, data=None):
+    """
+    Parses one PEM bundle or DER certificate, read from the file source
+    unless its data is given. Runs in the import worker processes, so it
+    only returns plain values: every certificate with its metadata and the
+    digest of its public key, and every private key with the same digest.
+    """
+    result = {'source': source, 'certificates': [], 'keys': [], 'errors': []}
+    try:
+        if data is None:
+            with open(source, 'rb') as f:
+                data = f.read()
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        if KEY_BEGIN.encode() in data:
+            text = data.decode('ascii')
+            certificates = crypto.split_certificates(text)
+            keys = list(_iter_pem_private_keys(text))
+        else:
+            certificates = crypto.split_certificates(data)
+            keys = []
+    except (OSError, ValueError, UnicodeDecodeError) as e:
+        result['errors'].append("{}: {}".format(source, e))
+        return result
+
+    for pem, cert in certificates:
+        key_id, authority_key_id = _key_identifiers(cert)
+        result['certificates'].append({
+            'body': pem,
+            'fingerprint': crypto.get_certificate_fingerprint(cert),
+            'public_key': _public_key_digest(cert.public_key()),
+            'subject': cert.subject.rfc4514_string(),
+            'key_id': key_id,
+            'authority_key_id': authority_key_id,
+            'ca': _is_ca(cert),
+            'metadata': crypto.get_certificate_metadata(cert),
+        })
+    for pem in keys:
+        try:
+            key = crypto.load_private_key(pem.encode('ascii'))
+        except (TypeError, ValueError) as e:
+            result['errors'].append("{}: {}".format(source, e))
+            continue
+        result['keys'].append({'body': pem, 'public_key': _public_key_digest(key.public_key())})
+    if not result['certificates'] and not result['keys'] and not result['errors']:
+        result['errors'].append("{}: no certificate or private key found".format(source))
+    return result
+
+
+def _parse_all(items, workers):
+    if not workers:
+        for source, data in items:
+            yield parse_bundle(source, data)
+        return
+    # spawned, forking a process with running threads is unsafe
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        sources, bodies = zip(*items) if items else ((), ())
+        yield from executor.map(parse_bundle, sources, bodies, chunksize=config.IMPORT_CHUNK_SIZE)
+
+
+def _find_issuer(cert, authorities):
+    """
+    Finds the issuer of cert among the CA certificates with its issuer name.
+    Cross-signed and rekeyed intermediates share a subject, so candidates
+    are told apart by the authority key identifier, or by checking the
+    signature when cert has none.
+    """
+    candidates = authorities.get(cert['metadata']['issuer'], {})
+    if cert['authority_key_id']:
+        return candidates.get(cert['authority_key_id'])
+    if len(candidates) <= 1:
+        return next(iter(candidates.values()), None)
+    child = crypto.load_pem_certificate(cert['body'].encode('ascii'))
+    for candidate in candidates.values():
+        try:
+            child.verify_directly_issued_by(
+                crypto.load_pem_certificate(candidate['body'].encode('ascii')))
+        except (ValueError, TypeError, InvalidSignature):
+            continue
+        return candidate
+    return None
+
+
+def _build_chain(leaf, authorities):
+    chain = []
+    authority = _find_issuer(leaf, authorities)
+    while authority is not None and len(chain) < 10:
+        # roots are not part of the chain a server sends
+        if authority['subject'] == authority['metadata']['issuer'] or authority in chain:
+            break
+        chain.append(authority)
+        authority = _find_issuer(authority, authorities)
+    return chain
+
+
+def import_certificates(user_id: int, paths: list = None, bundles: list = None,
+                        workers: int = None, batch_size: int = None):
+    """
+    Imports certificates issued elsewhere from files and directories, or
+    from PEM bundles given as strings. Bundles are parsed in a process pool,
+    private keys are matched to certificates across bundles by public key,
+    chains are rebuilt from the CA certificates found and the certificates
+    are inserted in batches with their metadata. Certificates already stored
+    for the user are skipped. Returns a summary of the import.
+    """
+    workers = config.IMPORT_WORKERS if workers is None else workers
+    batch_size = batch_size or config.IMPORT_BATCH_SIZE
+    items = [(path, None) for path in iter_import_files(paths or [])]
+    items += [('bundle {}'.format(i), bundle) for i, bundle in enumerate(bundles or [])]
+
+    leaves = {}
+    authorities = {}
+    keys = {}
+    errors = []
+    for result in _parse_all(items, workers if len(items) > 1 else 0):
+        errors.extend(result['errors'])
+        for cert in result['certificates']:
+            if cert['ca']:
+                authorities.setdefault(cert['subject'], {}).setdefault(cert['key_id'], cert)
+            else:
+                leaves.setdefault(cert['fingerprint'], cert)
+        for key in result['keys']:
+            keys.setdefault(key['public_key'], key['body'])
+
+    existing = set()
+    fingerprints = list(leaves)
+    for i in range(0, len(fingerprints), batch_size):
+        existing.update(fingerprint for fingerprint, in db.session.query(Certificate.fingerprint).filter(
+            Certificate.user_id == user_id, Certificate.fingerprint.in_(fingerprints[i:i + batch_size])))
+    stored = set()
+    rows = []
+    now = datetime.utcnow()
+    summary = {'files': len(items), 'imported': 0, 'duplicates': len(existing),
+               'without_key': 0, 'errors': errors}
+    for fingerprint, leaf in leaves.items():
+        if fingerprint in existing:
+            continue
+        chain = _build_chain(leaf, authorities)
+        for authority in chain:
+            if authority['fingerprint'] not in stored:
+                stored.add(Intermediate.store(authority['body']))
+        metadata = leaf['metadata']
+        private_key = keys.get(leaf['public_key'])
+        if private_key is None:
+            summary['without_key'] += 1
+        rows.append({
+            'user_id': user_id,
+            **Certificate.body.columns(leaf['body']),
+            **Certificate.private_key.columns(private_key),
+            'intermediate_fingerprints': ','.join(a['fingerprint'] for a in chain) or None,
+            'fingerprint': fingerprint,
+            'expiry': metadata['not_after'].strftime(config.EXPIRATION_FORMAT),
+            'status': 'valid' if metadata['not_after'] > now else 'expired',
+            'serial': metadata['serial'],
+            'issuer': metadata['issuer'],
+            'not_before': metadata['not_before'],
+            'not_after': metadata['not_after'],
+            'key_type': metadata['key_type'],
+            'san': ','.join(metadata['san']),
+        })
+        if len(rows) >= batch_size:
+            summary['imported'] += _insert(rows)
+            rows = []
+    if rows:
+        summary['imported'] += _insert(rows)
+    database.commit()
+    logger.info("{imported} certificates imported, {duplicates} already stored, "
+                "{without_key} without a private key".format(**summary))
+    return summary
+
+
+def _insert(rows):
+    db.session.bulk_insert_mappings(Certificate, rows)
+    database.commit()
+    return len(rows)
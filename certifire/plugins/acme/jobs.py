@@ -0,0 +1,344 @@
+import atexit
+import os
+import threading
+from datetime import datetime, timedelta
+
+from certifire import config, database, db
+from certifire.errors import BacklogFull
+from certifire.plugins.acme.handlers import AcmeDnsHandler, AcmeHttpHandler
+from certifire.plugins.acme.keypool import get_key_pool
+from certifire.plugins.acme.models import Job, Order
+from certifire.plugins.destinations.models import Destination
+from certifire.plugins.dns_providers.plugin import get_dns_provider
+from certifire.thread import AppContextExecutor
+from sqlalchemy import func, select
+
+ACTIVE_STATES = ('queued', 'running')
+
+_issuance_pool = None
+_issuance_pool_pid = None
+_issuance_pool_lock = threading.Lock()
+
+
+def get_issuance_pool() -> AppContextExecutor:
+    """
+    Returns the issuance worker pool of this process, creating it on first use.
+    A forked child never reuses the pool (and threads) of its parent. Once shut
+    down, the closed pool is returned and no new one is created.
+    """
+    global _issuance_pool, _issuance_pool_pid
+    with _issuance_pool_lock:
+        if _issuance_pool is None or _issuance_pool_pid != os.getpid():
+            _issuance_pool = AppContextExecutor(config.ISSUANCE_WORKERS,
+                                                config.ISSUANCE_BACKLOG,
+                                                thread_name_prefix='certifire-issuance')
+            _issuance_pool_pid = os.getpid()
+        return _issuance_pool
+
+
+@atexit.register
+def shutdown_issuance_pool(wait=True):
+    """
+    Stops accepting new orders and waits for the running ones to finish. The
+    closed pool stays in place, so jobs finishing meanwhile do not dispatch
+    more work to a new one.
+    """
+    with _issuance_pool_lock:
+        pool = _issuance_pool
+    if pool is not None and _issuance_pool_pid == os.getpid():
+        pool.shutdown(wait=wait)
+
+
+def get_handler(order_type, account_id):
+    if order_type == 'sftp':
+        return AcmeHttpHandler(account_id)
+    return AcmeDnsHandler(account_id)
+
+
+def enqueue(order_id: int, reissue: bool = False, dispatch_now: bool = True):
+    """
+    Persists an issuance job for the order, unless one is already waiting or
+    running, and hands it to the worker pool if there is room.
+    """
+    job = Job.query.filter(Job.order_id == order_id,
+                           Job.status.in_(ACTIVE_STATES)).first()
+    if job:
+        print("Order {} already has {} job {}".format(order_id, job.status, job.id))
+        if reissue and job.status == 'queued' and not job.reissue:
+            job.reissue = True
+            database.add(job)
+        return job
+
+    job = Job(order_id, reissue)
+    database.add(job)
+    # with standalone workers the API only records the job
+    if dispatch_now and config.ISSUANCE_EMBEDDED_WORKER:
+        dispatch()
+    return job
+
+
+def enqueue_many(orders, dispatch_now: bool = True):
+    """
+    Bulk version of enqueue. Takes (order_id, reissue) pairs, looks up the
+    existing active jobs with one query and commits all new jobs, together
+    with anything else pending in the session, in a single transaction.
+    """
+    reissues = {}
+    for order_id, reissue in orders:
+        reissues[order_id] = reissues.get(order_id, False) or reissue
+    active = {}
+    if reissues:
+        active = {job.order_id: job for job in Job.query.filter(
+            Job.order_id.in_(list(reissues)), Job.status.in_(ACTIVE_STATES))}
+
+    jobs = []
+    for order_id, reissue in reissues.items():
+        job = active.get(order_id)
+        if job is None:
+            job = Job(order_id, reissue)
+            db.session.add(job)
+        elif reissue and job.status == 'queued':
+            job.reissue = True
+        jobs.append(job)
+    database.commit()
+
+    if dispatch_now and config.ISSUANCE_EMBEDDED_WORKER:
+        dispatch()
+    return jobs
+
+
+def claim(job_id: int, worker: str = None) -> bool:
+    """
+    Atomically moves a queued job to running. Only one caller can win.
+    """
+    claimed = Job.query.filter(Job.id == job_id, Job.status == 'queued').update({
+        Job.status: 'running',
+        Job.worker: worker or config.ISSUANCE_WORKER_NAME,
+        Job.attempts: Job.attempts + 1,
+        Job.started_at: datetime.utcnow(),
+        Job.finished_at: None,
+    }, synchronize_session=False)
+    database.commit()
+    return claimed == 1
+
+
+def _lock_order_hash(order_hash) -> bool:
+    """
+    Takes a transaction scoped advisory lock on an order hash so that two
+    workers never start the same certificate at the same time. Databases
+    without advisory locks serialize writers anyway.
+    """
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return True
+    return db.session.execute(
+        select([func.pg_try_advisory_xact_lock(func.hashtext(order_hash))])).scalar()
+
+
+def claim_next(limit: int, worker: str = None):
+    """
+    Claims up to limit runnable jobs and returns their ids.
+
+    Rows are selected with SELECT ... FOR UPDATE SKIP LOCKED so any number of
+    workers can poll the same table concurrently, and a job is skipped while
+    another job for an order with the same hash is running.
+    """
+    if limit <= 0:
+        return []
+    worker = worker or config.ISSUANCE_WORKER_NAME
+
+    running_hashes = db.session.query(Order.hash).join(
+        Job, Job.order_id == Order.id).filter(Job.status == 'running')
+    candidates = db.session.query(Job, Order.hash).join(
+        Order, Job.order_id == Order.id
+    ).filter(
+        Job.status == 'queued',
+        Job.run_after <= datetime.utcnow(),
+        ~Order.hash.in_(running_hashes.subquery())
+    ).order_by(Job.id).limit(limit).with_for_update(skip_locked=True, of=Job).all()
+
+    claimed = []
+    seen_hashes = set()
+    for job, order_hash in candidates:
+        if order_hash in seen_hashes or not _lock_order_hash(order_hash):
+            continue
+        # re-check now that the hash is locked, a concurrent claim may have won
+        if running_hashes.filter(Order.hash == order_hash).first():
+            continue
+        seen_hashes.add(order_hash)
+        job.status = 'running'
+        job.worker = worker
+        job.attempts = (job.attempts or 0) + 1
+        job.started_at = datetime.utcnow()
+        job.finished_at = None
+        claimed.append(job.id)
+    database.commit()
+    return claimed
+
+
+def dispatch(worker: str = None):
+    """
+    Claims as many jobs as the worker pool has idle workers for and submits
+    them. Returns the number of jobs submitted.
+    """
+    pool = get_issuance_pool()
+    if pool.closed:
+        return 0
+    job_ids = claim_next(pool.idle_workers, worker)
+    for i, job_id in enumerate(job_ids):
+        try:
+            pool.submit(run_job, job_id)
+        except (BacklogFull, RuntimeError) as e:
+            # a concurrent dispatcher took the slots, or the pool shut down
+            print("Returning {} jobs to the queue: {}".format(len(job_ids) - i, e))
+            unclaim(job_ids[i:])
+            return i
+    return len(job_ids)
+
+
+def unclaim(job_ids):
+    """
+    Puts claimed jobs that never started back in the queue, as if they had
+    not been claimed.
+    """
+    Job.query.filter(Job.id.in_(job_ids), Job.status == 'running').update({
+        Job.status: 'queued',
+        Job.attempts: Job.attempts - 1,
+        Job.started_at: None,
+    }, synchronize_session=False)
+    database.commit()
+
+
+def run_job(job_id: int):
+    job = Job.query.get(job_id)
+    order = Order.query.get(job.order_id)
+    print("Running job {} (attempt {}) for order {}".format(job.id, job.attempts, order.id))
+
+    try:
+        acme = get_handler(order.type, order.account_id)
+        if job.attempts > 1:
+            clear_stale_challenges(acme, order)
+        acme.create_order(order.csr, order.provider, order.id,
+                          order.destination_id, job.reissue)
+    except Exception as e:
+        db.session.rollback()
+        job = Job.query.get(job_id)
+        job.error = "{}: {}".format(e.__class__.__name__, e)
+        job.finished_at = datetime.utcnow()
+        # back off before the next attempt, the CA or DNS may need a moment
+        job.run_after = job.finished_at + timedelta(seconds=60 * job.attempts)
+        job.status = 'queued' if job.attempts < config.ISSUANCE_MAX_ATTEMPTS else 'failed'
+        database.add(job)
+        print("Job {} failed, {}".format(job.id, job.status))
+        raise
+    else:
+        job.status = 'done'
+        job.error = None
+        job.finished_at = datetime.utcnow()
+        database.add(job)
+    finally:
+        # pull in the next waiting job without waiting for the poller
+        dispatch(job.worker)
+
+
+def clear_stale_challenges(acme, order):
+    """
+    Best effort removal of challenge records left behind by an interrupted
+    attempt, so a resumed order does not leave orphaned TXT records or tokens.
+    """
+    if not order.contents:
+        return
+    try:
+        orderr = acme.get_orderResource(order.id)
+    except Exception as e:
+        print("Could not fetch previous authorizations for order {}: {}".format(order.id, e))
+        return
+
+    if order.type == 'sftp':
+        challenges = acme.get_pending_challenges(orderr, 'http-01')
+        destination = Destination.query.get(order.destination_id)
+        for domain, challenge in challenges.items():
+            destination.delete_acme_token(challenge.chall.path)
+    else:
+        challenges = acme.get_pending_challenges(orderr, 'dns-01')
+        records = [(domain, challenge.validation(acme.key))
+                   for domain, challenge in challenges.items()]
+        if not records:
+            return
+        dns = get_dns_provider(order.provider)
+        try:
+            dns.delete_dns_records(records)
+            return
+        except Exception as e:
+            # some records may already be gone, remove the others one by one
+            print("Stale records of order {} not removed together: {}".format(order.id, e))
+        for domain, value in records:
+            try:
+                dns.delete_dns_record(domain, value)
+            except Exception as e:
+                print("Stale record for {} not removed: {}".format(domain, e))
+
+
+def resume(worker: str = None):
+    """
+    Requeues jobs left running by a previous run of this worker, or whose
+    lease has expired, then dispatches the backlog. Called on startup.
+    """
+    worker = worker or config.ISSUANCE_WORKER_NAME
+    lease_expiry = datetime.utcnow() - timedelta(seconds=config.ISSUANCE_JOB_TIMEOUT)
+    resumed = Job.query.filter(
+        Job.status == 'running',
+        db.or_(Job.worker == worker, Job.started_at < lease_expiry)
+    ).update({Job.status: 'queued', Job.run_after: datetime.utcnow()},
+             synchronize_session=False)
+    database.commit()
+    if resumed:
+        print("Resuming {} interrupted issuance jobs".format(resumed))
+    return dispatch(worker)
+
+
+def backlog():
+    """
+    Number of jobs per state, as seen in the database.
+    """
+    counts = dict(db.session.query(Job.status, func.count(Job.id)).group_by(Job.status))
+    return {state: counts.get(state, 0) for state in ('queued', 'running', 'done', 'failed')}
+
+
+class JobDispatcher(threading.Thread):
+    """
+    Background thread that periodically resubmits queued jobs to the worker
+    pool, picking up anything that did not fit when it was enqueued.
+    """
+
+    def __init__(self, app, interval=None, worker=None):
+        super().__init__(name='certifire-dispatcher', daemon=True)
+        self.app = app
+        self.interval = interval or config.ISSUANCE_POLL_INTERVAL
+        self.worker = worker or config.ISSUANCE_WORKER_NAME
+        self._stop_event = threading.Event()
+
+    def run(self):
+        get_key_pool().refill()
+        with self.app.app_context():
+            resume(self.worker)
+        while not self._stop_event.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    dispatch(self.worker)
+                except Exception as e:
+                    print("Dispatch failed: {}".format(e))
+                    db.session.rollback()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_dispatcher = None
+
+
+def start_dispatcher(app, interval=None, worker=None):
+    global _dispatcher
+    if _dispatcher is None or not _dispatcher.is_alive():
+        _dispatcher = JobDispatcher(app, interval, worker)
+        _dispatcher.start()
+    return _dispatcher
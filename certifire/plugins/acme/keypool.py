@@ -0,0 +1,139 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from certifire import config
+from certifire.plugins.acme import crypto
+
+logger = logging.getLogger(__name__)
+
+_key_pools = {}
+_key_pools_pid = None
+_key_pools_lock = threading.Lock()
+
+
+def _generate_key_pem(key_type):
+    return crypto.export_private_key(crypto.generate_private_key(key_type))
+
+
+class KeyPool:
+    """
+    Certificate private keys of one type generated ahead of time in worker
+    processes. The pool is topped up to its watermark in the background
+    whenever a key is taken, so creating a CSR does not wait for key
+    generation during bursts. With a watermark of 0 keys are generated inline.
+    """
+
+    def __init__(self, key_type=None, watermark=None, workers=None):
+        self.key_type = key_type or config.DEFAULT_KEY_TYPE
+        self.watermark = config.KEY_POOL_SIZE if watermark is None else watermark
+        self.workers = workers or config.KEY_POOL_WORKERS
+        self.hits = 0
+        self.misses = 0
+        self._keys = deque()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawned, forking a process with running threads is unsafe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def refill(self):
+        """
+        Starts generating keys until the pool holds watermark keys.
+        """
+        with self._lock:
+            missing = self.watermark - len(self._keys) - self._pending
+            if missing <= 0:
+                return
+            self._pending += missing
+        executor = self._get_executor()
+        for _ in range(missing):
+            executor.submit(_generate_key_pem, self.key_type).add_done_callback(self._collect)
+
+    def _collect(self, future):
+        with self._lock:
+            self._pending -= 1
+        try:
+            pem = future.result()
+        except Exception as e:
+            logger.warning("Key generation failed: {}".format(e))
+            return
+        with self._lock:
+            self._keys.append(pem)
+
+    def get(self):
+        """
+        Takes a private key from the pool, generating one if it is empty.
+        """
+        with self._lock:
+            pem = self._keys.popleft() if self._keys else None
+            if pem is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if not self.watermark:
+            return crypto.generate_private_key(self.key_type)
+
+        if pem is None:
+            # queued ahead of the refill, so the caller does not wait behind it
+            future = self._get_executor().submit(_generate_key_pem, self.key_type)
+            self.refill()
+            pem = future.result()
+        else:
+            self.refill()
+        return crypto.load_private_key(pem)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    @property
+    def stats(self):
+        return {'size': len(self._keys), 'pending': self._pending,
+                'watermark': self.watermark, 'hits': self.hits, 'misses': self.misses}
+
+
+def get_key_pool(key_type: str = None) -> KeyPool:
+    """
+    Returns the key pool of this process for a key type, creating it on
+    first use. Only RSA keys are pooled, EC keys take microseconds to make.
+    """
+    global _key_pools, _key_pools_pid
+    key_type = key_type or config.DEFAULT_KEY_TYPE
+    if key_type not in crypto.KEY_TYPES:
+        raise ValueError("Unsupported key type {}".format(key_type))
+    with _key_pools_lock:
+        if _key_pools_pid != os.getpid():
+            _key_pools, _key_pools_pid = {}, os.getpid()
+        pool = _key_pools.get(key_type)
+        if pool is None:
+            watermark = None if key_type.startswith('RSA') else 0
+            pool = _key_pools[key_type] = KeyPool(key_type, watermark)
+        return pool
+
+
+def key_pool_stats():
+    with _key_pools_lock:
+        return {key_type: pool.stats for key_type, pool in _key_pools.items()}
+
+
+@atexit.register
+def shutdown_key_pools(wait=False):
+    global _key_pools
+    with _key_pools_lock:
+        pools, _key_pools = _key_pools, {}
+    if _key_pools_pid == os.getpid():
+        for pool in pools.values():
+            pool.shutdown(wait=wait)
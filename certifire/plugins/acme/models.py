@@ -1,11 +1,15 @@
 import json
+import threading
 from datetime import datetime
 from urllib.parse import urljoin
 
 import josepy as jose
 from certifire import config, db, users
 from certifire.plugins.acme import crypto
-from sqlalchemy import Column, ForeignKey, Integer, String, Text
+from certifire.plugins.acme.cache import get_account_key
+from sqlalchemy import (Boolean, Column, DateTime, Float, ForeignKey, Integer,
+                        LargeBinary, String, Text, or_)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship
 
 
@@ -26,6 +30,9 @@ class Account(db.Model):
     state = Column(Text())
     location = Column(Text())
 
+    # default key type for the certificates of this account
+    key_type = Column(String(16))
+
     order_account = relationship("Order", foreign_keys="Order.account_id")
 
     def __init__(self, user_id, email, server=None, key=None, uri=None, 
@@ -33,7 +40,8 @@ class Account(db.Model):
                     organizational_unit: str = config.CERTIFIRE_ORGANIZATIONAL_UNIT,
                     country: str = config.CERTIFIRE_COUNTRY,
                     state: str = config.CERTIFIRE_STATE,
-                    location: str = config.CERTIFIRE_LOCATION):
+                    location: str = config.CERTIFIRE_LOCATION,
+                    key_type: str = None):
         self.email = email
         self.server = server if server else config.LETS_ENCRYPT_PRODUCTION
         self.directory_uri = urljoin(self.server, 'directory')
@@ -45,11 +53,11 @@ class Account(db.Model):
         self.country = country
         self.state = state
         self.location = location
+        self.key_type = key_type
 
     @property
     def thumbprint(self):
-        return crypto.generate_jwk_thumbprint(crypto.load_private_key(
-            self.key.encode("utf8")))
+        return get_account_key(self).thumbprint
     
     @property
     def json(self):
@@ -65,6 +73,7 @@ class Account(db.Model):
             'country': self.country,
             'state': self.state,
             'location': self.location,
+            'key_type': self.key_type,
             'user_id': self.user_id
         }).encode("utf-8")
 
@@ -92,11 +101,16 @@ class Order(db.Model):
 
     csr = Column(Text())
     key = Column(Text())
+    key_type = Column(String(16))
+
+    # seconds the CA spent in the processing state on the last finalization
+    processing_time = Column(Float)
 
     certificate_order = relationship("Certificate", foreign_keys="Certificate.order_id")
 
     def __init__(self, destination_id:int, domains: list, type, provider, account_id, user_id=1, hash=None, csr=None, key=None, 
-                email=None, organization=None, organizational_unit=None, country=None, state=None, location=None):
+                email=None, organization=None, organizational_unit=None, country=None, state=None, location=None,
+                key_type=None):
         self.destination_id = destination_id
         self.domains = ','.join(domains)
         self.type = type
@@ -107,6 +121,7 @@ class Order(db.Model):
         self.status = 'Pending'
         self.csr = csr
         self.key = key
+        self.key_type = key_type
 
         self.email = email
         self.organization = organization
@@ -138,11 +153,13 @@ class Order(db.Model):
             'provider': self.provider,
             'key': self.key,
             'csr': self.csr,
+            'key_type': self.key_type,
             'domains': self.domains.split(','),
             'account_id': self.account_id,
             'user_id': self.user_id,
             'status': self.status,
             'resolved_cert_id': self.resolved_cert_id,
+            'processing_time': self.processing_time,
             'organization': self.organization,
             'organizational_unit': self.organizational_unit,
             'country': self.country,
@@ -150,23 +167,207 @@ class Order(db.Model):
             'location': self.location
         }).encode("utf-8")
 
+class CompactPem:
+    """
+    PEM attribute kept in a text column, or as DER in a binary column when
+    COMPACT_STORAGE is on. PEM is rendered from DER on first read and kept
+    on the instance. Values that are not a single plain PEM block are always
+    kept as text. Rows written in either mode are read in both.
+    """
+
+    def __init__(self, text, der, label=None):
+        self.text = text
+        self.der = der
+        self.label = label
+
+    def __set_name__(self, owner, name):
+        self.owner = owner
+        self.cache = '_{}_pem'.format(name)
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        text = getattr(obj, self.text)
+        if text is not None:
+            return text
+        der = getattr(obj, self.der)
+        if der is None:
+            return None
+        cached = obj.__dict__.get(self.cache)
+        if cached is None or cached[0] is not der:
+            label = self.label or crypto.private_key_label(der)
+            cached = obj.__dict__[self.cache] = (der, crypto.der_to_pem(der, label))
+        return cached[1]
+
+    def __set__(self, obj, value):
+        for column, stored in self.columns(value).items():
+            setattr(obj, column, stored)
+
+    def columns(self, value) -> dict:
+        """
+        Returns the column values storing value, for bulk inserts.
+        """
+        if value is not None and config.COMPACT_STORAGE:
+            try:
+                return {self.text: None, self.der: crypto.pem_to_der(value, self.label)}
+            except ValueError:
+                pass
+        return {self.text: value, self.der: None}
+
+    def isnot_none(self):
+        """
+        Returns a filter for rows where this attribute is set.
+        """
+        return or_(getattr(self.owner, self.text).isnot(None),
+                   getattr(self.owner, self.der).isnot(None))
+
+    def convertible(self):
+        """
+        Returns a filter for rows where this attribute is not stored the
+        way COMPACT_STORAGE asks for.
+        """
+        column = self.text if config.COMPACT_STORAGE else self.der
+        return getattr(self.owner, column).isnot(None)
+
+
+_intermediate_bodies = {}
+_intermediate_bodies_lock = threading.Lock()
+
+
+class Intermediate(db.Model):
+    """
+    Intermediate CA certificate, stored once and referenced by its SHA256
+    fingerprint from every certificate it issued.
+    """
+    __tablename__ = "intermediates"
+    fingerprint = Column(String(64), primary_key=True)
+    _body = Column('body', Text())
+    body_der = Column(LargeBinary())
+    body = CompactPem('_body', 'body_der', 'CERTIFICATE')
+    subject = Column(Text())
+    not_after = Column(DateTime())
+
+    def __init__(self, body, certificate=None):
+        if certificate is None:
+            certificate = crypto.load_pem_certificate(body.encode('ASCII'))
+        self.fingerprint = crypto.get_certificate_fingerprint(certificate)
+        self.body = body
+        self.subject = certificate.subject.rfc4514_string()
+        self.not_after = certificate.not_valid_after
+
+    @classmethod
+    def store(cls, body, certificate=None) -> str:
+        """
+        Stores an intermediate unless it is already known and returns its
+        fingerprint.
+        """
+        intermediate = cls(body, certificate)
+        fingerprint = intermediate.fingerprint
+        if fingerprint in _intermediate_bodies or cls.query.get(fingerprint) is not None:
+            return fingerprint
+        try:
+            with db.session.begin_nested():
+                db.session.add(intermediate)
+        except IntegrityError:
+            # stored by a concurrent issuance
+            pass
+        return fingerprint
+
+    @classmethod
+    def get_body(cls, fingerprint) -> str:
+        """
+        Returns the PEM of an intermediate. Intermediates never change, so
+        they are kept in memory once read.
+        """
+        body = _intermediate_bodies.get(fingerprint)
+        if body is None:
+            intermediate = cls.query.get(fingerprint)
+            if intermediate is None:
+                raise LookupError("Intermediate {} not found".format(fingerprint))
+            body = intermediate.body
+            with _intermediate_bodies_lock:
+                _intermediate_bodies[fingerprint] = body
+        return body
+
+
 class Certificate(db.Model):
     __tablename__ = "certificates"
     id = Column(Integer, primary_key=True)
     external_id = Column(String(128))
-    body = Column(Text())
-    intermediate = Column(Text())
-    chain = Column(Text())
-    csr = Column(Text())
-    private_key = Column(Text())
+    _body = Column('body', Text())
+    body_der = Column(LargeBinary())
+    body = CompactPem('_body', 'body_der', 'CERTIFICATE')
+    # legacy copies, certificates now reference their intermediates
+    _intermediate = Column('intermediate', Text())
+    _chain = Column('chain', Text())
+    intermediate_fingerprints = Column(Text())
+    _csr = Column('csr', Text())
+    csr_der = Column(LargeBinary())
+    csr = CompactPem('_csr', 'csr_der', 'CERTIFICATE REQUEST')
+    _private_key = Column('private_key', Text())
+    private_key_der = Column(LargeBinary())
+    private_key = CompactPem('_private_key', 'private_key_der')
     expiry = Column(String(12))
     fingerprint = Column(Text())
     status = Column(String(16), nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"))
     order_id = Column(Integer, ForeignKey("orders.id"))
 
+    # parsed from body once, so inventory queries never touch the PEM
+    serial = Column(String(64), index=True)
+    issuer = Column(Text())
+    not_before = Column(DateTime())
+    not_after = Column(DateTime(), index=True)
+    key_type = Column(String(16))
+    san = Column(Text())
+
     #certificate_order = relationship("Order", foreign_keys="Order.resolved_cert_id")
 
+    @property
+    def domains(self):
+        return self.san.split(',') if self.san else []
+
+    @property
+    def intermediate(self):
+        if self.intermediate_fingerprints:
+            return ''.join(Intermediate.get_body(fingerprint)
+                           for fingerprint in self.intermediate_fingerprints.split(','))
+        return self._intermediate
+
+    @property
+    def chain(self):
+        # a legacy chain is only kept when it is not simply body and intermediate
+        if self._chain or not self.intermediate_fingerprints:
+            return self._chain
+        return (self.body or '') + self.intermediate
+
+    def set_intermediates(self, chain):
+        """
+        Stores the intermediates of this certificate, in chain order, in the
+        intermediates table and references them by fingerprint. Takes PEM
+        strings or (pem, certificate) pairs of already parsed certificates.
+        """
+        pairs = [item if isinstance(item, tuple) else (item, None) for item in chain]
+        self.intermediate_fingerprints = ','.join(
+            Intermediate.store(body, certificate) for body, certificate in pairs)
+        self._intermediate = None
+        self._chain = None
+
+    def load_metadata(self, certificate=None):
+        """
+        Fills the metadata columns from the certificate, parsing body if no
+        certificate object is given.
+        """
+        if certificate is None:
+            certificate = crypto.load_pem_certificate(self.body.encode('ASCII'))
+        metadata = crypto.get_certificate_metadata(certificate)
+        self.serial = metadata['serial']
+        self.issuer = metadata['issuer']
+        self.not_before = metadata['not_before']
+        self.not_after = metadata['not_after']
+        self.key_type = metadata['key_type']
+        self.san = ','.join(metadata['san'])
+
     @property
     def json(self):
         return json.dumps({
@@ -178,7 +379,55 @@ class Certificate(db.Model):
             'chain': self.chain,
             'key': self.private_key,
             'csr': self.csr,
+            'serial': self.serial,
+            'issuer': self.issuer,
+            'not_before': self.not_before.isoformat() if self.not_before else None,
+            'not_after': self.not_after.isoformat() if self.not_after else None,
+            'key_type': self.key_type,
+            'domains': self.domains,
             'order_id': self.order_id,
             'user_id': self.user_id,
             'status': self.status
         }).encode("utf-8")
+
+
+class Job(db.Model):
+    """
+    Durable issuance request for an order. Rows are claimed by the worker
+    pool of a running process and survive restarts of that process.
+    """
+    __tablename__ = "issuance_jobs"
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False, index=True)
+    reissue = Column(Boolean(), default=False)
+    status = Column(String(16), nullable=False, index=True)
+    attempts = Column(Integer, default=0)
+    worker = Column(String(128))
+    error = Column(Text())
+    created_at = Column(DateTime())
+    run_after = Column(DateTime())
+    started_at = Column(DateTime())
+    finished_at = Column(DateTime())
+
+    def __init__(self, order_id, reissue=False):
+        self.order_id = order_id
+        self.reissue = reissue
+        self.status = 'queued'
+        self.attempts = 0
+        self.created_at = datetime.utcnow()
+        self.run_after = self.created_at
+
+    @property
+    def json(self):
+        return json.dumps({
+            'id': self.id,
+            'order_id': self.order_id,
+            'reissue': self.reissue,
+            'status': self.status,
+            'attempts': self.attempts,
+            'worker': self.worker,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }).encode("utf-8")
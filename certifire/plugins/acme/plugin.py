@@ -1,12 +1,14 @@
 import hashlib
-from threading import Thread
 
 from certifire import config, database, db
 from certifire.plugins.acme import crypto
 from certifire.plugins.acme.handlers import AcmeDnsHandler, AcmeHttpHandler
-from certifire.plugins.acme.models import Account, Certificate, Order
+from certifire.plugins.acme.jobs import enqueue, enqueue_many
+from certifire.plugins.acme.keypool import get_key_pool
+from certifire.plugins.acme.models import (Account, Certificate, Intermediate,
+                                          Order)
 from certifire.plugins.destinations.models import Destination
-from certifire.thread import AppContextThread
+from sqlalchemy import or_
 
 
 def register(user_id=1, email: str = None, server: str = None, rsa_key=None,
@@ -14,8 +16,12 @@ def register(user_id=1, email: str = None, server: str = None, rsa_key=None,
              organizational_unit: str = None,
              country: str = None,
              state: str = None,
-             location: str = None):
+             location: str = None,
+             key_type: str = None):
 
+    if key_type and key_type not in crypto.KEY_TYPES:
+        print("Invalid key type {}".format(key_type))
+        return False, 0
     email = email if email else config.CERTIFIRE_EMAIL
     server = server if server else config.LETS_ENCRYPT_PRODUCTION
     organization = organization if organization else config.CERTIFIRE_ORGANIZATION
@@ -32,7 +38,8 @@ def register(user_id=1, email: str = None, server: str = None, rsa_key=None,
 
     acme = AcmeDnsHandler()
     account = acme.setup_acme_account(user_id, email, server, rsa_key,
-                                      organization, organizational_unit, country, state, location)
+                                      organization, organizational_unit, country, state, location,
+                                      key_type)
     print("Account {} created for given email {}.".format(
         account.uri, account.email))
     return True, account.id
@@ -70,13 +77,29 @@ def create_order(account_id: int,
                  location: str = None,
                  reissue: bool = False,
                  csr: str = None,
-                 key: str = None):
+                 key: str = None,
+                 key_type: str = None):
 
     account = Account.query.get(account_id)
     if not account:
         print("Account {} not found".format(account_id))
         return False, 0
 
+    try:
+        csr_obj = _load_pem(csr, crypto.load_csr)
+        key_obj = _load_pem(key, crypto.load_private_key)
+    except (ValueError, TypeError) as e:
+        print("Invalid csr or key: {}".format(e))
+        return False, 0
+
+    if csr_obj or key_obj:
+        key_type = crypto.get_key_type(csr_obj.public_key() if csr_obj else key_obj)
+    else:
+        key_type = key_type or account.key_type or config.DEFAULT_KEY_TYPE
+    if key_type not in crypto.KEY_TYPES:
+        print("Invalid key type {}".format(key_type))
+        return False, 0
+
     type = type if type else config.DEFAULT_AUTH_TYPE
     provider = provider if provider else config.DEFAULT_DNS
     email = email if email else account.email
@@ -94,6 +117,11 @@ def create_order(account_id: int,
     if type == 'sftp':
         acme = AcmeHttpHandler(account.id)
 
+    try:
+        domains = _normalize_domains(domains or [])
+    except ValueError as e:
+        print("Invalid domains: {}".format(e))
+        return False, 0
     if not domains:
         if not destination_id:
             print("No domains or destinations provided")
@@ -106,33 +134,196 @@ def create_order(account_id: int,
             if destination_db.host not in domains:
                 domains = [destination_db.host] + domains
 
-    domains_hash = hashlib.sha256(
-        "_".join(domains).encode("ascii")).hexdigest()
+    domains_hash = _order_hash(domains)
     check = database.get_all(Order, domains_hash, 'hash')
     for order in check:
-        if order.email == email and order.type == type and order.account_id == account.id:
+        if order.email == email and order.type == type and order.account_id == account.id \
+                and order.key_type == key_type:
             print("Order {} exists for given email: {} and account_id: {}.".format(
                 order.uri, email, account.id))
             #acme_order = acme.create_order(order.csr, order.provider, order.id)
-            AppContextThread(target=acme.create_order, args=(
-                order.csr, order.provider, order.id, destination_id, reissue)).start()
+            enqueue(order.id, reissue)
             return False, order.id
 
 
-    if not csr or key:
+    if csr_obj:
+        csr = crypto.export_pem_csr(csr_obj).decode('utf-8')
+        key = crypto.export_private_key(key_obj).decode('utf-8') if key_obj else None
+    else:
         csr, key = acme.generate_csr(
-            domains, email, organization, organizational_unit, country, state, location)
+            domains, email, organization, organizational_unit, country, state, location, key_type,
+            key_obj)
 
     order = Order(destination_id, domains, type, provider, account.id, account.user_id, domains_hash,
-                  csr, key, email, organization, organizational_unit, country, state, location)
+                  csr, key, email, organization, organizational_unit, country, state, location,
+                  key_type)
     database.add(order)
 
     #acme_order = acme.create_order(csr, provider, order.id)
-    AppContextThread(target=acme.create_order, args=(
-        csr, provider, order.id, destination_id)).start()
+    enqueue(order.id)
     return True, order.id
 
 
+def _load_pem(value, loader):
+    """
+    Loads a PEM str or bytes value, objects already loaded by the caller are
+    returned as is.
+    """
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.encode('UTF-8')
+    if isinstance(value, bytes):
+        return loader(value)
+    return value
+
+
+def _order_hash(domains: list):
+    return hashlib.sha256("_".join(domains).encode("ascii")).hexdigest()
+
+
+def _normalize_domains(domains):
+    """
+    Checks that domains is a list of names and IDNA-encodes them, raises
+    ValueError otherwise.
+    """
+    if not isinstance(domains, list) or not all(isinstance(d, str) for d in domains):
+        raise ValueError('domains must be a list of strings')
+    return [domain.encode('idna').decode('ascii') for domain in domains]
+
+
+def create_orders(user_id: int, specs: list):
+    """
+    Creates many orders at once. Each spec takes the same fields as the
+    /api/order body. Accounts, destinations and existing orders are looked
+    up with one query each, all new orders are inserted and queued in a
+    single transaction.
+
+    Returns one result dict per spec, in order, with either the order id and
+    whether it was created or already existed, or an error.
+    """
+    account_ids = {spec.get('account') for spec in specs if spec.get('account')}
+    destination_ids = {spec.get('destination') for spec in specs if spec.get('destination')}
+    accounts = {act.id: act for act in Account.query.filter(Account.id.in_(account_ids))} \
+        if account_ids else {}
+    destinations = {dest.id: dest for dest in Destination.query.filter(
+        Destination.id.in_(destination_ids))} if destination_ids else {}
+
+    results = [None] * len(specs)
+    prepared = []
+    for index, spec in enumerate(specs):
+        account = accounts.get(spec.get('account'))
+        if not account or account.user_id != user_id:
+            results[index] = {'error': 'Account {} not found'.format(spec.get('account'))}
+            continue
+
+        destination_id = spec.get('destination')
+        destination_db = None
+        if destination_id:
+            destination_db = destinations.get(destination_id)
+            if not destination_db or destination_db.user_id != user_id:
+                results[index] = {'error': 'Destination {} not found'.format(destination_id)}
+                continue
+
+        type = spec.get('type') or config.DEFAULT_AUTH_TYPE
+        provider = spec.get('provider') or config.DEFAULT_DNS
+        if type not in ('dns', 'sftp'):
+            results[index] = {'error': 'Invalid authorization type {}'.format(type)}
+            continue
+        if type == 'dns' and provider not in config.VALID_DNS_PROVIDERS:
+            results[index] = {'error': 'Invalid DNS Provider {}'.format(provider)}
+            continue
+        if type == 'sftp' and not destination_db:
+            results[index] = {'error': 'sftp authorization needs a destination'}
+            continue
+
+        try:
+            domains = _normalize_domains(spec.get('domains') or [])
+        except ValueError as e:
+            results[index] = {'error': 'Invalid domains: {}'.format(e)}
+            continue
+        if destination_db and destination_db.host not in domains:
+            domains = [destination_db.host] + domains
+        if not domains:
+            results[index] = {'error': 'Provide atleast one domain or destination'}
+            continue
+
+        try:
+            csr = crypto.load_csr(spec['csr'].encode('UTF-8')) if spec.get('csr') else None
+            key = crypto.load_private_key(spec['key'].encode('UTF-8')) if spec.get('key') else None
+        except (ValueError, TypeError) as e:
+            results[index] = {'error': 'Invalid csr or key: {}'.format(e)}
+            continue
+
+        if csr or key:
+            key_type = crypto.get_key_type(csr.public_key() if csr else key)
+        else:
+            key_type = spec.get('key_type') or account.key_type or config.DEFAULT_KEY_TYPE
+        if key_type not in crypto.KEY_TYPES:
+            results[index] = {'error': 'Invalid key type {}'.format(key_type)}
+            continue
+
+        prepared.append((index, spec, account, destination_id, domains, type, provider, csr, key,
+                         key_type))
+
+    existing = {}
+    hashes = {_order_hash(item[4]) for item in prepared}
+    if hashes:
+        for order in Order.query.filter(Order.hash.in_(hashes)):
+            existing[(order.hash, order.email, order.type, order.account_id, order.key_type)] = order
+
+    new_orders = []
+    resolved = []
+    queued = []
+    for index, spec, account, destination_id, domains, type, provider, csr, key, key_type \
+            in prepared:
+        email = spec.get('email') or account.email
+        domains_hash = _order_hash(domains)
+        order = existing.get((domains_hash, email, type, account.id, key_type))
+        if order is not None:
+            resolved.append((index, order, False))
+            queued.append((order, bool(spec.get('reissue'))))
+            continue
+
+        organization = spec.get('organization') or account.organization
+        organizational_unit = spec.get('organizational_unit') or account.organizational_unit
+        country = spec.get('country') or account.country
+        state = spec.get('state') or account.state
+        location = spec.get('location') or account.location
+
+        if csr:
+            csr_pem = crypto.export_pem_csr(csr).decode('utf-8')
+            key_pem = crypto.export_private_key(key).decode('utf-8') if key else None
+        else:
+            csr_pem, key_pem = crypto.create_csr({
+                "domains": domains,
+                "owner": email,
+                "organization": organization,
+                "organizational_unit": organizational_unit,
+                "country": country,
+                "state": state,
+                "location": location
+            }, key or get_key_pool(key_type).get())
+
+        order = Order(destination_id, domains, type, provider, account.id, account.user_id,
+                      domains_hash, csr_pem, key_pem, email, organization,
+                      organizational_unit, country, state, location, key_type)
+        db.session.add(order)
+        existing[(domains_hash, email, type, account.id, key_type)] = order
+        new_orders.append(order)
+        resolved.append((index, order, True))
+        queued.append((order, False))
+
+    # assign ids to the new rows, the commit happens along with the jobs
+    db.session.flush()
+    for index, order, created in resolved:
+        results[index] = {'id': order.id, 'created': created}
+    enqueue_many([(order.id, reissue) for order, reissue in queued])
+
+    print("Batch of {} orders: {} created".format(len(specs), len(new_orders)))
+    return results
+
+
 def reorder(account_id: int, order_id: int):
     account = Account.query.get(account_id)
     order_db = Order.query.get(order_id)
@@ -141,12 +332,7 @@ def reorder(account_id: int, order_id: int):
         print("This order does not belong to this account")
         return False, order_id
 
-    if order_db.type == 'dns':
-        acme = AcmeDnsHandler(account.id)
-    elif order_db.type == 'sftp':
-        acme = AcmeHttpHandler(account.id)
-    AppContextThread(target=acme.create_order, args=(order_db.csr,
-                            order_db.provider, order_db.id, order_db.destination_id, True)).start()
+    enqueue(order_db.id, True)
     return True, order_db.id
 
 
@@ -182,3 +368,100 @@ def revoke_certificate(account_id: int, cert_id: int, delete: bool = False):
         status = "Certificate with id: {} does not exist".format(cert_id)
         print(status)
         return False, status
+
+
+def backfill_certificate_metadata(batch_size: int = 500):
+    """
+    Fills the metadata columns of certificates stored before they existed,
+    committing every batch_size rows. Returns the number of rows updated.
+    """
+    updated = 0
+    failed = set()
+    while True:
+        query = Certificate.query.filter(Certificate.not_after.is_(None),
+                                         Certificate.body.isnot_none())
+        if failed:
+            query = query.filter(~Certificate.id.in_(failed))
+        certificates = query.order_by(Certificate.id).limit(batch_size).all()
+        if not certificates:
+            break
+        for cert_db in certificates:
+            try:
+                cert_db.load_metadata()
+                updated += 1
+            except ValueError as e:
+                print("Certificate {} could not be parsed: {}".format(cert_db.id, e))
+                failed.add(cert_db.id)
+        database.commit()
+        print("{} certificates updated".format(updated))
+    return updated
+
+
+def _chain_ders(chain):
+    try:
+        return [crypto.pem_to_der(pem) for pem in crypto.iter_pem_certificates(chain)]
+    except ValueError:
+        return None
+
+
+def dedupe_intermediates(batch_size: int = 500):
+    """
+    Moves the intermediates of certificates stored with their own copies
+    into the intermediates table, committing every batch_size rows.
+    Returns the number of certificates updated.
+    """
+    updated = 0
+    failed = set()
+    while True:
+        query = Certificate.query.filter(Certificate.intermediate_fingerprints.is_(None),
+                                         Certificate._intermediate.isnot(None))
+        if failed:
+            query = query.filter(~Certificate.id.in_(failed))
+        certificates = query.order_by(Certificate.id).limit(batch_size).all()
+        if not certificates:
+            break
+        for cert_db in certificates:
+            bodies = [body.decode() for body in
+                      crypto.strip_certificates(cert_db._intermediate.encode())]
+            if not bodies:
+                print("Certificate {} has no readable intermediate".format(cert_db.id))
+                failed.add(cert_db.id)
+                continue
+            legacy_chain = cert_db._chain
+            cert_db.set_intermediates(bodies)
+            # keep a chain that is not simply body and intermediate, compared
+            # as DER so PEM formatting differences do not count
+            if legacy_chain and _chain_ders(legacy_chain) != _chain_ders(cert_db.chain):
+                cert_db._chain = legacy_chain
+            updated += 1
+        database.commit()
+        print("{} certificates deduplicated".format(updated))
+    return updated
+
+
+def convert_certificate_storage(batch_size: int = 500):
+    """
+    Rewrites certificates, their keys and CSRs, and intermediates in the
+    storage format selected by COMPACT_STORAGE, DER or PEM, committing every
+    batch_size rows. Returns the number of rows rewritten.
+    """
+    updated = 0
+    for model, key, attributes in ((Certificate, Certificate.id, ('body', 'csr', 'private_key')),
+                                   (Intermediate, Intermediate.fingerprint, ('body',))):
+        last = None
+        while True:
+            query = model.query.filter(or_(*[getattr(model, name).convertible()
+                                             for name in attributes]))
+            if last is not None:
+                query = query.filter(key > last)
+            rows = query.order_by(key).limit(batch_size).all()
+            if not rows:
+                break
+            for row in rows:
+                for name in attributes:
+                    setattr(row, name, getattr(row, name))
+            last = getattr(rows[-1], key.key)
+            updated += len(rows)
+            database.commit()
+            print("{} rows converted".format(updated))
+    return updated
@@ -1,15 +1,26 @@
 import json
 import os
 
-from certifire import app, auth, config, database, db
+from certifire import app, auth, config, database, db, users
+from certifire.errors import BacklogFull
 from certifire.plugins.acme import crypto
-from certifire.plugins.acme.models import Account, Certificate, Order
-from certifire.plugins.acme.plugin import (create_order, deregister, register,
-                                           reorder, revoke_certificate)
+from certifire.plugins.acme.client import nonce_pool_stats
+from certifire.plugins.acme.importer import import_certificates
+from certifire.plugins.acme.jobs import backlog, get_issuance_pool
+from certifire.plugins.acme.keypool import key_pool_stats
+from certifire.plugins.acme.models import Account, Certificate, Job, Order
+from certifire.plugins.acme.plugin import (create_order, create_orders,
+                                           deregister, register, reorder,
+                                           revoke_certificate)
 from certifire.plugins.destinations.models import Destination
 from flask import abort, g, jsonify, request, url_for
 
 
+@app.errorhandler(BacklogFull)
+def backlog_full(e):
+    return (jsonify({'status': str(e).strip("'")}), 503, {'Retry-After': 30})
+
+
 @app.route('/api/acme', methods=['POST'])
 @auth.login_required
 def new_acme_account():
@@ -22,6 +33,7 @@ def new_acme_account():
     state = post_data.get('state')
     location = post_data.get('location')
     key = post_data.get('key')
+    key_type = post_data.get('key_type')
     if not email:
         post_data = request.get_json(force=True)
         email = post_data.get('email')
@@ -32,18 +44,22 @@ def new_acme_account():
         state = post_data.get('state')
         location = post_data.get('location')
         key = post_data.get('key')
+        key_type = post_data.get('key_type')
 
     user_id = g.user.id
     if email is None:
         abort(400)
     if server is None:
         server = config.LETS_ENCRYPT_PRODUCTION
+    if key_type and key_type not in crypto.KEY_TYPES:
+        return (jsonify({'status': 'Key type must be one of {}'.format(', '.join(crypto.KEY_TYPES))}), 400)
     rsa_key = None
     if key:
         rsa_key = crypto.load_private_key(key.encode('UTF-8'))
 
     ret, account_id = register(user_id, email, server, rsa_key,
-                               organization, organizational_unit, country, state, location)
+                               organization, organizational_unit, country, state, location,
+                               key_type)
     if ret:
         return (jsonify({'status': 'New account created', 'id': account_id}), 201,
                 {'Location': url_for('get_acme_account', id=account_id, _external=True),
@@ -111,7 +127,10 @@ def new_order():
     csr = post_data.get('csr')
     key = post_data.get('key')
     reissue = post_data.get('reissue')
+    key_type = post_data.get('key_type')
 
+    if key_type and key_type not in crypto.KEY_TYPES:
+        return (jsonify({'status': 'Key type must be one of {}'.format(', '.join(crypto.KEY_TYPES))}), 400)
     if not destination:
         if domains is None or domains == []:
             return (jsonify({'status': 'Provide atleast one domain or destination'}), 400)
@@ -135,7 +154,8 @@ def new_order():
         pem_csr = crypto.load_csr(csr.encode('UTF-8'))
 
     ret, order_id = create_order(account.id, destination, domains, type, provider, email,
-                                 organization, organizational_unit, country, state, location, reissue, pem_csr, pem_key)
+                                 organization, organizational_unit, country, state, location, reissue, pem_csr, pem_key,
+                                 key_type)
     if ret:
         return (jsonify({'status': 'New order created, Please wait some time before acessing the order', 'id': order_id}), 201,
                 {'Location': url_for('get_order', id=order_id, _external=True)})
@@ -144,6 +164,50 @@ def new_order():
                 {'Location': url_for('get_order', id=order_id, _external=True)})
 
 
+@app.route('/api/orders/batch', methods=['POST'])
+@auth.login_required
+def new_orders():
+    post_data = request.get_json(force=True)
+    specs = post_data.get('orders') if isinstance(post_data, dict) else post_data
+    if not isinstance(specs, list) or not specs:
+        return (jsonify({'status': 'Provide a list of orders'}), 400)
+    if len(specs) > config.ORDER_BATCH_LIMIT:
+        return (jsonify({'status': 'At most {} orders per batch'.format(config.ORDER_BATCH_LIMIT)}), 400)
+    if not all(isinstance(spec, dict) for spec in specs):
+        return (jsonify({'status': 'Every order must be an object'}), 400)
+
+    results = create_orders(g.user.id, specs)
+    created = len([r for r in results if r.get('created')])
+    failed = len([r for r in results if 'error' in r])
+    return (jsonify({'status': '{} orders created, {} existing, {} failed'.format(
+                        created, len(results) - created - failed, failed),
+                     'orders': results}), 201 if created else 200)
+
+
+@app.route('/api/queue')
+@auth.login_required
+def get_queue():
+    if not g.user.is_admin:
+        return (jsonify({'status': 'Only admin can view the issuance queue'}), 400)
+    return jsonify({'pool': get_issuance_pool().stats, 'jobs': backlog(),
+                    'nonces': nonce_pool_stats(), 'keys': key_pool_stats()})
+
+
+@app.route('/api/order/<int:id>/jobs')
+@auth.login_required
+def get_order_jobs(id):
+    order = Order.query.get(id)
+    if not order:
+        abort(400)
+    if g.user.id != order.user_id:
+        return (jsonify({'status': 'This order does not belong to you!'}), 400)
+
+    data = {}
+    for job in database.get_all(Job, order.id, 'order_id'):
+        data[job.id] = json.loads(job.json)
+    return jsonify(data)
+
+
 @app.route('/api/order/<int:id>')
 @auth.login_required
 def get_order(id):
@@ -212,6 +276,33 @@ def get_all_certificates():
     return jsonify(data)
 
 
+@app.route('/api/certificates/import', methods=['POST'])
+@auth.login_required
+def import_certs():
+    if not g.user.is_admin:
+        return (jsonify({'status': 'Only admin can import certificates'}), 400)
+    bundles = [f.read() for f in request.files.getlist('files')]
+    user_id = request.form.get('user_id', g.user.id)
+    if not bundles:
+        post_data = request.get_json(force=True, silent=True) or {}
+        bundles = post_data.get('bundles')
+        user_id = post_data.get('user_id', g.user.id)
+    if not isinstance(bundles, list) or not bundles:
+        return (jsonify({'status': 'Provide a list of PEM bundles'}), 400)
+    if len(bundles) > config.IMPORT_BATCH_LIMIT:
+        return (jsonify({'status': 'At most {} bundles per import'.format(config.IMPORT_BATCH_LIMIT)}), 400)
+    try:
+        user = users.User.query.get(int(user_id))
+    except (TypeError, ValueError):
+        user = None
+    if not user:
+        return (jsonify({'status': 'There is no such user!'}), 400)
+
+    summary = import_certificates(user.id, bundles=bundles)
+    summary['status'] = '{} certificates imported'.format(summary['imported'])
+    return (jsonify(summary), 201 if summary['imported'] else 200)
+
+
 @app.route('/api/certificate/<int:id>', methods=['DELETE'])
 @auth.login_required
 def revoke_cert(id):
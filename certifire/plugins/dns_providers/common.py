@@ -1,8 +1,13 @@
 from typing import Any, Dict, Sequence, Union
 import base64
+import time
 from hashlib import sha256
 
+from certifire import config
+from certifire.errors import PluginError
 from certifire.plugins.dns_providers.auth import ErrataItemType, DNSProviderBase
+from certifire.plugins.dns_providers.propagation import get_propagation_checker
+from certifire.plugins.dns_providers.waiter import get_change_waiter
 
 def safe_base64(un_encoded_data: Union[str, bytes]) -> str:
     "return ACME-safe base64 encoding of un_encoded_data as a string"
@@ -20,11 +25,22 @@ def dns_challenge(key_auth: str) -> str:
 class BaseDns(DNSProviderBase):
     """
     Shim for legacy DNS provider interface.
+
+    Providers that set supports_alias, and name their records with
+    challenge_name, write the TXT records in the alias zone, DNS_ALIAS_ZONE by
+    default, instead of the zone of each domain. Every domain then delegates
+    _acme-challenge.<domain> to <domain>.<alias> with a CNAME.
     """
 
+    supports_alias = False
+
     def __init__(self, **kwargs: Any) -> None:
         if "chal_types" not in kwargs:
             kwargs["chal_types"] = ["dns-01"]
+        if "alias" not in kwargs and self.supports_alias:
+            kwargs["alias"] = config.DNS_ALIAS_ZONE
+        elif kwargs.get("alias") and not self.supports_alias:
+            raise ValueError("{} does not support a DNS alias".format(self.__class__.__name__))
         if "LOG_LEVEL" not in kwargs:
             kwargs["LOG_LEVEL"] = "WARNING"
         super().__init__(**kwargs)
@@ -32,18 +48,28 @@ class BaseDns(DNSProviderBase):
     ### shim methods
 
     def setup(self, challenges: Sequence[Dict[str, str]]) -> Sequence[ErrataItemType]:
-        for chal in challenges:
-            self.create_dns_record(chal["ident_value"], dns_challenge(chal["key_auth"]))
+        self.create_dns_records(
+            [(chal["ident_value"], dns_challenge(chal["key_auth"])) for chal in challenges])
         return []
 
     def unpropagated(self, challenges: Sequence[Dict[str, str]]) -> Sequence[ErrataItemType]:
-        return []
+        records = {("_acme-challenge." + chal["ident_value"] + ".", dns_challenge(chal["key_auth"])): chal
+                   for chal in challenges}
+        errata = {}
+        for name, value, reason in get_propagation_checker().missing(list(records)):
+            errata.setdefault((name, value), ("unready", reason, records[(name, value)]))
+        return list(errata.values())
 
     def clear(self, challenges: Sequence[Dict[str, str]]) -> Sequence[ErrataItemType]:
-        for chal in challenges:
-            self.delete_dns_record(chal["ident_value"], dns_challenge(chal["key_auth"]))
+        self.delete_dns_records(
+            [(chal["ident_value"], dns_challenge(chal["key_auth"])) for chal in challenges])
         return []
 
+    def challenge_name(self, domain_name: str) -> str:
+        "returns the fqdn, with the trailing dot, where the TXT record of a domain is written"
+
+        return self.target_domain({"ident_value": domain_name}).rstrip(".") + "."
+
     ### legacy DNS methods
 
     def create_dns_record(self, domain_name, domain_dns_value):
@@ -64,6 +90,7 @@ class BaseDns(DNSProviderBase):
             Then, your implementation of this method ought to create a DNS TXT record
             whose name is '_acme-challenge' + '.' + domain_name + '.' (ie: _acme-challenge.example.com. )
             and whose value/content is HAJA_4MkowIFByHhFaP8u035skaM91lTKplKld
+            Providers that set supports_alias name the record self.challenge_name(domain_name)
 
             Using a dns client like dig(https://linux.die.net/man/1/dig) to do a dns lookup should result
             in something like:
@@ -93,5 +120,76 @@ class BaseDns(DNSProviderBase):
         """
         raise NotImplementedError("delete_dns_record method must be implemented.")
 
+    def create_dns_records(self, records):
+        """
+        Method that creates the dns TXT records of several domains at once.
+
+        :param records: :list: (domain_name, domain_dns_value) pairs, as passed
+            to `create_dns_record`
+
+        This method should return the list of change ids to wait for. The default
+        creates the records one by one, providers that can change several
+        records in one request should override it.
+        """
+        return [self.create_dns_record(domain_name, domain_dns_value)
+                for domain_name, domain_dns_value in records]
+
+    def delete_dns_records(self, records):
+        """
+        Method that deletes the dns TXT records of several domains at once.
+
+        :param records: :list: (domain_name, domain_dns_value) pairs, as passed
+            to `delete_dns_record`
+
+        This method should return the list of change ids. The default deletes
+        the records one by one.
+        """
+        return [self.delete_dns_record(domain_name, domain_dns_value)
+                for domain_name, domain_dns_value in records]
+
     def wait_for_change(self, change_id):
         raise NotImplementedError("wait_for_change method must be implemented.")
+
+    def wait_for_propagation(self, records):
+        """
+        Waits until the challenge TXT records of (domain_name, domain_dns_value)
+        pairs are served by every authoritative nameserver of their zones,
+        following the CNAMEs of aliased domains, checking with exponential
+        backoff. Raises PluginError after
+        DNS_PROPAGATION_TIMEOUT seconds.
+        """
+        names = [("_acme-challenge." + domain_name + ".", value) for domain_name, value in records]
+        deadline = time.monotonic() + config.DNS_PROPAGATION_TIMEOUT
+        delay = 0.5
+        while True:
+            missing = get_propagation_checker().missing(names)
+            if not missing:
+                return
+            if time.monotonic() + delay > deadline:
+                name, value, reason = missing[0]
+                raise PluginError("Timed out waiting for TXT {} on {}: {}".format(value, name, reason))
+            time.sleep(delay)
+            names = [(name, value) for name, value, _ in missing]
+            delay = min(delay * 2, 10)
+
+    def change_propagated(self, change_id):
+        """
+        Method that checks once whether a change returned by `create_dns_record` or
+        `delete_dns_record` has reached all nameservers of the provider.
+
+        This method should return True or False. Providers implementing it are
+        waited on by the shared change waiter.
+        """
+        raise NotImplementedError("change_propagated method must be implemented.")
+
+    def wait_for_changes(self, change_ids):
+        """
+        Waits until all changes have propagated, concurrently with the shared
+        change waiter if the provider implements `change_propagated`, else one
+        after the other with `wait_for_change`.
+        """
+        if type(self).change_propagated is BaseDns.change_propagated:
+            for change_id in change_ids:
+                self.wait_for_change(change_id)
+            return
+        get_change_waiter().wait(self, change_ids)
@@ -1,10 +1,80 @@
+import importlib
+import threading
+
+from certifire import config
 from certifire.errors import UnknownProvider
 from certifire.plugins.dns_providers.common import BaseDns
-from certifire.plugins.dns_providers.route53 import Route53Dns
 
-def get_dns_provider(type) -> BaseDns:
-        if type == "route53":
-            print("Initialized route53 DNS Plugin")
-            return Route53Dns()
+try:
+    from importlib.metadata import entry_points
+except ImportError:  # python < 3.8
+    entry_points = None
+
+ENTRY_POINT_GROUP = "certifire.dns_providers"
+
+# used when certifire runs from a source tree without installed entry points
+BUILTIN_DNS_PROVIDERS = {
+    "route53": "certifire.plugins.dns_providers.route53:Route53Dns",
+}
+
+_provider_classes = {}
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def _find_entry_point(name):
+    if entry_points is None:
+        return None
+    eps = entry_points()
+    group = eps.select(group=ENTRY_POINT_GROUP) if hasattr(eps, "select") \
+        else eps.get(ENTRY_POINT_GROUP, [])
+    for ep in group:
+        if ep.name == name:
+            return ep
+    return None
+
+
+def load_dns_provider_class(name):
+    """
+    Returns the class of an enabled DNS provider, importing its module on
+    first use. Providers are registered in the certifire.dns_providers entry
+    point group, so in-house providers ship as packages of their own, and
+    only those listed in VALID_DNS_PROVIDERS can be used.
+    """
+    if name not in config.VALID_DNS_PROVIDERS:
+        raise UnknownProvider("No such DNS provider: {}".format(name))
+    provider_class = _provider_classes.get(name)
+    if provider_class is None:
+        ep = _find_entry_point(name)
+        if ep is not None:
+            provider_class = ep.load()
+        elif name in BUILTIN_DNS_PROVIDERS:
+            module, _, attr = BUILTIN_DNS_PROVIDERS[name].partition(":")
+            provider_class = getattr(importlib.import_module(module), attr)
         else:
-            raise UnknownProvider("No such DNS provider: {}".format(type))
+            raise UnknownProvider("DNS provider {} is not installed".format(name))
+        _provider_classes[name] = provider_class
+    return provider_class
+
+
+def get_dns_provider(type, **credentials) -> BaseDns:
+    """
+    Returns the provider instance for a provider type and set of
+    credentials. Instances are built once per process and shared by all
+    orders and threads, keeping their API clients, connection pools and
+    record bookkeeping.
+    """
+    key = (type, tuple(sorted(credentials.items())))
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            provider = load_dns_provider_class(type)(**credentials)
+            print("Initialized {} DNS Plugin".format(type))
+            _providers[key] = provider
+        return provider
+
+
+def clear_dns_providers():
+    with _providers_lock:
+        _providers.clear()
+        _provider_classes.clear()
@@ -0,0 +1,149 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.query
+import dns.rdatatype
+import dns.resolver
+
+from certifire import config
+
+_checker = None
+_checker_lock = threading.Lock()
+
+
+class PropagationChecker:
+    """
+    Checks that challenge TXT values are served by every authoritative
+    nameserver of their zone, by querying the nameservers directly instead
+    of a caching resolver. Zones and nameserver addresses are looked up
+    through the configured resolvers, or the system ones, and cached for
+    their TTL. Names delegated with a CNAME, as in DNS alias mode, are
+    followed to the nameservers of their target.
+    """
+
+    max_cname_depth = 8
+
+    def __init__(self, resolvers=None, port=53, timeout=None):
+        self.resolvers = config.DNS_RESOLVERS if resolvers is None else resolvers
+        self.port = port
+        self.timeout = config.DNS_QUERY_TIMEOUT if timeout is None else timeout
+        # shared by the resolvers of all threads, answers expire with their TTL
+        self._cache = dns.resolver.LRUCache()
+
+    def _resolver(self):
+        resolver = dns.resolver.Resolver(configure=not self.resolvers)
+        if self.resolvers:
+            resolver.nameservers = list(self.resolvers)
+        resolver.port = self.port
+        resolver.lifetime = self.timeout
+        resolver.cache = self._cache
+        return resolver
+
+    def nameservers(self, name):
+        """
+        Returns the zone of a name and the IPv4 addresses of its
+        authoritative nameservers. Nameservers without an A record, like
+        IPv6-only or dead out-of-zone ones, are skipped, as long as one
+        nameserver has an address.
+        """
+        resolver = self._resolver()
+        zone = dns.resolver.zone_for_name(name, resolver=resolver)
+        addresses = []
+        errors = []
+        for ns in resolver.resolve(zone, dns.rdatatype.NS):
+            try:
+                addresses.extend(a.address for a in resolver.resolve(ns.target, dns.rdatatype.A))
+            except dns.exception.DNSException as e:
+                errors.append("{}: {}".format(ns.target, e))
+        if not addresses:
+            raise dns.exception.DNSException("no IPv4 address for any nameserver of {}: {}".format(
+                zone, '; '.join(errors)))
+        return zone, addresses
+
+    def query_txt(self, name, address):
+        """
+        Returns the TXT values of a name served by one nameserver, and the
+        target of its CNAME or None.
+        """
+        query = dns.message.make_query(name, dns.rdatatype.TXT)
+        response = dns.query.udp(query, address, timeout=self.timeout, port=self.port)
+        if response.flags & dns.flags.TC:
+            response = dns.query.tcp(query, address, timeout=self.timeout, port=self.port)
+        values = set()
+        cname = None
+        for rrset in response.answer:
+            if rrset.rdtype == dns.rdatatype.TXT:
+                values.update(b''.join(rdata.strings).decode() for rdata in rrset)
+            elif rrset.rdtype == dns.rdatatype.CNAME and rrset.name == query.question[0].name:
+                cname = rrset[0].target.to_text()
+        return values, cname
+
+    def missing(self, records, depth=0):
+        """
+        Takes (name, value) pairs and returns those not yet served by all
+        authoritative nameservers, each with the reason, as (name, value,
+        reason). All nameservers of all names are queried in parallel, then
+        those of the CNAME targets of the names that have one.
+        """
+        values = {}
+        for name, value in records:
+            values.setdefault(name.rstrip('.') + '.', set()).add(value)
+
+        missing = []
+        queries = []
+        for name in values:
+            try:
+                _, addresses = self.nameservers(name)
+            except dns.exception.DNSException as e:
+                missing.extend((name, value, "no nameservers: {}".format(e)) for value in values[name])
+                continue
+            queries.extend((name, address) for address in addresses)
+        if not queries:
+            return missing
+
+        def check(query):
+            name, address = query
+            try:
+                return self.query_txt(name, address)
+            except (dns.exception.DNSException, OSError) as e:
+                return e
+
+        aliases = {}
+        with ThreadPoolExecutor(max_workers=min(len(queries), config.DNS_QUERY_CONCURRENCY)) as executor:
+            for (name, address), served in zip(queries, executor.map(check, queries)):
+                if isinstance(served, Exception):
+                    missing.extend((name, value, "{} failed: {}".format(address, served))
+                                   for value in values[name])
+                    continue
+                served, cname = served
+                if cname is not None:
+                    aliases.setdefault(name, set()).add(cname)
+                    continue
+                missing.extend((name, value, "not served by {}".format(address))
+                               for value in values[name] if value not in served)
+
+        targets = {}
+        for name, cnames in aliases.items():
+            if len(cnames) > 1 or depth >= self.max_cname_depth:
+                missing.extend((name, value, "unusable CNAME to {}".format(', '.join(sorted(cnames))))
+                               for value in values[name])
+                continue
+            targets.setdefault(cnames.pop(), []).append(name)
+        if targets:
+            records = [(target, value) for target, names in targets.items()
+                       for name in names for value in values[name]]
+            for target, value, reason in self.missing(records, depth + 1):
+                missing.extend((name, value, "{} (CNAME to {})".format(reason, target))
+                               for name in targets[target] if value in values[name])
+        return missing
+
+
+def get_propagation_checker() -> PropagationChecker:
+    global _checker
+    with _checker_lock:
+        if _checker is None:
+            _checker = PropagationChecker()
+        return _checker
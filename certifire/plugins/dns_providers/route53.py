@@ -1,16 +1,99 @@
 import collections
+import threading
 import time
+import weakref
 
 import boto3  # type: ignore
 from botocore.client import Config  # type: ignore
 
+from certifire import config
 from certifire.plugins.dns_providers import common
-from certifire.errors import PluginError
+
+_zone_indexes = {}
+# indexes of injected clients live as long as their client
+_client_zone_indexes = weakref.WeakKeyDictionary()
+_zone_indexes_lock = threading.Lock()
+
+
+class ZoneIndex:
+    """
+    Public hosted zones of one Route53 account keyed by name, so the zone of
+    a domain is found by looking up its suffixes from the longest down. The
+    zones are listed at most once per ttl seconds, or again on a miss when
+    the last listing is older than miss_interval seconds.
+    """
+
+    def __init__(self, ttl=None, miss_interval=30):
+        self.ttl = config.ROUTE53_ZONE_CACHE_TTL if ttl is None else ttl
+        self.miss_interval = miss_interval
+        self._zones = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self, r53):
+        with self._lock:
+            self._load(r53)
+
+    def _load(self, r53):
+        zones = {}
+        paginator = r53.get_paginator("list_hosted_zones")
+        for page in paginator.paginate():
+            for zone in page["HostedZones"]:
+                if zone["Config"]["PrivateZone"]:
+                    continue
+                zones[zone["Name"].rstrip(".").lower()] = zone["Id"]
+        self._zones = zones
+        self._loaded_at = time.monotonic()
+
+    def _age(self):
+        return float("inf") if self._loaded_at is None else time.monotonic() - self._loaded_at
+
+    def _lookup(self, labels):
+        for i in range(len(labels)):
+            zone_id = self._zones.get(".".join(labels[i:]))
+            if zone_id is not None:
+                return zone_id
+        return None
+
+    def find(self, r53, domain):
+        labels = domain.rstrip(".").lower().split(".")
+        with self._lock:
+            if self._age() > self.ttl:
+                self._load(r53)
+            zone_id = self._lookup(labels)
+            if zone_id is None and self._age() > self.miss_interval:
+                # the zone may have been created since the last listing
+                self._load(r53)
+                zone_id = self._lookup(labels)
+        return zone_id
+
+
+def get_zone_index(access_key_id=None, client=None):
+    """
+    Returns the zone index shared by the providers using the same access key,
+    or the same injected client.
+    """
+    with _zone_indexes_lock:
+        indexes, key = (_zone_indexes, access_key_id) if client is None \
+            else (_client_zone_indexes, client)
+        index = indexes.get(key)
+        if index is None:
+            index = indexes[key] = ZoneIndex()
+        return index
+
+
+def clear_zone_indexes():
+    with _zone_indexes_lock:
+        _zone_indexes.clear()
+        _client_zone_indexes.clear()
 
 
 # most code of this class is copy from certbot's route53 dns plugin.
 class Route53Dns(common.BaseDns):
+    supports_alias = True
     ttl = 10
+    # Route53 takes at most 1000 changes per ChangeBatch
+    max_batch_changes = 500
     connect_timeout = 30
     read_timeout = 30
 
@@ -18,8 +101,10 @@ class Route53Dns(common.BaseDns):
         if (access_key_id or secret_access_key) and client:
             raise RuntimeError("Pass keys OR preconfigured client, not both")
 
+        # one client is shared by every thread using this instance
         self.aws_config = Config(
-            connect_timeout=self.connect_timeout, read_timeout=self.read_timeout
+            connect_timeout=self.connect_timeout, read_timeout=self.read_timeout,
+            max_pool_connections=config.ROUTE53_MAX_POOL_CONNECTIONS,
         )
         if access_key_id and secret_access_key:
             # use user given credential
@@ -37,92 +122,129 @@ class Route53Dns(common.BaseDns):
             # https://boto3.readthedocs.io/en/latest/guide/configuration.html#best-practices-for-configuring-credentials
             self.r53 = boto3.client("route53", config=self.aws_config)
 
-        self._resource_records = collections.defaultdict(list)
+        # zones are shared by every instance using the same credentials
+        self.zones = get_zone_index(access_key_id, client)
+        self._resource_records = {}
+        self._zone_locks = collections.defaultdict(threading.Lock)
+        self._zone_locks_lock = threading.Lock()
 
         super().__init__(**kwargs)
 
     def create_dns_record(self, domain_name, domain_dns_value):
-        print("Creating DNS TXT record: {} for domain: {}".format(domain_dns_value, domain_name))
-        challenge_domain = "_acme-challenge" + "." + domain_name + "."
-        return self._change_txt_record("UPSERT", challenge_domain, domain_dns_value)
+        return self.create_dns_records([(domain_name, domain_dns_value)])[0]
 
     def delete_dns_record(self, domain_name, domain_dns_value):
-        print("Deleting DNS TXT record: {} for domain: {}".format(domain_dns_value, domain_name))
-        challenge_domain = "_acme-challenge" + "." + domain_name + "."
-        return self._change_txt_record("DELETE", challenge_domain, domain_dns_value)
+        return self.delete_dns_records([(domain_name, domain_dns_value)])[0]
+
+    def create_dns_records(self, records):
+        for domain_name, domain_dns_value in records:
+            print("Creating DNS TXT record: {} for domain: {}".format(domain_dns_value, domain_name))
+        return self._change_txt_records("UPSERT", records)
+
+    def delete_dns_records(self, records):
+        for domain_name, domain_dns_value in records:
+            print("Deleting DNS TXT record: {} for domain: {}".format(domain_dns_value, domain_name))
+        return self._change_txt_records("DELETE", records)
 
     def _find_zone_id_for_domain(self, domain):
         """Find the zone id responsible a given FQDN.
            That is, the id for the zone whose name is the longest parent of the
            domain.
         """
-        paginator = self.r53.get_paginator("list_hosted_zones")
-        zones = []
-        target_labels = domain.rstrip(".").split(".")
-        for page in paginator.paginate():
-            for zone in page["HostedZones"]:
-                if zone["Config"]["PrivateZone"]:
-                    continue
-
-                candidate_labels = zone["Name"].rstrip(".").split(".")
-                if candidate_labels == target_labels[-len(candidate_labels) :]:
-                    zones.append((zone["Name"], zone["Id"]))
-
-        if not zones:
+        zone_id = self.zones.find(self.r53, domain)
+        if zone_id is None:
             raise RuntimeError("Unable to find a Route53 hosted zone for {0}".format(domain))
+        return zone_id
 
-        # Order the zones that are suffixes for our desired to domain by
-        # length, this puts them in an order like:
-        # ["foo.bar.baz.com", "bar.baz.com", "baz.com", "com"]
-        # And then we choose the first one, which will be the most specific.
-        zones.sort(key=lambda z: len(z[0]), reverse=True)
-        return zones[0][1]
-
-    def _change_txt_record(self, action, domain_name, domain_dns_value):
-        zone_id = self._find_zone_id_for_domain(domain_name)
+    def refresh_zones(self):
+        """Lists the hosted zones again, after zones were added or removed."""
+        self.zones.refresh(self.r53)
 
-        rrecords = self._resource_records[domain_name]
-        challenge = {"Value": '"{0}"'.format(domain_dns_value)}
+    def _txt_change(self, action, domain_name, domain_dns_values):
+        """Returns the change for a record set and the values tracked for it
+           once the change is applied. Nothing is tracked until then.
+        """
+        rrecords = self._resource_records.get(domain_name, [])
+        challenges = [{"Value": '"{0}"'.format(value)} for value in domain_dns_values]
         if action == "DELETE":
-            # Remove the record being deleted from the list of tracked records
-            rrecords.remove(challenge)
-            if rrecords:
+            # Remove the records being deleted from the list of tracked records,
+            # they may be untracked when cleaning up after a restarted process
+            tracked = [c for c in challenges if c in rrecords]
+            remaining = [r for r in rrecords if r not in tracked]
+            if remaining:
                 # Need to update instead, as we're not deleting the rrset
                 action = "UPSERT"
+                rrecords = remaining
             else:
-                # Create a new list containing the record to use with DELETE
-                rrecords = [challenge]
+                # Create a new list containing the records to use with DELETE
+                rrecords = tracked or challenges
         else:
-            rrecords.append(challenge)
-
-        response = self.r53.change_resource_record_sets(
-            HostedZoneId=zone_id,
-            ChangeBatch={
-                "Comment": "certbot-dns-route53 certificate validation " + action,
-                "Changes": [
-                    {
-                        "Action": action,
-                        "ResourceRecordSet": {
-                            "Name": domain_name,
-                            "Type": "TXT",
-                            "TTL": self.ttl,
-                            "ResourceRecords": rrecords,
-                        },
-                    }
-                ],
+            remaining = rrecords + [c for c in challenges if c not in rrecords]
+            rrecords = remaining
+
+        return {
+            "Action": action,
+            "ResourceRecordSet": {
+                "Name": domain_name,
+                "Type": "TXT",
+                "TTL": self.ttl,
+                "ResourceRecords": list(rrecords),
             },
-        )
-        return response["ChangeInfo"]["Id"]
-    
-    def wait_for_change(self, change_id):
-        """Wait for a change to be propagated to all Route53 DNS servers.
+        }, remaining
+
+    def _change_txt_records(self, action, records):
+        """Changes the challenge TXT records of several domains with one
+           ChangeBatch per hosted zone. Values for the same name, like those of
+           a domain and its wildcard, go into one record set. In alias mode
+           all records are in the alias zone and go into a single batch.
+           Returns the change ids, one per zone.
+        """
+        names = collections.OrderedDict()
+        for domain_name, domain_dns_value in records:
+            challenge_domain = self.challenge_name(domain_name)
+            names.setdefault(challenge_domain, []).append(domain_dns_value)
+
+        zones = collections.OrderedDict()
+        for challenge_domain in names:
+            zone_id = self._find_zone_id_for_domain(challenge_domain)
+            zones.setdefault(zone_id, []).append(challenge_domain)
+
+        change_ids = []
+        for zone_id, zone_names in zones.items():
+            # record sets are read, changed and written back under the lock of
+            # their zone, so concurrent orders never overwrite each other's values
+            with self._zone_lock(zone_id):
+                for i in range(0, len(zone_names), self.max_batch_changes):
+                    batch = zone_names[i:i + self.max_batch_changes]
+                    changes = [self._txt_change(action, name, names[name]) for name in batch]
+                    response = self.r53.change_resource_record_sets(
+                        HostedZoneId=zone_id,
+                        ChangeBatch={
+                            "Comment": "certbot-dns-route53 certificate validation " + action,
+                            "Changes": [change for change, _ in changes],
+                        },
+                    )
+                    # only track what Route53 accepted, a failed change leaves
+                    # the record sets as they were
+                    for name, (_, remaining) in zip(batch, changes):
+                        if remaining:
+                            self._resource_records[name] = remaining
+                        else:
+                            self._resource_records.pop(name, None)
+                    change_ids.append(response["ChangeInfo"]["Id"])
+        return change_ids
+
+    def _zone_lock(self, zone_id):
+        with self._zone_locks_lock:
+            return self._zone_locks[zone_id]
+
+    def change_propagated(self, change_id):
+        """Whether a change has propagated to all Route53 DNS servers.
            https://docs.aws.amazon.com/Route53/latest/APIReference/API_GetChange.html
         """
-        for unused_n in range(0, 120):
-            response = self.r53.get_change(Id=change_id)
-            if response["ChangeInfo"]["Status"] == "INSYNC":
-                return
-            time.sleep(5)
-        raise PluginError(
-            "Timed out waiting for Route53 change. Current status: %s" %
-            response["ChangeInfo"]["Status"])
+        response = self.r53.get_change(Id=change_id)
+        return response["ChangeInfo"]["Status"] == "INSYNC"
+
+    def wait_for_change(self, change_id):
+        """Wait for a change to be propagated to all Route53 DNS servers."""
+        self.wait_for_changes([change_id])
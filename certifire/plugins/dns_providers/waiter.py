@@ -0,0 +1,117 @@
+import threading
+import time
+
+from certifire import config
+from certifire.errors import PluginError
+
+_waiter = None
+_waiter_lock = threading.Lock()
+
+
+class _Change:
+    __slots__ = ('provider', 'change_id', 'delay', 'next_poll', 'waiters', 'error', 'event')
+
+    def __init__(self, provider, change_id, delay):
+        self.provider = provider
+        self.change_id = change_id
+        self.delay = delay
+        self.next_poll = time.monotonic() + delay
+        self.waiters = 0
+        self.error = None
+        self.event = threading.Event()
+
+
+class ChangeWaiter:
+    """
+    Waits for DNS changes to propagate. Every change id waited on in the
+    process is polled by one background thread, each with its own
+    exponential backoff, so waiting on many changes takes as long as the
+    slowest of them. A change waited on by several orders is polled once.
+    """
+
+    def __init__(self, interval=None, max_interval=None):
+        self.interval = config.DNS_CHANGE_POLL_INTERVAL if interval is None else interval
+        self.max_interval = config.DNS_CHANGE_POLL_MAX_INTERVAL if max_interval is None \
+            else max_interval
+        self._changes = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+    def wait(self, provider, change_ids, timeout=None):
+        """
+        Blocks until all changes have propagated, polling them through
+        provider.change_propagated. Raises PluginError after timeout seconds.
+        """
+        timeout = config.DNS_CHANGE_TIMEOUT if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            changes = []
+            for change_id in change_ids:
+                key = (type(provider).__name__, change_id)
+                change = self._changes.get(key)
+                if change is None:
+                    change = self._changes[key] = _Change(provider, change_id, self.interval)
+                change.waiters += 1
+                changes.append(change)
+            if changes and self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='certifire-dns-changes',
+                                                daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+
+        try:
+            for change in changes:
+                if not change.event.wait(max(0, deadline - time.monotonic())):
+                    raise PluginError("Timed out waiting for DNS change {} after {} seconds".format(
+                        change.change_id, timeout))
+                if change.error is not None:
+                    raise change.error
+        finally:
+            with self._lock:
+                for change in changes:
+                    change.waiters -= 1
+                    key = (type(change.provider).__name__, change.change_id)
+                    if change.waiters <= 0 and self._changes.get(key) is change:
+                        del self._changes[key]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._changes:
+                    self._thread = None
+                    return
+                now = time.monotonic()
+                due = [(key, change) for key, change in self._changes.items()
+                       if change.next_poll <= now]
+                if not due:
+                    self._wakeup.wait(min(c.next_poll for c in self._changes.values()) - now)
+                    continue
+
+            for key, change in due:
+                try:
+                    done = change.provider.change_propagated(change.change_id)
+                except Exception as e:
+                    change.error = e
+                    done = True
+                with self._lock:
+                    if done:
+                        if self._changes.get(key) is change:
+                            del self._changes[key]
+                        change.event.set()
+                    else:
+                        change.delay = min(change.delay * 2, self.max_interval)
+                        change.next_poll = time.monotonic() + change.delay
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._changes)
+
+
+def get_change_waiter() -> ChangeWaiter:
+    global _waiter
+    with _waiter_lock:
+        if _waiter is None:
+            _waiter = ChangeWaiter()
+        return _waiter
@@ -1,9 +1,15 @@
+import logging
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import _app_ctx_stack, has_app_context
+from flask import _app_ctx_stack, current_app, has_app_context
+
+from certifire.errors import BacklogFull
 
 APP_CONTEXT_ERROR = 'Running outside of Flask AppContext.'
 
+logger = logging.getLogger(__name__)
+
 class AppContextThread(threading.Thread):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -17,3 +23,94 @@ class AppContextThread(threading.Thread):
             super().run()
         finally:
             self.app_ctx.pop()
+
+
+class AppContextExecutor:
+    """
+    Fixed size thread pool that runs every submitted callable inside a fresh
+    AppContext of the submitting Flask app.
+
+    At most max_workers callables run at once and at most max_backlog wait
+    for a free worker, anything beyond that is rejected with BacklogFull
+    instead of piling up in memory.
+    """
+
+    def __init__(self, max_workers, max_backlog=0, thread_name_prefix='certifire'):
+        self.max_workers = max_workers
+        self.max_backlog = max_backlog
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix=thread_name_prefix)
+        self._slots = threading.BoundedSemaphore(max_workers + max_backlog)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self.closed = False
+
+    def submit(self, fn, *args, **kwargs):
+        if not has_app_context():
+            raise RuntimeError(APP_CONTEXT_ERROR)
+        app = current_app._get_current_object()
+
+        if not self._slots.acquire(blocking=False):
+            raise BacklogFull(self.max_backlog)
+        with self._lock:
+            self._queued += 1
+
+        try:
+            return self._executor.submit(self._run, app, fn, *args, **kwargs)
+        except RuntimeError:
+            # executor already shut down
+            with self._lock:
+                self._queued -= 1
+            self._slots.release()
+            raise
+
+    def _run(self, app, fn, *args, **kwargs):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        failed = False
+        try:
+            with app.app_context():
+                return fn(*args, **kwargs)
+        except BaseException:
+            failed = True
+            logger.exception("Task {} failed".format(getattr(fn, '__qualname__', fn)))
+            raise
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+                if failed:
+                    self._failed += 1
+            self._slots.release()
+
+    @property
+    def free_slots(self):
+        with self._lock:
+            return self.max_workers + self.max_backlog - self._queued - self._running
+
+    @property
+    def idle_workers(self):
+        with self._lock:
+            if self.closed:
+                return 0
+            return max(self.max_workers - self._queued - self._running, 0)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'max_backlog': self.max_backlog,
+                'running': self._running,
+                'queued': self._queued,
+                'completed': self._completed,
+                'failed': self._failed,
+            }
+
+    def shutdown(self, wait=True):
+        self.closed = True
+        self._executor.shutdown(wait=wait)
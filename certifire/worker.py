@@ -0,0 +1,89 @@
+import argparse
+import logging
+import signal
+import sys
+import threading
+
+from certifire import app, config, db, get_version
+from certifire.plugins.acme.jobs import (dispatch, get_issuance_pool, resume,
+                                         shutdown_issuance_pool)
+from certifire.plugins.acme.keypool import get_key_pool
+
+logger = logging.getLogger(__name__)
+
+DESCRIPTION = \
+    """
+Certifire issuance worker {}.
+
+Claims queued orders from the database and issues their certificates.
+Run as many workers on as many machines as needed, pointed at the same
+database. Jobs are claimed with row level locks, so no order is issued twice.
+
+Set ISSUANCE_EMBEDDED_WORKER=false on the API servers to leave all issuance
+to the workers.
+""".format(get_version())
+
+
+class Formatter(argparse.ArgumentDefaultsHelpFormatter,
+                argparse.RawDescriptionHelpFormatter):
+    pass
+
+
+def run(name, poll_interval, once=False):
+    stop = threading.Event()
+
+    def _stop(signum, frame):
+        logger.info("Received signal {}, finishing running jobs".format(signum))
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    get_key_pool().refill()
+    with app.app_context():
+        logger.info("Worker {} started with {} threads".format(
+            name, get_issuance_pool().max_workers))
+        resume(name)
+        while not stop.is_set():
+            try:
+                dispatch(name)
+            except Exception as e:
+                logger.exception(e)
+                db.session.rollback()
+            if once:
+                break
+            stop.wait(poll_interval)
+
+    shutdown_issuance_pool(wait=True)
+    logger.info("Worker {} stopped".format(name))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=DESCRIPTION,
+        formatter_class=Formatter,
+    )
+    parser.add_argument('--name', '-n', default=config.ISSUANCE_WORKER_NAME,
+                        help="Worker name, unique per process, in-flight jobs of a "
+                             "worker with the same name are resumed on start")
+    parser.add_argument('--concurrency', '-c', type=int, default=config.ISSUANCE_WORKERS,
+                        help="Number of orders issued in parallel")
+    parser.add_argument('--poll-interval', '-i', type=int, default=config.ISSUANCE_POLL_INTERVAL,
+                        help="Seconds between polls for new jobs")
+    parser.add_argument('--once', action='store_true',
+                        help="Claim one round of jobs, wait for them and exit")
+    args = parser.parse_args()
+
+    root = logging.getLogger('certifire')
+    root.setLevel(logging.INFO)
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(threadName)s %(message)s"))
+    root.addHandler(handler)
+
+    # the pool is sized from the config when first created
+    config.ISSUANCE_WORKERS = args.concurrency
+    run(args.name, args.poll_interval, args.once)
+
+
+if __name__ == "__main__":
+    main()
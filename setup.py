@@ -66,6 +66,10 @@ setup(
         'console_scripts': [
             "certifire = certifire.cli:certifire_main",
             "certifire-manager = certifire.manage:main",
+            "certifire-worker = certifire.worker:main",
+        ],
+        'certifire.dns_providers': [
+            "route53 = certifire.plugins.dns_providers.route53:Route53Dns",
         ],
     },
 )
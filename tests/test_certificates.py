@@ -0,0 +1,201 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.x509 import NameOID
+
+from certifire import create_app, database, db, users
+from certifire.plugins.acme import crypto
+from certifire.plugins.acme.models import Certificate, Intermediate
+from certifire.plugins.acme.plugin import (backfill_certificate_metadata,
+                                           convert_certificate_storage,
+                                           dedupe_intermediates)
+
+
+def make_certificate(domains, key_type='ECCPRIME256V1', issuer_key=None, issuer_name=None):
+    key = crypto.generate_private_key(key_type)
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domains[0])])
+    now = datetime.utcnow().replace(microsecond=0)
+    cert = x509.CertificateBuilder().subject_name(subject).issuer_name(
+        issuer_name or subject
+    ).public_key(key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(
+        now
+    ).not_valid_after(now + timedelta(days=90)).add_extension(
+        x509.SubjectAlternativeName([x509.DNSName(d) for d in domains]), critical=False
+    ).sign(issuer_key or key, hashes.SHA256(), default_backend())
+    return cert, key
+
+
+class TestCertificateMetadata(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        database.add(users.User('admin', 'admin', True))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_load_metadata(self):
+        cert, key = make_certificate(['certifire.xyz', 'www.certifire.xyz'])
+        cert_db = Certificate(body=crypto.export_pem_certificate(cert).decode('utf-8'),
+                              status='valid', user_id=1)
+        cert_db.load_metadata()
+
+        self.assertEqual(cert_db.serial, format(cert.serial_number, 'x'))
+        self.assertEqual(cert_db.issuer, 'CN=certifire.xyz')
+        self.assertEqual(cert_db.not_after, cert.not_valid_after)
+        self.assertEqual(cert_db.key_type, 'ECCPRIME256V1')
+        self.assertEqual(cert_db.domains, ['certifire.xyz', 'www.certifire.xyz'])
+
+    def test_backfill(self):
+        for domain in ('a.certifire.xyz', 'b.certifire.xyz', 'c.certifire.xyz'):
+            cert, key = make_certificate([domain])
+            database.add(Certificate(body=crypto.export_pem_certificate(cert).decode('utf-8'),
+                                     status='valid', user_id=1))
+        database.add(Certificate(body='not a certificate', status='valid', user_id=1))
+
+        self.assertEqual(backfill_certificate_metadata(batch_size=2), 3)
+        expiring = Certificate.query.filter(
+            Certificate.not_after < datetime.utcnow() + timedelta(days=91)).count()
+        self.assertEqual(expiring, 3)
+
+
+class TestIntermediates(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        database.add(users.User('admin', 'admin', True))
+        ca, self.ca_key = make_certificate(['Certifire Test CA'])
+        self.ca_name = ca.subject
+        self.ca_pem = crypto.export_pem_certificate(ca).decode('utf-8')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def leaf(self, domain):
+        cert, key = make_certificate([domain], issuer_key=self.ca_key, issuer_name=self.ca_name)
+        return crypto.export_pem_certificate(cert).decode('utf-8')
+
+    def test_shared_intermediate(self):
+        for domain in ('a.certifire.xyz', 'b.certifire.xyz'):
+            cert_db = Certificate(body=self.leaf(domain), status='valid', user_id=1)
+            cert_db.set_intermediates([self.ca_pem])
+            database.add(cert_db)
+
+        self.assertEqual(Intermediate.query.count(), 1)
+        for cert_db in Certificate.query.all():
+            self.assertEqual(cert_db.intermediate, self.ca_pem)
+            self.assertEqual(cert_db.chain, cert_db.body + self.ca_pem)
+            self.assertIsNone(cert_db._chain)
+
+    def test_dedupe_legacy_rows(self):
+        for domain in ('a.certifire.xyz', 'b.certifire.xyz'):
+            body = self.leaf(domain)
+            database.add(Certificate(body=body, _intermediate=self.ca_pem,
+                                     _chain=body + self.ca_pem, status='valid', user_id=1))
+        legacy = Certificate.query.first()
+        self.assertEqual(legacy.chain, legacy.body + self.ca_pem)
+
+        self.assertEqual(dedupe_intermediates(batch_size=1), 2)
+        self.assertEqual(Intermediate.query.count(), 1)
+        for cert_db in Certificate.query.all():
+            self.assertIsNone(cert_db._intermediate)
+            self.assertIsNone(cert_db._chain)
+            self.assertEqual(cert_db.chain, cert_db.body + self.ca_pem)
+
+    def test_dedupe_keeps_custom_chain(self):
+        crlf = self.leaf('a.certifire.xyz')
+        custom = self.leaf('b.certifire.xyz')
+        database.add(Certificate(body=crlf, _intermediate=self.ca_pem, status='valid', user_id=1,
+                                 _chain=(crlf + self.ca_pem).replace('\n', '\r\n')))
+        database.add(Certificate(body=custom, _intermediate=self.ca_pem, status='valid',
+                                 user_id=1, _chain=custom + self.ca_pem + self.ca_pem))
+
+        self.assertEqual(dedupe_intermediates(), 2)
+        crlf_db, custom_db = Certificate.query.order_by(Certificate.id).all()
+        # only formatting differs, the legacy copy is dropped
+        self.assertIsNone(crlf_db._chain)
+        self.assertEqual(crlf_db.chain, crlf + self.ca_pem)
+        self.assertEqual(custom_db.chain, custom + self.ca_pem + self.ca_pem)
+
+
+class TestCompactStorage(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        database.add(users.User('admin', 'admin', True))
+        cert, key = make_certificate(['certifire.xyz'])
+        self.body = crypto.export_pem_certificate(cert).decode('utf-8')
+        self.key = crypto.export_private_key(key).decode('utf-8')
+        self.csr, _ = crypto.create_csr({'domains': ['certifire.xyz'], 'owner': 'admin@certifire.xyz',
+                                         'key_type': 'ECCPRIME256V1'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def certificate(self):
+        return Certificate(body=self.body, csr=self.csr, private_key=self.key,
+                           status='valid', user_id=1)
+
+    def assertPem(self, cert_db):
+        self.assertEqual(cert_db.body, self.body)
+        self.assertEqual(cert_db.csr, self.csr)
+        self.assertEqual(cert_db.private_key, self.key)
+
+    @patch("certifire.plugins.acme.models.config.COMPACT_STORAGE", True)
+    def test_stores_der(self):
+        database.add(self.certificate())
+        db.session.expire_all()
+
+        cert_db = Certificate.query.one()
+        self.assertIsNone(cert_db._body)
+        self.assertIsNone(cert_db._private_key)
+        self.assertLess(len(cert_db.body_der), len(self.body))
+        self.assertPem(cert_db)
+        self.assertEqual(Certificate.query.filter(Certificate.body.isnot_none()).count(), 1)
+
+    @patch("certifire.plugins.acme.models.config.COMPACT_STORAGE", True)
+    def test_keeps_text_that_is_not_a_single_block(self):
+        cert_db = Certificate(body=self.body + self.body, status='valid', user_id=1)
+        self.assertIsNone(cert_db.body_der)
+        self.assertEqual(cert_db.body, self.body + self.body)
+
+    def test_convert(self):
+        database.add(self.certificate())
+        cert_db = Certificate.query.one()
+        cert_db.set_intermediates([self.body])
+        database.commit()
+
+        with patch("certifire.plugins.acme.models.config.COMPACT_STORAGE", True):
+            self.assertEqual(convert_certificate_storage(batch_size=1), 2)
+            self.assertEqual(convert_certificate_storage(), 0)
+        db.session.expire_all()
+        cert_db = Certificate.query.one()
+        self.assertIsNone(cert_db._csr)
+        self.assertIsNotNone(Intermediate.query.one().body_der)
+        self.assertPem(cert_db)
+
+        self.assertEqual(convert_certificate_storage(), 2)
+        db.session.expire_all()
+        cert_db = Certificate.query.one()
+        self.assertIsNone(cert_db.private_key_der)
+        self.assertPem(cert_db)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import json
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import josepy as jose
+
+from certifire.plugins.acme import client, crypto
+from certifire.plugins.acme.cache import account_key_cache, get_account_key
+
+
+def make_account(account_id, key=None):
+    key = key or crypto.generate_rsa_key(2048)
+    return SimpleNamespace(
+        id=account_id,
+        key=crypto.export_private_key(key).decode("utf-8"),
+        contents=json.dumps({'body': {}, 'uri': 'https://ca/acct/{}'.format(account_id)}),
+        directory_uri='https://ca/directory')
+
+
+@patch("certifire.plugins.acme.client.config.ACME_NONCE_POOL_SIZE", 0)
+@patch("certifire.plugins.acme.client.BackwardsCompatibleClientV2")
+class TestClientCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.key = crypto.generate_rsa_key(2048)
+
+    def setUp(self):
+        client.clear_acme_clients()
+        account_key_cache.clear()
+
+    def test_client_is_reused(self, mock_client):
+        account = make_account(1, self.key)
+        key, acme = client.get_acme_client(account)
+        self.assertEqual(client.get_acme_client(account), (key, acme))
+        mock_client.assert_called_once()
+
+    def test_shared_between_threads(self, mock_client):
+        mock_client.side_effect = lambda net, key, directory: MagicMock()
+        account = make_account(1, self.key)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(client.get_acme_client(account)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len({id(acme) for key, acme in results}), 1)
+
+    def test_key_change_rebuilds(self, mock_client):
+        account = make_account(1, self.key)
+        client.get_acme_client(account)
+        rotated = make_account(1)
+        client.get_acme_client(rotated)
+        self.assertEqual(mock_client.call_count, 2)
+
+    def test_invalidate(self, mock_client):
+        account = make_account(1, self.key)
+        client.get_acme_client(account)
+        client.invalidate_acme_client(account.id)
+        client.get_acme_client(account)
+        self.assertEqual(mock_client.call_count, 2)
+
+
+class TestAccountKeyCache(unittest.TestCase):
+    def setUp(self):
+        account_key_cache.clear()
+
+    @patch("certifire.plugins.acme.cache.crypto.load_private_key",
+           wraps=crypto.load_private_key)
+    def test_key_parsed_once(self, mock_load):
+        account = make_account(1)
+        first = get_account_key(account)
+        self.assertIs(get_account_key(account), first)
+        mock_load.assert_called_once()
+        self.assertEqual(first.thumbprint, crypto.generate_jwk_thumbprint(first.key))
+
+    def test_key_change(self):
+        account = make_account(1)
+        first = get_account_key(account)
+        account.key = make_account(1).key
+        self.assertNotEqual(get_account_key(account).thumbprint, first.thumbprint)
+
+    def test_invalidate_with_client(self):
+        account = make_account(1)
+        get_account_key(account)
+        client.invalidate_acme_client(account.id)
+        self.assertEqual(len(account_key_cache), 0)
+
+
+@patch.object(client.NoncePool, "refill_async")
+class TestNoncePool(unittest.TestCase):
+    def setUp(self):
+        self.pool = client.NoncePool('https://ca/new-nonce', size=4, max_age=60)
+
+    def test_hits_and_misses(self, mock_refill):
+        self.assertIsNone(self.pool.get())
+        self.pool.add(b'one')
+        self.pool.add(b'two')
+        self.assertEqual(self.pool.get(), b'two')
+        self.assertEqual(self.pool.stats, {'size': 1, 'hits': 1, 'misses': 1})
+        mock_refill.assert_called()
+
+    def test_bounded(self, mock_refill):
+        for i in range(10):
+            self.pool.add(str(i).encode())
+        self.assertEqual(self.pool.stats['size'], 4)
+        self.assertEqual(self.pool.get(), b'9')
+
+    def test_old_nonces_are_dropped(self, mock_refill):
+        self.pool.max_age = 0
+        self.pool.add(b'stale')
+        self.assertIsNone(self.pool.get())
+
+    def test_network_uses_pool(self, mock_refill):
+        key = jose.JWKRSA(key=crypto.generate_rsa_key(2048))
+        net = client.ThreadSafeClientNetwork(key)
+        net.nonce_pool = self.pool
+        self.pool.add(b'pooled')
+        self.assertEqual(net._get_nonce('https://ca/order', 'https://ca/new-nonce'), b'pooled')
+
+        response = MagicMock(headers={'Replay-Nonce': jose.b64encode(b'fresh').decode()})
+        net._add_nonce(response)
+        self.assertEqual(self.pool.get(), b'fresh')
+
+
+if __name__ == "__main__":
+    unittest.main()
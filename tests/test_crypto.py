@@ -0,0 +1,113 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509 import NameOID
+
+from certifire.plugins.acme import crypto
+
+
+def make_chain(length):
+    certificates = []
+    issuer_key = issuer_name = None
+    for i in reversed(range(length)):
+        key = crypto.generate_private_key('ECCPRIME256V1')
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'cert{}.certifire.xyz'.format(i))])
+        now = datetime.utcnow()
+        cert = x509.CertificateBuilder().subject_name(name).issuer_name(
+            issuer_name or name
+        ).public_key(key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(
+            now
+        ).not_valid_after(now + timedelta(days=90)).sign(issuer_key or key, hashes.SHA256(),
+                                                        default_backend())
+        certificates.insert(0, cert)
+        issuer_key, issuer_name = key, name
+    return certificates
+
+
+class TestKeyTypes(unittest.TestCase):
+    def test_generate_private_key(self):
+        for key_type in ('RSA2048', 'ECCPRIME256V1', 'ECCSECP384R1'):
+            key = crypto.generate_private_key(key_type)
+            self.assertEqual(crypto.get_key_type(key), key_type)
+            self.assertEqual(crypto.get_key_type(key.public_key()), key_type)
+
+    def test_unsupported_key_type(self):
+        with self.assertRaises(ValueError):
+            crypto.generate_private_key('DSA1024')
+
+    def test_ec_csr(self):
+        csr_pem, key_pem = crypto.create_csr({
+            'domains': ['certifire.xyz', 'www.certifire.xyz'],
+            'owner': 'admin@certifire.xyz',
+            'key_type': 'ECCPRIME256V1',
+        })
+        csr = crypto.load_csr(csr_pem.encode('utf-8'))
+        self.assertEqual(crypto.get_key_type(csr.public_key()), 'ECCPRIME256V1')
+        self.assertEqual(crypto.get_key_type(crypto.load_private_key(key_pem.encode('utf-8'))),
+                         'ECCPRIME256V1')
+
+
+class TestDer(unittest.TestCase):
+    def test_private_key_round_trip(self):
+        for key_type in ('RSA2048', 'ECCPRIME256V1'):
+            pem = crypto.export_private_key(crypto.generate_private_key(key_type)).decode('ascii')
+            der = crypto.pem_to_der(pem)
+            self.assertEqual(crypto.der_to_pem(der, crypto.private_key_label(der)), pem)
+
+    def test_rejects_bundles(self):
+        pem = crypto.export_pem_certificate(make_chain(1)[0]).decode('ascii')
+        self.assertEqual(crypto.der_to_pem(crypto.pem_to_der(pem, 'CERTIFICATE'), 'CERTIFICATE'), pem)
+        with self.assertRaises(ValueError):
+            crypto.pem_to_der(pem + pem)
+        with self.assertRaises(ValueError):
+            crypto.pem_to_der(pem, 'CERTIFICATE REQUEST')
+
+
+@patch("certifire.plugins.acme.crypto.config.IDENTRUST_CROSS_SIGNED_LE_ICA", None)
+class TestSplitCertificates(unittest.TestCase):
+    def setUp(self):
+        self.chain = make_chain(3)
+        self.pems = [crypto.export_pem_certificate(c).decode('ascii') for c in self.chain]
+
+    def test_split_fullchain(self):
+        (pem, leaf), chain = crypto.split_fullchain(''.join(self.pems))
+        self.assertEqual(pem, self.pems[0])
+        self.assertEqual(leaf, self.chain[0])
+        self.assertEqual([p for p, _ in chain], self.pems[1:])
+        self.assertEqual([c for _, c in chain], self.chain[1:])
+
+    def test_crlf_and_blank_lines(self):
+        fullchain = '\r\n'.join(pem.replace('\n', '\r\n') for pem in self.pems)
+        certificates = crypto.split_certificates(fullchain.encode('ascii'))
+        self.assertEqual([pem for pem, _ in certificates], self.pems)
+
+    def test_der(self):
+        data = b''.join(c.public_bytes(Encoding.DER) for c in self.chain)
+        certificates = crypto.split_certificates(data)
+        self.assertEqual([pem for pem, _ in certificates], self.pems)
+
+    def test_truncated_der(self):
+        der = self.chain[0].public_bytes(Encoding.DER)
+        for data in (b'\x30', der + b'\x30', der + b'\x30\x82\x01'):
+            with self.assertRaises(ValueError):
+                crypto.split_certificates(data)
+
+    def test_extract_cert_and_chain(self):
+        pem, chain = crypto.extract_cert_and_chain(''.join(self.pems))
+        self.assertEqual(pem, self.pems[0])
+        self.assertEqual(chain, ''.join(self.pems[1:]))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            crypto.split_fullchain('')
+        with self.assertRaises(ValueError):
+            crypto.split_certificates(self.pems[0][:-30])
+
+
+if __name__ == "__main__":
+    unittest.main()
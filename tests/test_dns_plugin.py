@@ -0,0 +1,92 @@
+import os
+import subprocess
+import sys
+import threading
+import unittest
+from unittest import mock
+
+from certifire.errors import UnknownProvider
+from certifire.plugins.dns_providers.common import BaseDns
+from certifire.plugins.dns_providers.plugin import clear_dns_providers, get_dns_provider
+
+
+class FakeDns(BaseDns):
+    def __init__(self, **kwargs):
+        super().__init__()
+        self.kwargs = kwargs
+
+
+@mock.patch("certifire.plugins.dns_providers.route53.boto3.client")
+class TestDnsProviderRegistry(unittest.TestCase):
+    def setUp(self):
+        clear_dns_providers()
+
+    def tearDown(self):
+        clear_dns_providers()
+
+    def test_instances_are_reused(self, mock_client):
+        dns = get_dns_provider("route53")
+        self.assertIs(get_dns_provider("route53"), dns)
+        mock_client.assert_called_once()
+
+        other = get_dns_provider("route53", access_key_id="key", secret_access_key="secret")
+        self.assertIsNot(other, dns)
+        self.assertIs(get_dns_provider("route53", secret_access_key="secret",
+                                       access_key_id="key"), other)
+
+    def test_shared_between_threads(self, mock_client):
+        providers = []
+        threads = [threading.Thread(target=lambda: providers.append(get_dns_provider("route53")))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, providers))), 1)
+        mock_client.assert_called_once()
+
+    def test_pool_size(self, mock_client):
+        with mock.patch("certifire.plugins.dns_providers.route53.config.ROUTE53_MAX_POOL_CONNECTIONS", 7):
+            dns = get_dns_provider("route53")
+        self.assertEqual(dns.aws_config.max_pool_connections, 7)
+
+    def test_unknown_provider(self, mock_client):
+        with self.assertRaises(UnknownProvider):
+            get_dns_provider("nope")
+        with mock.patch("certifire.plugins.dns_providers.plugin.config.VALID_DNS_PROVIDERS",
+                        ["route53", "nope"]):
+            with self.assertRaises(UnknownProvider):
+                get_dns_provider("nope")
+
+    @mock.patch("certifire.plugins.dns_providers.plugin.config.VALID_DNS_PROVIDERS",
+                ["route53", "fake"])
+    @mock.patch("certifire.plugins.dns_providers.plugin._find_entry_point")
+    def test_entry_point_provider(self, mock_entry_point, mock_client):
+        mock_entry_point.return_value.load.return_value = FakeDns
+        dns = get_dns_provider("fake", token="secret")
+        self.assertIsInstance(dns, FakeDns)
+        self.assertEqual(dns.kwargs, {"token": "secret"})
+        mock_entry_point.assert_called_once_with("fake")
+
+    @mock.patch("certifire.plugins.dns_providers.plugin.config.VALID_DNS_PROVIDERS", ["fake"])
+    def test_disabled_provider(self, mock_client):
+        with self.assertRaises(UnknownProvider):
+            get_dns_provider("route53")
+
+
+class TestLazyImport(unittest.TestCase):
+    def test_boto3_not_imported_at_startup(self):
+        code = ("import sys, certifire.cli, certifire.plugins.acme.handlers; "
+                "print('boto3' in sys.modules)")
+        output = subprocess.check_output([sys.executable, "-c", code], text=True)
+        self.assertEqual(output.strip().splitlines()[-1], "False")
+
+    def test_valid_providers_are_stripped(self):
+        code = "from certifire import config; print(','.join(config.VALID_DNS_PROVIDERS))"
+        env = dict(os.environ, VALID_DNS_PROVIDERS="route53, mydns,")
+        output = subprocess.check_output([sys.executable, "-c", code], text=True, env=env)
+        self.assertEqual(output.strip().splitlines()[-1], "route53,mydns")
+
+
+if __name__ == "__main__":
+    unittest.main()
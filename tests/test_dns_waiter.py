@@ -0,0 +1,67 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from certifire.errors import PluginError
+from certifire.plugins.dns_providers.common import BaseDns
+from certifire.plugins.dns_providers.waiter import ChangeWaiter
+
+
+class FakeDns(BaseDns):
+    def __init__(self, polls):
+        super().__init__()
+        self.polls = dict(polls)
+        self.calls = []
+
+    def change_propagated(self, change_id):
+        self.calls.append(change_id)
+        self.polls[change_id] -= 1
+        return self.polls[change_id] <= 0
+
+
+class TestChangeWaiter(unittest.TestCase):
+    def setUp(self):
+        self.waiter = ChangeWaiter(interval=0.05, max_interval=0.2)
+
+    def test_waits_for_all_changes_concurrently(self):
+        dns = FakeDns({'a': 3, 'b': 3, 'c': 1})
+        start = time.monotonic()
+        self.waiter.wait(dns, ['a', 'b', 'c'], timeout=5)
+
+        # 0.05 + 0.1 + 0.2, not three times that
+        self.assertLess(time.monotonic() - start, 0.6)
+        self.assertEqual(dns.calls.count('a'), 3)
+        self.assertEqual(dns.calls.count('c'), 1)
+        self.assertEqual(self.waiter.pending, 0)
+
+    def test_shared_change_is_polled_once(self):
+        dns = FakeDns({'a': 2})
+        threads = [threading.Thread(target=self.waiter.wait, args=(dns, ['a'], 5))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(dns.calls, ['a', 'a'])
+
+    def test_timeout(self):
+        dns = FakeDns({'a': 1000})
+        with self.assertRaises(PluginError):
+            self.waiter.wait(dns, ['a'], timeout=0.3)
+        self.assertEqual(self.waiter.pending, 0)
+
+    def test_error(self):
+        dns = FakeDns({})
+        with self.assertRaises(KeyError):
+            self.waiter.wait(dns, ['a'], timeout=5)
+
+    def test_legacy_provider(self):
+        dns = BaseDns()
+        dns.wait_for_change = MagicMock()
+        dns.wait_for_changes(['a', 'b'])
+        self.assertEqual(dns.wait_for_change.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
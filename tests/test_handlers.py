@@ -0,0 +1,237 @@
+import datetime
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+from acme import errors, messages
+
+from certifire.plugins.acme.cache import authorization_cache
+from certifire.plugins.acme.handlers import AcmeHandler, AcmeHttpHandler
+
+
+def authzr(url, status, expires=None):
+    return messages.AuthorizationResource(
+        uri=url, body=messages.Authorization(status=status, expires=expires))
+
+
+class TestAcmeHandler(unittest.TestCase):
+    def setUp(self):
+        authorization_cache.clear()
+        self.handler = AcmeHandler.__new__(AcmeHandler)
+        self.handler.account_uri = 'https://ca/acct/1'
+        self.handler.client = MagicMock()
+        self.handler.client.retry_after.side_effect = \
+            lambda response, default: datetime.datetime.now() + datetime.timedelta(seconds=0.2)
+        self.statuses = {}
+        self.handler.client._post_as_get.side_effect = \
+            lambda url: MagicMock(headers={'Retry-After': '1'})
+        self.handler.client._authzr_from_response.side_effect = \
+            lambda url, uri: authzr(uri, self.statuses[uri].pop(0))
+
+    def orderr(self, *urls):
+        return messages.OrderResource(body=messages.Order(authorizations=list(urls)))
+
+    def test_polls_authorizations_in_parallel(self):
+        urls = ['https://ca/authz/{}'.format(i) for i in range(5)]
+        for url in urls:
+            self.statuses[url] = [messages.STATUS_PENDING] * 3 + [messages.STATUS_VALID]
+
+        start = time.monotonic()
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=10)
+        orderr = self.handler.poll_authorizations(self.orderr(*urls), deadline)
+
+        # three polls of 0.2s each, not fifteen
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual([a.uri for a in orderr.authorizations], urls)
+
+    def test_invalid_authorization(self):
+        self.statuses['a'] = [messages.STATUS_VALID]
+        self.statuses['b'] = [messages.STATUS_INVALID]
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=10)
+        with self.assertRaises(errors.ValidationError):
+            self.handler.poll_authorizations(self.orderr('a', 'b'), deadline)
+
+    def test_shared_deadline(self):
+        self.statuses['a'] = [messages.STATUS_PENDING] * 100
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=0.5)
+        with self.assertRaises(errors.TimeoutError):
+            self.handler.poll_authorizations(self.orderr('a'), deadline)
+
+    def test_polls_do_not_hold_pool_threads(self):
+        self.statuses['a'] = [messages.STATUS_PENDING] * 3 + [messages.STATUS_VALID]
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=10)
+        pool = ThreadPoolExecutor(max_workers=1)
+        with patch("certifire.plugins.acme.handlers.get_acme_pool", return_value=pool):
+            poller = threading.Thread(target=self.handler.poll_authorizations,
+                                      args=(self.orderr('a'), deadline))
+            poller.start()
+            time.sleep(0.1)
+            # the only pool thread is free while the poll waits
+            pool.submit(lambda: None).result(timeout=0.1)
+            poller.join()
+        pool.shutdown()
+        self.assertEqual(self.statuses['a'], [])
+
+    def test_last_poll_before_deadline(self):
+        self.handler.client.retry_after.side_effect = \
+            lambda response, default: datetime.datetime.now() + datetime.timedelta(seconds=60)
+        self.statuses['a'] = [messages.STATUS_PENDING, messages.STATUS_VALID]
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=0.3)
+
+        start = time.monotonic()
+        orderr = self.handler.poll_authorizations(self.orderr('a'), deadline)
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(orderr.authorizations[0].body.status, messages.STATUS_VALID)
+
+    @patch("certifire.plugins.acme.handlers.config.ACME_POLL_INTERVAL", 1)
+    @patch("certifire.plugins.acme.handlers.config.ACME_POLL_MAX_INTERVAL", 8)
+    def test_backoff_without_retry_after(self):
+        response = MagicMock(headers={})
+        for attempt in range(6):
+            wait = self.handler.next_poll(response, attempt)
+            self.assertGreaterEqual(wait, 1)
+            self.assertLessEqual(wait, min(2 ** attempt, 8))
+
+    @patch("certifire.plugins.acme.handlers.config.FINALIZE_TIMEOUT", 60)
+    @patch("certifire.plugins.acme.handlers.config.FINALIZE_TIMEOUT_PER_DOMAIN", 10)
+    @patch("certifire.plugins.acme.handlers.config.FINALIZE_MAX_TIMEOUT", 300)
+    def test_finalize_deadline(self):
+        now = datetime.datetime.now()
+        small = self.handler.finalize_deadline(self.orderr('a', 'b'))
+        large = self.handler.finalize_deadline(self.orderr(*range(100)))
+        self.assertAlmostEqual((small - now).total_seconds(), 80, delta=1)
+        self.assertAlmostEqual((large - now).total_seconds(), 300, delta=1)
+
+    @patch("certifire.plugins.acme.handlers.jose.ComparableX509")
+    @patch("certifire.plugins.acme.handlers.OpenSSL.crypto.load_certificate_request")
+    def test_finalize_order_honours_retry_after(self, mock_csr, mock_request):
+        orders = [{'status': 'processing'}, {'status': 'processing'},
+                  {'status': 'valid', 'certificate': 'https://ca/cert'}]
+        responses = [MagicMock(headers={'Retry-After': '1'}, **{'json.return_value': body})
+                     for body in orders]
+        self.handler.client._post.return_value = responses[0]
+        self.handler.client._post_as_get.side_effect = responses[1:] + [MagicMock(text='pem')]
+
+        orderr = messages.OrderResource(uri='https://ca/order', csr_pem=b'csr',
+                                        body=messages.Order(finalize='https://ca/finalize'))
+        final_order, processing_time = self.handler.finalize_order(
+            orderr, datetime.datetime.now() + datetime.timedelta(seconds=10))
+
+        self.assertEqual(final_order.fullchain_pem, 'pem')
+        self.assertEqual(self.handler.client.retry_after.call_count, 2)
+        self.assertGreater(processing_time, 0.3)
+
+    @patch("certifire.plugins.acme.handlers.jose.ComparableX509")
+    @patch("certifire.plugins.acme.handlers.OpenSSL.crypto.load_certificate_request")
+    def test_finalize_order_polls_before_deadline(self, mock_csr, mock_request):
+        self.handler.client.retry_after.side_effect = \
+            lambda response, default: datetime.datetime.now() + datetime.timedelta(seconds=60)
+        processing = MagicMock(headers={'Retry-After': '60'},
+                               **{'json.return_value': {'status': 'processing'}})
+        valid = MagicMock(headers={}, **{'json.return_value': {
+            'status': 'valid', 'certificate': 'https://ca/cert'}})
+        self.handler.client._post.return_value = processing
+        self.handler.client._post_as_get.side_effect = [valid, MagicMock(text='pem')]
+
+        orderr = messages.OrderResource(uri='https://ca/order', csr_pem=b'csr',
+                                        body=messages.Order(finalize='https://ca/finalize'))
+        start = time.monotonic()
+        final_order, _ = self.handler.finalize_order(
+            orderr, datetime.datetime.now() + datetime.timedelta(seconds=0.5))
+        self.assertEqual(final_order.fullchain_pem, 'pem')
+        self.assertLess(time.monotonic() - start, 2)
+
+        # still processing at the deadline
+        self.handler.client._post_as_get.side_effect = [processing]
+        with self.assertRaises(errors.TimeoutError):
+            self.handler.finalize_order(
+                orderr, datetime.datetime.now() + datetime.timedelta(seconds=0.2))
+
+    def test_valid_authorizations_are_cached(self):
+        expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=30)
+        self.handler.client._authzr_from_response.side_effect = \
+            lambda response, uri: authzr(uri, messages.STATUS_VALID, expires)
+
+        first = self.handler.get_authorization('a')
+        self.assertIs(self.handler.get_authorization('a'), first)
+        self.assertEqual(self.handler.client._post_as_get.call_count, 1)
+
+        # another account never sees it
+        self.handler.account_uri = 'https://ca/acct/2'
+        self.handler.get_authorization('a')
+        self.assertEqual(self.handler.client._post_as_get.call_count, 2)
+
+    def test_expiring_authorizations_are_not_cached(self):
+        expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=10)
+        self.handler.client._authzr_from_response.side_effect = \
+            lambda response, uri: authzr(uri, messages.STATUS_VALID, expires)
+
+        self.handler.get_authorization('a')
+        self.handler.get_authorization('a')
+        self.assertEqual(self.handler.client._post_as_get.call_count, 2)
+
+    def test_answers_challenges_concurrently(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def answer(domain, challenge, response):
+            # only returns once all three answers are in flight
+            barrier.wait()
+            return domain
+
+        self.handler.key = MagicMock()
+        self.handler.verify_challenge = lambda domain, challenge, response: True
+        self.handler.answer_challenge = answer
+        answered = self.handler.answer_challenges(
+            {'a': MagicMock(), 'b': MagicMock(), 'c': MagicMock()})
+        self.assertEqual(answered, ['a', 'b', 'c'])
+
+    def test_answer_does_not_wait_for_other_probes(self):
+        fast_answered = threading.Event()
+        threads = []
+        served = []
+
+        def verify(domain, challenge, response):
+            threads.append(threading.current_thread().name)
+            if domain == 'slow':
+                # only served once the fast domain has been answered
+                served.append(fast_answered.wait(5))
+                return served[-1]
+            return True
+
+        def answer(domain, challenge, response):
+            if domain == 'fast':
+                fast_answered.set()
+            return domain
+
+        self.handler.key = MagicMock()
+        self.handler.verify_challenge = verify
+        self.handler.answer_challenge = answer
+        answered = self.handler.answer_challenges({'slow': MagicMock(), 'fast': MagicMock()})
+        self.assertEqual(answered, ['slow', 'fast'])
+        self.assertEqual(served, [True])
+        self.assertTrue(all(name.startswith('certifire-probe') for name in threads))
+
+
+class TestAcmeHttpHandler(unittest.TestCase):
+    def setUp(self):
+        self.handler = AcmeHttpHandler.__new__(AcmeHttpHandler)
+        self.handler.probe_token = MagicMock()
+
+    def test_waits_until_token_is_served(self):
+        self.handler.probe_token.side_effect = [False, False, True]
+        self.assertTrue(self.handler.verify_challenge('certifire.xyz', None, None))
+        self.assertEqual(self.handler.probe_token.call_count, 3)
+
+    @patch("certifire.plugins.acme.handlers.config.HTTP01_PROBE_TIMEOUT", 1)
+    def test_probe_timeout(self):
+        self.handler.probe_token.return_value = False
+        start = time.monotonic()
+        self.assertFalse(self.handler.verify_challenge('certifire.xyz', None, None))
+        self.assertLess(time.monotonic() - start, 1.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509 import NameOID
+
+from certifire import create_app, database, db, users
+from certifire.plugins.acme import crypto
+from certifire.plugins.acme.importer import import_certificates
+from certifire.plugins.acme.models import Certificate, Intermediate
+
+
+def make_certificate(name, issuer=None, ca=False, days=90, key=None, authority_key_id=False):
+    key = key or crypto.generate_private_key('ECCPRIME256V1')
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+    issuer_cert, issuer_key = issuer or (None, key)
+    now = datetime.utcnow().replace(microsecond=0)
+    builder = x509.CertificateBuilder()
+    if authority_key_id:
+        builder = builder.add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(
+            issuer_key.public_key()), critical=False)
+    cert = builder.subject_name(subject).issuer_name(
+        issuer_cert.subject if issuer_cert else subject
+    ).public_key(key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(
+        now - timedelta(days=1)
+    ).not_valid_after(now + timedelta(days=days)).add_extension(
+        x509.BasicConstraints(ca=ca, path_length=None), critical=True
+    ).add_extension(
+        x509.SubjectAlternativeName([x509.DNSName(name)]), critical=False
+    ).sign(issuer_key, hashes.SHA256(), default_backend())
+    return cert, key
+
+
+def pem(cert):
+    return crypto.export_pem_certificate(cert).decode('ascii')
+
+
+def key_pem(key):
+    return crypto.export_private_key(key).decode('ascii')
+
+
+class TestImportCertificates(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        database.add(users.User('admin', 'admin', True))
+        self.dir = tempfile.mkdtemp()
+
+        self.root = make_certificate('Root CA', ca=True)
+        self.intermediate = make_certificate('Intermediate CA', self.root, ca=True)
+        self.leaves = [make_certificate('{}.certifire.xyz'.format(name), self.intermediate)
+                       for name in ('a', 'b', 'c', 'd')]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+
+    def write_estate(self):
+        (a, a_key), (b, b_key), (c, c_key), (d, _) = self.leaves
+        # full bundle with key, chain and root
+        self.write('a/bundle.pem', key_pem(a_key) + pem(a) + pem(self.intermediate[0])
+                   + pem(self.root[0]))
+        # certificate and key in separate files, CRLF line endings
+        self.write('b/cert.crt', pem(b).replace('\n', '\r\n'))
+        self.write('keys/b.key', key_pem(b_key))
+        # DER certificate, key elsewhere
+        self.write('c/cert.der', c.public_bytes(Encoding.DER))
+        self.write('keys/c.key', key_pem(c_key))
+        # certificate without key
+        self.write('d/cert.pem', pem(d))
+        self.write('junk.txt', 'not a certificate')
+
+    def test_import_directory(self):
+        self.write_estate()
+        summary = import_certificates(1, [self.dir], workers=0, batch_size=2)
+
+        self.assertEqual(summary['files'], 7)
+        self.assertEqual(summary['imported'], 4)
+        self.assertEqual(summary['without_key'], 1)
+        self.assertEqual(len(summary['errors']), 1)
+        self.assertEqual(Intermediate.query.count(), 1)
+
+        for cert, key in self.leaves[:3]:
+            cert_db = Certificate.query.filter_by(
+                fingerprint=crypto.get_certificate_fingerprint(cert)).one()
+            self.assertEqual(cert_db.body, pem(cert))
+            self.assertEqual(cert_db.private_key, key_pem(key))
+            self.assertEqual(cert_db.intermediate, pem(self.intermediate[0]))
+            self.assertEqual(cert_db.domains, [cert.subject.rfc4514_string()[3:]])
+            self.assertEqual(cert_db.not_after, cert.not_valid_after)
+            self.assertEqual(cert_db.status, 'valid')
+            self.assertEqual(cert_db.user_id, 1)
+        self.assertIsNone(Certificate.query.filter_by(san='d.certifire.xyz').one().private_key)
+
+    def test_import_is_idempotent(self):
+        self.write_estate()
+        import_certificates(1, [self.dir], workers=0)
+        summary = import_certificates(1, [self.dir], workers=0)
+        self.assertEqual(summary['imported'], 0)
+        self.assertEqual(summary['duplicates'], 4)
+        self.assertEqual(Certificate.query.count(), 4)
+
+    def test_import_bundles_in_process_pool(self):
+        expired = make_certificate('old.certifire.xyz', self.intermediate, days=-1)
+        bundles = [pem(cert) + key_pem(key) for cert, key in self.leaves + [expired]]
+        bundles.append(pem(self.intermediate[0]))
+
+        summary = import_certificates(1, bundles=bundles, workers=2)
+        self.assertEqual(summary['imported'], 5)
+        self.assertEqual(summary['without_key'], 0)
+        self.assertEqual(Certificate.query.filter_by(status='expired').count(), 1)
+
+    def test_import_cross_signed_intermediates(self):
+        other_root = make_certificate('Other Root CA', ca=True)
+        # the same intermediate key signed by both roots, and a rekeyed
+        # intermediate with the same name
+        cross_signed = make_certificate('Intermediate CA', other_root, ca=True,
+                                        key=self.intermediate[1])
+        rekeyed = make_certificate('Intermediate CA', other_root, ca=True)
+        leaves = [make_certificate('{}.certifire.xyz'.format(name), issuer,
+                                   authority_key_id=authority_key_id)
+                  for name, issuer, authority_key_id in (
+                      ('e', self.intermediate, True), ('f', self.intermediate, False),
+                      ('g', rekeyed, True), ('h', rekeyed, False))]
+        bundles = [pem(cert) for cert, _ in leaves]
+        bundles.append(''.join(pem(cert) for cert, _ in (
+            rekeyed, self.intermediate, cross_signed, self.root, other_root)))
+
+        summary = import_certificates(1, bundles=bundles, workers=0)
+        self.assertEqual(summary['imported'], 4)
+
+        for (cert, _), intermediate in zip(leaves, (self.intermediate, self.intermediate,
+                                                    rekeyed, rekeyed)):
+            cert_db = Certificate.query.filter_by(
+                fingerprint=crypto.get_certificate_fingerprint(cert)).one()
+            self.assertEqual(cert_db.intermediate_fingerprints,
+                             crypto.get_certificate_fingerprint(intermediate[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
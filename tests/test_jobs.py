@@ -0,0 +1,224 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+from certifire import config, create_app, database, db, users
+from certifire.errors import BacklogFull
+from certifire.plugins.acme import jobs
+from certifire.plugins.acme.models import Account, Job, Order
+from certifire.thread import AppContextExecutor
+
+
+class TestJobs(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        database.add(users.User('admin', 'admin', True))
+        account = Account(1, 'admin@certifire.xyz')
+        database.add(account)
+        self.order = Order(None, ['certifire.xyz'], 'dns', 'route53', account.id,
+                           hash='hash', csr='csr')
+        database.add(self.order)
+
+    def tearDown(self):
+        jobs._issuance_pool = None
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_enqueue_is_idempotent(self):
+        job = jobs.enqueue(self.order.id, dispatch_now=False)
+        again = jobs.enqueue(self.order.id, reissue=True, dispatch_now=False)
+        self.assertEqual(job.id, again.id)
+        self.assertTrue(Job.query.get(job.id).reissue)
+        self.assertEqual(jobs.backlog()['queued'], 1)
+
+    def test_claim_only_once(self):
+        job = jobs.enqueue(self.order.id, dispatch_now=False)
+        self.assertTrue(jobs.claim(job.id, 'worker-a'))
+        self.assertFalse(jobs.claim(job.id, 'worker-b'))
+
+        job = Job.query.get(job.id)
+        self.assertEqual(job.status, 'running')
+        self.assertEqual(job.worker, 'worker-a')
+        self.assertEqual(job.attempts, 1)
+
+    def test_claim_next_skips_running_hash(self):
+        duplicate = Order(None, ['certifire.xyz'], 'dns', 'route53',
+                          self.order.account_id, hash='hash')
+        other = Order(None, ['www.certifire.xyz'], 'dns', 'route53',
+                      self.order.account_id, hash='hash2')
+        database.add(duplicate)
+        database.add(other)
+        first = jobs.enqueue(self.order.id, dispatch_now=False)
+        second = jobs.enqueue(duplicate.id, dispatch_now=False)
+        third = jobs.enqueue(other.id, dispatch_now=False)
+
+        self.assertEqual(jobs.claim_next(5, 'worker-a'), [first.id, third.id])
+        self.assertEqual(jobs.claim_next(5, 'worker-b'), [])
+
+        first = Job.query.get(first.id)
+        first.status = 'done'
+        database.add(first)
+        self.assertEqual(jobs.claim_next(5, 'worker-b'), [second.id])
+        self.assertEqual(Job.query.get(second.id).worker, 'worker-b')
+
+    @patch("certifire.plugins.acme.jobs.get_handler")
+    def test_run_job(self, mock_handler):
+        job = jobs.enqueue(self.order.id, dispatch_now=False)
+        jobs.claim(job.id)
+        jobs.run_job(job.id)
+
+        mock_handler.return_value.create_order.assert_called_once_with(
+            'csr', 'route53', self.order.id, None, False)
+        self.assertEqual(Job.query.get(job.id).status, 'done')
+
+    @patch("certifire.plugins.acme.jobs.get_handler")
+    def test_run_job_failure_backs_off(self, mock_handler):
+        mock_handler.return_value.create_order.side_effect = RuntimeError("CA down")
+        job = jobs.enqueue(self.order.id, dispatch_now=False)
+        jobs.claim(job.id)
+        with self.assertRaises(RuntimeError):
+            jobs.run_job(job.id)
+
+        job = Job.query.get(job.id)
+        self.assertEqual(job.status, 'queued')
+        self.assertIn('CA down', job.error)
+        self.assertGreater(job.run_after, datetime.utcnow())
+        # not picked up again before the backoff expires
+        self.assertEqual(jobs.dispatch(), 0)
+
+        job.attempts = config.ISSUANCE_MAX_ATTEMPTS - 1
+        job.run_after = datetime.utcnow()
+        database.add(job)
+        jobs.claim(job.id)
+        with self.assertRaises(RuntimeError):
+            jobs.run_job(job.id)
+        self.assertEqual(Job.query.get(job.id).status, 'failed')
+
+    def test_dispatch_returns_unsubmitted_jobs(self):
+        other = Order(None, ['www.certifire.xyz'], 'dns', 'route53',
+                      self.order.account_id, hash='hash2')
+        database.add(other)
+        first = jobs.enqueue(self.order.id, dispatch_now=False)
+        second = jobs.enqueue(other.id, dispatch_now=False)
+
+        pool = jobs._issuance_pool = AppContextExecutor(2)
+        jobs._issuance_pool_pid = os.getpid()
+        with patch.object(pool, 'submit', side_effect=[None, BacklogFull(0)]):
+            self.assertEqual(jobs.dispatch(), 1)
+
+        db.session.expire_all()
+        self.assertEqual(Job.query.get(first.id).status, 'running')
+        second = Job.query.get(second.id)
+        self.assertEqual(second.status, 'queued')
+        self.assertEqual(second.attempts, 0)
+        pool.shutdown()
+
+    @patch("certifire.plugins.acme.jobs.get_handler")
+    def test_shutdown_drains(self, mock_handler):
+        started, release = threading.Event(), threading.Event()
+
+        def create_order(*args):
+            started.set()
+            release.wait(5)
+
+        mock_handler.return_value.create_order.side_effect = create_order
+        other = Order(None, ['www.certifire.xyz'], 'dns', 'route53',
+                      self.order.account_id, hash='hash2')
+        database.add(other)
+        first = jobs.enqueue(self.order.id, dispatch_now=False)
+        second = jobs.enqueue(other.id, dispatch_now=False)
+
+        pool = jobs._issuance_pool = AppContextExecutor(1)
+        jobs._issuance_pool_pid = os.getpid()
+        self.assertEqual(jobs.dispatch(), 1)
+        self.assertTrue(started.wait(5))
+
+        shutdown = threading.Thread(target=jobs.shutdown_issuance_pool)
+        shutdown.start()
+        while not pool.closed:
+            time.sleep(0.01)
+        release.set()
+        shutdown.join(5)
+
+        db.session.expire_all()
+        self.assertEqual(Job.query.get(first.id).status, 'done')
+        # the finishing job did not claim the next one
+        self.assertEqual(Job.query.get(second.id).status, 'queued')
+        self.assertIs(jobs.get_issuance_pool(), pool)
+        self.assertEqual(jobs.dispatch(), 0)
+
+    @patch("certifire.plugins.acme.jobs.get_dns_provider")
+    def test_clear_stale_challenges_in_one_batch(self, mock_provider):
+        self.order.contents = '{}'
+        acme = MagicMock()
+        acme.get_pending_challenges.return_value = {
+            domain: MagicMock(**{'validation.return_value': domain + '-value'})
+            for domain in ('a.certifire.xyz', 'b.certifire.xyz')}
+        dns = mock_provider.return_value
+
+        jobs.clear_stale_challenges(acme, self.order)
+        dns.delete_dns_records.assert_called_once_with([('a.certifire.xyz', 'a.certifire.xyz-value'),
+                                                        ('b.certifire.xyz', 'b.certifire.xyz-value')])
+        dns.delete_dns_record.assert_not_called()
+
+        # falls back to single deletes when the batch fails
+        dns.delete_dns_records.side_effect = RuntimeError("record not found")
+        dns.delete_dns_record.side_effect = [RuntimeError("record not found"), None]
+        jobs.clear_stale_challenges(acme, self.order)
+        self.assertEqual(dns.delete_dns_record.call_count, 2)
+
+    def test_resume(self):
+        own = jobs.enqueue(self.order.id, dispatch_now=False)
+        jobs.claim(own.id, config.ISSUANCE_WORKER_NAME)
+
+        other_order = Order(None, ['www.certifire.xyz'], 'dns', 'route53',
+                            self.order.account_id, hash='hash2')
+        database.add(other_order)
+        other = jobs.enqueue(other_order.id, dispatch_now=False)
+        jobs.claim(other.id, 'some-other-node')
+
+        with patch("certifire.plugins.acme.jobs.dispatch") as mock_dispatch:
+            jobs.resume()
+            mock_dispatch.assert_called_once()
+
+        self.assertEqual(Job.query.get(own.id).status, 'queued')
+        self.assertEqual(Job.query.get(other.id).status, 'running')
+
+        # a lease that ran out is taken over from any node
+        other = Job.query.get(other.id)
+        other.started_at = datetime.utcnow() - timedelta(seconds=config.ISSUANCE_JOB_TIMEOUT + 1)
+        database.add(other)
+        with patch("certifire.plugins.acme.jobs.dispatch"):
+            jobs.resume()
+        self.assertEqual(Job.query.get(other.id).status, 'queued')
+
+    def test_workers_sharing_a_host(self):
+        code = "from certifire import config; print(config.ISSUANCE_WORKER_NAME)"
+        env = {k: v for k, v in os.environ.items() if k != 'ISSUANCE_WORKER_NAME'}
+        names = [subprocess.check_output([sys.executable, "-c", code], text=True,
+                                         env=env).strip().splitlines()[-1] for _ in range(2)]
+        self.assertNotEqual(names[0], names[1])
+        self.assertEqual(names[0].split(':')[0], socket.gethostname())
+
+        job = jobs.enqueue(self.order.id, dispatch_now=False)
+        jobs.claim(job.id, names[0])
+        # the other process restarting leaves the running job alone
+        with patch("certifire.plugins.acme.jobs.dispatch"):
+            jobs.resume(names[1])
+        job = Job.query.get(job.id)
+        self.assertEqual(job.status, 'running')
+        self.assertEqual(job.worker, names[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
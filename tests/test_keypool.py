@@ -0,0 +1,66 @@
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+
+from certifire.plugins.acme import crypto
+from certifire.plugins.acme.keypool import KeyPool
+
+
+class TestKeyPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = KeyPool(key_type='RSA2048', watermark=2, workers=1)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def wait_for(self, size, timeout=60):
+        deadline = time.monotonic() + timeout
+        while self.pool.stats['size'] < size and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    def test_refills_to_watermark(self):
+        self.pool.refill()
+        self.wait_for(2)
+        self.assertEqual(self.pool.stats['size'], 2)
+
+        key = self.pool.get()
+        self.assertIsInstance(key, RSAPrivateKey)
+        self.assertEqual(key.key_size, 2048)
+        self.assertEqual(self.pool.stats['hits'], 1)
+
+        # taking a key starts generating its replacement
+        self.wait_for(2)
+        self.assertEqual(self.pool.stats['size'], 2)
+
+    def test_miss_generates_a_key(self):
+        key = self.pool.get()
+        self.assertEqual(key.key_size, 2048)
+        self.assertEqual(self.pool.stats['misses'], 1)
+
+    def test_miss_is_generated_before_refill(self):
+        pem = crypto.export_private_key(crypto.generate_private_key('ECCPRIME256V1'))
+        futures = []
+
+        def submit(fn, key_type):
+            futures.append(MagicMock(**{'result.return_value': pem}))
+            return futures[-1]
+
+        executor = MagicMock(**{'submit.side_effect': submit})
+        with patch.object(self.pool, '_get_executor', return_value=executor):
+            self.pool.get()
+
+        # the key of the miss is queued first, then the refill
+        self.assertEqual(len(futures), 3)
+        futures[0].result.assert_called_once()
+        futures[1].result.assert_not_called()
+
+    def test_inline_without_watermark(self):
+        pool = KeyPool(key_type='RSA2048', watermark=0)
+        self.assertEqual(pool.get().key_size, 2048)
+        self.assertIsNone(pool._executor)
+
+
+if __name__ == "__main__":
+    unittest.main()
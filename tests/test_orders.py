@@ -0,0 +1,196 @@
+import base64
+import unittest
+from unittest.mock import patch
+
+from certifire import create_app, database, db, users
+from certifire.config import TestingConfig
+from certifire.plugins.acme import crypto
+from certifire.plugins.acme.models import Account, Job, Order
+from certifire.plugins.acme.plugin import create_order, create_orders
+from certifire.plugins.destinations.models import Destination
+
+
+@patch("certifire.plugins.acme.jobs.dispatch")
+@patch("certifire.plugins.acme.plugin.crypto.create_csr", return_value=('csr', 'key'))
+@patch("certifire.plugins.acme.plugin.get_key_pool")
+class TestBatchOrders(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        database.add(users.User('admin', 'admin', True))
+        database.add(users.User('other', 'other'))
+        self.account = Account(1, 'admin@certifire.xyz')
+        database.add(self.account)
+        self.foreign_account = Account(2, 'other@certifire.xyz')
+        database.add(self.foreign_account)
+        self.destination = Destination(1, 'dest.certifire.xyz')
+        database.add(self.destination)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_batch(self, mock_key_pool, mock_csr, mock_dispatch):
+        results = create_orders(1, [
+            {'account': self.account.id, 'domains': ['a.certifire.xyz']},
+            {'account': self.account.id, 'domains': ['b.certifire.xyz'],
+             'destination': self.destination.id},
+            {'account': self.account.id, 'domains': ['a.certifire.xyz']},
+            {'account': self.foreign_account.id, 'domains': ['c.certifire.xyz']},
+            {'account': self.account.id, 'domains': ['d.certifire.xyz'], 'provider': 'nope'},
+            {'account': self.account.id},
+        ])
+
+        self.assertTrue(results[0]['created'])
+        self.assertTrue(results[1]['created'])
+        self.assertEqual(results[2], {'id': results[0]['id'], 'created': False})
+        self.assertIn('error', results[3])
+        self.assertIn('error', results[4])
+        self.assertIn('error', results[5])
+
+        order = Order.query.get(results[1]['id'])
+        self.assertEqual(order.domains, 'dest.certifire.xyz,b.certifire.xyz')
+        self.assertEqual(order.destination_id, self.destination.id)
+        self.assertEqual(mock_csr.call_count, 2)
+
+        self.assertEqual(Job.query.filter_by(status='queued').count(), 2)
+        mock_dispatch.assert_called_once()
+
+    def test_batch_invalid_domains(self, mock_key_pool, mock_csr, mock_dispatch):
+        results = create_orders(1, [
+            {'account': self.account.id, 'domains': 'a.certifire.xyz'},
+            {'account': self.account.id, 'domains': ['b.certifire.xyz']},
+            {'account': self.account.id, 'domains': ['c.certifire.xyz', 3]},
+            {'account': self.account.id, 'domains': ['bücher.certifire.xyz']},
+            {'account': self.account.id, 'domains': ['{}.certifire.xyz'.format('x' * 64)]},
+        ])
+
+        self.assertIn('error', results[0])
+        self.assertTrue(results[1]['created'])
+        self.assertIn('error', results[2])
+        self.assertTrue(results[3]['created'])
+        self.assertIn('error', results[4])
+        order = Order.query.get(results[3]['id'])
+        self.assertEqual(order.domains, 'xn--bcher-kva.certifire.xyz')
+
+    def test_batch_existing_order(self, mock_key_pool, mock_csr, mock_dispatch):
+        first = create_orders(1, [{'account': self.account.id, 'domains': ['a.certifire.xyz']}])
+        again = create_orders(1, [{'account': self.account.id, 'domains': ['a.certifire.xyz'],
+                                   'reissue': True}])
+
+        self.assertEqual(again, [{'id': first[0]['id'], 'created': False}])
+        self.assertEqual(Order.query.count(), 1)
+        job = Job.query.one()
+        self.assertTrue(job.reissue)
+
+    def test_batch_key_types(self, mock_key_pool, mock_csr, mock_dispatch):
+        self.account.key_type = 'ECCPRIME256V1'
+        database.add(self.account)
+        results = create_orders(1, [
+            {'account': self.account.id, 'domains': ['a.certifire.xyz']},
+            {'account': self.account.id, 'domains': ['a.certifire.xyz'], 'key_type': 'RSA2048'},
+            {'account': self.account.id, 'domains': ['a.certifire.xyz'], 'key_type': 'RSA1024'},
+        ])
+
+        self.assertEqual(Order.query.get(results[0]['id']).key_type, 'ECCPRIME256V1')
+        self.assertEqual(Order.query.get(results[1]['id']).key_type, 'RSA2048')
+        self.assertIn('error', results[2])
+        mock_key_pool.assert_any_call('ECCPRIME256V1')
+        mock_key_pool.assert_any_call('RSA2048')
+
+
+@patch("certifire.plugins.acme.jobs.dispatch")
+@patch("certifire.plugins.acme.plugin.AcmeDnsHandler")
+class TestCreateOrder(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        database.add(users.User('admin', 'admin', True))
+        self.account = Account(1, 'admin@certifire.xyz')
+        database.add(self.account)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_key_type_of_supplied_csr(self, mock_handler, mock_dispatch):
+        key = crypto.generate_private_key('ECCPRIME256V1')
+        csr, _ = crypto.create_csr({'domains': ['a.certifire.xyz'],
+                                    'owner': 'admin@certifire.xyz'}, key)
+        csr = csr.decode('utf-8') if isinstance(csr, bytes) else csr
+
+        created, order_id = create_order(self.account.id, domains=['a.certifire.xyz'],
+                                         csr=csr, key_type='RSA2048')
+        self.assertTrue(created)
+        self.assertEqual(Order.query.get(order_id).key_type, 'ECCPRIME256V1')
+        mock_handler.return_value.generate_csr.assert_not_called()
+
+        # the same csr finds the existing order
+        created, again = create_order(self.account.id, domains=['a.certifire.xyz'], csr=csr)
+        self.assertFalse(created)
+        self.assertEqual(again, order_id)
+
+    def test_invalid_csr(self, mock_handler, mock_dispatch):
+        self.assertEqual(create_order(self.account.id, domains=['a.certifire.xyz'], csr='junk'),
+                         (False, 0))
+
+
+@patch("certifire.plugins.acme.jobs.dispatch")
+@patch("certifire.plugins.acme.plugin.AcmeDnsHandler")
+class TestOrderViews(unittest.TestCase):
+    """
+    The acme views are registered on the global app, pointed at the testing
+    database here.
+    """
+
+    def setUp(self):
+        from certifire import app
+        from certifire.plugins.acme import views  # noqa: F401 registers the routes
+        self.app = app
+        self.uri = app.config['SQLALCHEMY_DATABASE_URI']
+        app.config['SQLALCHEMY_DATABASE_URI'] = TestingConfig.SQLALCHEMY_DATABASE_URI
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.create_all()
+        database.add(users.User('admin', 'admin', True))
+        self.account = Account(1, 'admin@certifire.xyz')
+        database.add(self.account)
+        self.headers = {'Authorization': 'Basic ' + base64.b64encode(b'admin:admin').decode()}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = self.uri
+
+    def test_order_with_key_and_csr(self, mock_handler, mock_dispatch):
+        key = crypto.generate_private_key('ECCPRIME256V1')
+        csr, key_pem = crypto.create_csr({'domains': ['a.certifire.xyz'],
+                                          'owner': 'admin@certifire.xyz'}, key)
+        response = self.app.test_client().post('/api/order', headers=self.headers, json={
+            'account': self.account.id, 'domains': ['a.certifire.xyz'], 'csr': csr, 'key': key_pem})
+        self.assertEqual(response.status_code, 201)
+
+        order = Order.query.get(response.json['id'])
+        self.assertEqual(order.csr, csr)
+        self.assertEqual(order.key, key_pem)
+        self.assertEqual(order.key_type, 'ECCPRIME256V1')
+
+        # a key alone signs a new CSR
+        mock_handler.return_value.generate_csr.return_value = ('csr', key_pem)
+        response = self.app.test_client().post('/api/order', headers=self.headers, json={
+            'account': self.account.id, 'domains': ['b.certifire.xyz'], 'key': key_pem})
+        self.assertEqual(response.status_code, 201)
+        mock_handler.return_value.generate_csr.assert_called_once()
+        self.assertEqual(crypto.export_private_key(
+            mock_handler.return_value.generate_csr.call_args[0][8]).decode(), key_pem)
+
+
+if __name__ == "__main__":
+    unittest.main()
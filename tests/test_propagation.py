@@ -0,0 +1,162 @@
+import socket
+import threading
+import unittest
+from unittest.mock import patch
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+from certifire.errors import PluginError
+from certifire.plugins.dns_providers.common import BaseDns, dns_challenge
+from certifire.plugins.dns_providers.propagation import PropagationChecker
+
+
+class StubDnsServer:
+    """
+    Authoritative server for example.com on a local UDP port, serving the
+    TXT records in txt.
+    """
+
+    zone = dns.name.from_text("example.com.")
+
+    def __init__(self):
+        self.txt = {}
+        self.cname = {}
+        self.extra_ns = []
+        self.queries = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def records(self, name, rdtype):
+        if name == self.zone and rdtype == dns.rdatatype.SOA:
+            return ["ns1.example.com. admin.example.com. 1 3600 600 86400 60"]
+        if name == self.zone and rdtype == dns.rdatatype.NS:
+            return ["ns1.example.com."] + self.extra_ns
+        if name == dns.name.from_text("ns1.example.com.") and rdtype == dns.rdatatype.A:
+            return ["127.0.0.1"]
+        if name.to_text() in self.cname:
+            return []
+        if rdtype == dns.rdatatype.TXT:
+            return ['"{}"'.format(v) for v in self.txt.get(name.to_text(), [])]
+        return []
+
+    def serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            query = dns.message.from_wire(data)
+            question = query.question[0]
+            self.queries.append((question.name.to_text(), question.rdtype))
+            response = dns.message.make_response(query)
+            response.flags |= dns.flags.AA
+            if not question.name.is_subdomain(self.zone):
+                response.set_rcode(dns.rcode.REFUSED)
+            elif question.name.to_text() in self.cname:
+                response.answer.append(dns.rrset.from_text(
+                    question.name, 60, "IN", "CNAME", self.cname[question.name.to_text()]))
+            else:
+                values = self.records(question.name, question.rdtype)
+                if values:
+                    response.answer.append(dns.rrset.from_text(
+                        question.name, 60, "IN", question.rdtype, *values))
+                else:
+                    response.authority.append(dns.rrset.from_text(
+                        self.zone, 60, "IN", "SOA", *self.records(self.zone, dns.rdatatype.SOA)))
+            self.sock.sendto(response.to_wire(), address)
+
+    def close(self):
+        self.sock.close()
+
+
+class TestPropagationChecker(unittest.TestCase):
+    def setUp(self):
+        self.server = StubDnsServer()
+        self.checker = PropagationChecker(resolvers=["127.0.0.1"], port=self.server.port,
+                                          timeout=2)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_nameservers(self):
+        zone, addresses = self.checker.nameservers("_acme-challenge.a.example.com.")
+        self.assertEqual(zone.to_text(), "example.com.")
+        self.assertEqual(addresses, ["127.0.0.1"])
+
+    def test_nameserver_without_address(self):
+        self.server.extra_ns = ["ns6.example.com."]
+        zone, addresses = self.checker.nameservers("_acme-challenge.a.example.com.")
+        self.assertEqual(addresses, ["127.0.0.1"])
+
+    def test_missing(self):
+        self.server.txt["_acme-challenge.a.example.com."] = ["one"]
+        records = [("_acme-challenge.a.example.com", "one"), ("_acme-challenge.a.example.com", "two"),
+                   ("_acme-challenge.b.example.com.", "three")]
+
+        missing = self.checker.missing(records)
+        self.assertEqual(sorted((name, value) for name, value, _ in missing),
+                         [("_acme-challenge.a.example.com.", "two"),
+                          ("_acme-challenge.b.example.com.", "three")])
+
+        self.server.txt["_acme-challenge.a.example.com."].append("two")
+        self.server.txt["_acme-challenge.b.example.com."] = ["three"]
+        self.assertEqual(self.checker.missing(records), [])
+
+    def test_follows_cname(self):
+        self.server.cname["_acme-challenge.a.example.com."] = "a.example.com.acme.example.com."
+        records = [("_acme-challenge.a.example.com.", "one")]
+
+        missing = self.checker.missing(records)
+        self.assertEqual([(name, value) for name, value, _ in missing], records)
+        self.assertIn("CNAME to a.example.com.acme.example.com.", missing[0][2])
+
+        self.server.txt["a.example.com.acme.example.com."] = ["one"]
+        self.assertEqual(self.checker.missing(records), [])
+
+    def test_cname_loop(self):
+        self.server.cname["_acme-challenge.a.example.com."] = "_acme-challenge.a.example.com."
+        missing = self.checker.missing([("_acme-challenge.a.example.com.", "one")])
+        self.assertEqual([(name, value) for name, value, _ in missing],
+                         [("_acme-challenge.a.example.com.", "one")])
+
+    def test_nameservers_are_cached(self):
+        self.checker.missing([("_acme-challenge.a.example.com", "one")])
+        lookups = len([q for q in self.server.queries if q[1] != dns.rdatatype.TXT])
+        self.checker.missing([("_acme-challenge.a.example.com", "one")])
+        self.assertEqual(len([q for q in self.server.queries if q[1] != dns.rdatatype.TXT]),
+                         lookups)
+
+    def test_unreachable_zone(self):
+        missing = self.checker.missing([("_acme-challenge.example.org", "one")])
+        self.assertEqual(len(missing), 1)
+        self.assertIn("no nameservers", missing[0][2])
+
+    def test_base_dns(self):
+        dns_class = BaseDns()
+        chal = {"ident_value": "a.example.com", "key_auth": "token.thumbprint"}
+        with patch("certifire.plugins.dns_providers.common.get_propagation_checker",
+                   return_value=self.checker):
+            errata = dns_class.unpropagated([chal])
+            self.assertEqual(len(errata), 1)
+            self.assertEqual(errata[0][0], "unready")
+            self.assertIs(errata[0][2], chal)
+
+            self.server.txt["_acme-challenge.a.example.com."] = [dns_challenge("token.thumbprint")]
+            self.assertEqual(dns_class.unpropagated([chal]), [])
+            dns_class.wait_for_propagation([("a.example.com", dns_challenge("token.thumbprint"))])
+
+            with patch("certifire.plugins.dns_providers.common.config.DNS_PROPAGATION_TIMEOUT", 1):
+                with self.assertRaises(PluginError):
+                    dns_class.wait_for_propagation([("b.example.com", "value")])
+
+
+if __name__ == "__main__":
+    unittest.main()
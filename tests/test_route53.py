@@ -1,7 +1,11 @@
+import gc
+import threading
 from unittest import mock
 from unittest import TestCase
 
-from certifire.plugins.dns_providers.route53 import Route53Dns
+from certifire.plugins.dns_providers.common import BaseDns
+from certifire.plugins.dns_providers import route53
+from certifire.plugins.dns_providers.route53 import Route53Dns, clear_zone_indexes
 
 
 class TestRoute53(TestCase):
@@ -9,6 +13,7 @@ class TestRoute53(TestCase):
     """
 
     def setUp(self):
+        clear_zone_indexes()
         self.domain_name = "example.com"
         self.domain_dns_value = "mock-domain_dns_value"
         self.route53_key_id = "mock-key-id"
@@ -130,4 +135,170 @@ class TestRoute53(TestCase):
         mock_client.mock_calls[4].assert_called_once_with(
             HostedZoneId="mocked-id",
             ChangeBatch=self.make_change_batch("DELETE", self.domain_name, self.domain_dns_value),
-        )
\ No newline at end of file
+        )
+
+    def zones_page(self, *names):
+        return [{"HostedZones": [{"Config": {"PrivateZone": False}, "Id": "/hostedzone/" + name,
+                                  "Name": name + "."} for name in names]}]
+
+    @mock.patch("certifire.plugins.dns_providers.route53.boto3.client")
+    def test_zone_index_longest_match(self, mock_client):
+        paginate = mock_client.return_value.get_paginator.return_value.paginate
+        paginate.return_value = self.zones_page("com", "example.com", "a.example.com")
+        dns_class = Route53Dns()
+
+        self.assertEqual(dns_class._find_zone_id_for_domain("_acme-challenge.x.a.example.com."),
+                         "/hostedzone/a.example.com")
+        self.assertEqual(dns_class._find_zone_id_for_domain("_acme-challenge.B.Example.com."),
+                         "/hostedzone/example.com")
+        self.assertEqual(dns_class._find_zone_id_for_domain("badexample.com"), "/hostedzone/com")
+
+    @mock.patch("certifire.plugins.dns_providers.route53.boto3.client")
+    def test_zone_index_shared_between_instances(self, mock_client):
+        paginate = mock_client.return_value.get_paginator.return_value.paginate
+        paginate.return_value = self.zones_page("example.com")
+        mock_client.return_value.change_resource_record_sets.return_value = (
+            self.mocked_route53_set_record_response()
+        )
+
+        for domain in ("a.example.com", "b.example.com", "c.example.com"):
+            Route53Dns().create_dns_record(domain, self.domain_dns_value)
+        paginate.assert_called_once()
+
+        Route53Dns().refresh_zones()
+        self.assertEqual(paginate.call_count, 2)
+
+    def test_zone_index_per_injected_client(self):
+        first, second = mock.MagicMock(), mock.MagicMock()
+        self.assertIs(Route53Dns(client=first).zones, Route53Dns(client=first).zones)
+        self.assertIsNot(Route53Dns(client=first).zones, Route53Dns(client=second).zones)
+
+        zones = Route53Dns(client=second).zones
+        del second
+        gc.collect()
+        # a client built later never inherits the zones of a collected one
+        self.assertNotIn(zones, list(route53._client_zone_indexes.values()))
+
+    @mock.patch("certifire.plugins.dns_providers.route53.boto3.client")
+    def test_zone_index_refreshes_on_miss(self, mock_client):
+        paginate = mock_client.return_value.get_paginator.return_value.paginate
+        paginate.side_effect = [self.zones_page("example.com"),
+                                self.zones_page("example.com", "example.org")]
+        dns_class = Route53Dns()
+        dns_class.zones.miss_interval = 0
+
+        self.assertEqual(dns_class._find_zone_id_for_domain("example.org"),
+                         "/hostedzone/example.org")
+        self.assertEqual(paginate.call_count, 2)
+
+    @mock.patch("certifire.plugins.dns_providers.route53.boto3.client")
+    def test_zone_index_miss(self, mock_client):
+        paginate = mock_client.return_value.get_paginator.return_value.paginate
+        paginate.return_value = self.zones_page("example.com")
+        dns_class = Route53Dns()
+
+        with self.assertRaises(RuntimeError):
+            dns_class._find_zone_id_for_domain("example.org")
+        with self.assertRaises(RuntimeError):
+            dns_class._find_zone_id_for_domain("example.net")
+        # a miss shortly after listing does not list again
+        paginate.assert_called_once()
+
+    @mock.patch("certifire.plugins.dns_providers.route53.boto3.client")
+    def test_change_batch_per_zone(self, mock_client):
+        paginate = mock_client.return_value.get_paginator.return_value.paginate
+        paginate.return_value = self.zones_page("example.com", "example.org")
+        change = mock_client.return_value.change_resource_record_sets
+        change.side_effect = lambda HostedZoneId, ChangeBatch: {"ChangeInfo": {"Id": HostedZoneId}}
+        dns_class = Route53Dns()
+
+        records = [("a.example.com", "a"), ("b.example.com", "b"), ("example.org", "c"),
+                   ("example.org", "d")]
+        change_ids = dns_class.create_dns_records(records)
+        self.assertEqual(change_ids, ["/hostedzone/example.com", "/hostedzone/example.org"])
+        self.assertEqual(change.call_count, 2)
+
+        batch = change.call_args_list[1][1]["ChangeBatch"]
+        self.assertEqual(len(batch["Changes"]), 1)
+        self.assertEqual(batch["Changes"][0]["ResourceRecordSet"]["ResourceRecords"],
+                         [{"Value": '"c"'}, {"Value": '"d"'}])
+
+        # deleting one of two values keeps the record set with the other
+        dns_class.delete_dns_records([("example.org", "c")])
+        upsert = change.call_args_list[2][1]["ChangeBatch"]["Changes"][0]
+        self.assertEqual(upsert["Action"], "UPSERT")
+        self.assertEqual(upsert["ResourceRecordSet"]["ResourceRecords"], [{"Value": '"d"'}])
+
+        dns_class.delete_dns_records(records)
+        changes = change.call_args_list[4][1]["ChangeBatch"]["Changes"]
+        self.assertEqual([c["Action"] for c in changes], ["DELETE"])
+        self.assertEqual(changes[0]["ResourceRecordSet"]["ResourceRecords"], [{"Value": '"d"'}])
+        self.assertEqual(change.call_count, 5)
+
+    @mock.patch("certifire.plugins.dns_providers.route53.boto3.client")
+    def test_concurrent_changes_keep_all_values(self, mock_client):
+        paginate = mock_client.return_value.get_paginator.return_value.paginate
+        paginate.return_value = self.zones_page("example.com")
+        sent = []
+
+        def change(HostedZoneId, ChangeBatch):
+            sent.append(ChangeBatch["Changes"][0]["ResourceRecordSet"]["ResourceRecords"])
+            return {"ChangeInfo": {"Id": "id"}}
+
+        mock_client.return_value.change_resource_record_sets.side_effect = change
+        dns_class = Route53Dns()
+        threads = [threading.Thread(target=dns_class.create_dns_record,
+                                    args=("example.com", str(i))) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # every write carries all values written before it
+        self.assertEqual([len(records) for records in sent], list(range(1, 21)))
+
+    @mock.patch("certifire.plugins.dns_providers.route53.boto3.client")
+    def test_alias_zone(self, mock_client):
+        paginate = mock_client.return_value.get_paginator.return_value.paginate
+        paginate.return_value = self.zones_page("example.com", "example.org", "acme.example.net")
+        change = mock_client.return_value.change_resource_record_sets
+        change.side_effect = lambda HostedZoneId, ChangeBatch: {"ChangeInfo": {"Id": HostedZoneId}}
+        dns_class = Route53Dns(alias="acme.example.net")
+
+        change_ids = dns_class.create_dns_records([("a.example.com", "a"), ("example.org", "b")])
+        self.assertEqual(change_ids, ["/hostedzone/acme.example.net"])
+        names = [c["ResourceRecordSet"]["Name"] for c in change.call_args[1]["ChangeBatch"]["Changes"]]
+        self.assertEqual(names, ["a.example.com.acme.example.net.", "example.org.acme.example.net."])
+
+    @mock.patch("certifire.plugins.dns_providers.route53.boto3.client")
+    def test_alias_zone_from_config(self, mock_client):
+        with mock.patch("certifire.plugins.dns_providers.common.config.DNS_ALIAS_ZONE",
+                        "acme.example.net."):
+            dns_class = Route53Dns()
+            # providers writing _acme-challenge names themselves keep doing so
+            self.assertEqual(BaseDns().alias, "")
+            self.assertEqual(BaseDns().challenge_name("example.com"),
+                             "_acme-challenge.example.com.")
+        with self.assertRaises(ValueError):
+            BaseDns(alias="acme.example.net")
+        self.assertEqual(dns_class.challenge_name("example.com"), "example.com.acme.example.net.")
+        self.assertEqual(Route53Dns().challenge_name("example.com"), "_acme-challenge.example.com.")
+
+    @mock.patch("certifire.plugins.dns_providers.route53.boto3.client")
+    def test_failed_change_is_not_tracked(self, mock_client):
+        paginate = mock_client.return_value.get_paginator.return_value.paginate
+        paginate.return_value = self.zones_page("example.com")
+        change = mock_client.return_value.change_resource_record_sets
+        change.side_effect = [RuntimeError("throttled"), {"ChangeInfo": {"Id": "a"}},
+                              {"ChangeInfo": {"Id": "b"}}]
+        dns_class = Route53Dns()
+
+        with self.assertRaises(RuntimeError):
+            dns_class.create_dns_record("example.com", "old")
+        dns_class.create_dns_record("example.com", "new")
+        dns_class.delete_dns_record("example.com", "new")
+
+        delete = change.call_args[1]["ChangeBatch"]["Changes"][0]
+        self.assertEqual(delete["Action"], "DELETE")
+        self.assertEqual(delete["ResourceRecordSet"]["ResourceRecords"], [{"Value": '"new"'}])
+        self.assertEqual(dns_class._resource_records, {})
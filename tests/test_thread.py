@@ -0,0 +1,64 @@
+import threading
+import unittest
+
+from flask import current_app
+
+from certifire import create_app
+from certifire.errors import BacklogFull
+from certifire.thread import AppContextExecutor
+
+
+class TestAppContextExecutor(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.pool = AppContextExecutor(max_workers=1, max_backlog=1)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        self.ctx.pop()
+
+    def test_runs_in_app_context(self):
+        future = self.pool.submit(lambda: current_app.name)
+        self.assertEqual(future.result(timeout=5), self.app.name)
+
+    def test_submit_outside_app_context(self):
+        self.ctx.pop()
+        try:
+            with self.assertRaises(RuntimeError):
+                self.pool.submit(lambda: None)
+        finally:
+            self.ctx.push()
+
+    def test_rejects_when_backlog_full(self):
+        release = threading.Event()
+        running = self.pool.submit(release.wait, 5)
+        queued = self.pool.submit(lambda: None)
+
+        with self.assertRaises(BacklogFull):
+            self.pool.submit(lambda: None)
+        self.assertEqual(self.pool.free_slots, 0)
+
+        release.set()
+        running.result(timeout=5)
+        queued.result(timeout=5)
+        self.assertEqual(self.pool.free_slots, 2)
+
+    def test_stats(self):
+        def fail():
+            raise ValueError("boom")
+
+        self.pool.submit(lambda: None).result(timeout=5)
+        with self.assertRaises(ValueError):
+            self.pool.submit(fail).result(timeout=5)
+
+        stats = self.pool.stats
+        self.assertEqual(stats['completed'], 2)
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['running'], 0)
+        self.assertEqual(stats['queued'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()